@@ -0,0 +1,107 @@
+"""Content-addressed cache of vision analyses.
+
+Identical photos with the same prompt and model always produce an
+equivalent analysis, so the result is cached under a hash of those inputs:
+first in a bounded in-process LRU, then (optionally) in the database with a
+TTL so the cache survives restarts.
+"""
+
+import hashlib
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+
+from async_database import (
+    get_cached_analysis,
+    save_cached_analysis,
+    delete_expired_analyses,
+)
+from config import ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_TTL_HOURS
+
+_memory_cache = OrderedDict()
+
+# Hit/miss counters since start, see get_cache_stats()
+_stats = {"memory_hits": 0, "db_hits": 0, "misses": 0}
+
+_ttl = timedelta(hours=ANALYSIS_CACHE_TTL_HOURS)
+
+
+def cache_key(photos_base64: list, prompt: str, model: str) -> str:
+    """
+    Build the cache key of an analysis request
+    Args:
+        photos_base64: Preprocessed photos, as sent to the model
+        prompt: Prompt text, including the user's description
+        model: Model name
+    Returns:
+        str: Hex SHA-256 digest of the inputs
+    """
+    digest = hashlib.sha256()
+    digest.update(model.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(prompt.encode("utf-8"))
+    for photo_base64 in photos_base64:
+        digest.update(b"\0")
+        digest.update(hashlib.sha256(photo_base64.encode("ascii")).digest())
+    return digest.hexdigest()
+
+
+def _remember(key: str, response: str):
+    """Put a response into the in-process LRU, evicting the oldest entry"""
+    _memory_cache[key] = response
+    _memory_cache.move_to_end(key)
+    while len(_memory_cache) > ANALYSIS_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+
+
+async def get_analysis(key: str) -> str:
+    """
+    Look up a cached analysis
+    Args:
+        key: Key from cache_key()
+    Returns:
+        str: Cached response or None on a miss
+    """
+    if key in _memory_cache:
+        _memory_cache.move_to_end(key)
+        _stats["memory_hits"] += 1
+        return _memory_cache[key]
+
+    if ANALYSIS_CACHE_TTL_HOURS > 0:
+        response = await get_cached_analysis(key, _ttl)
+        if response is not None:
+            _stats["db_hits"] += 1
+            _remember(key, response)
+            return response
+
+    _stats["misses"] += 1
+    return None
+
+
+async def store_analysis(key: str, response: str):
+    """
+    Cache an analysis in both tiers
+    Args:
+        key: Key from cache_key()
+        response: Model response to cache
+    """
+    _remember(key, response)
+    if ANALYSIS_CACHE_TTL_HOURS > 0:
+        await save_cached_analysis(key, response)
+
+
+async def purge_expired():
+    """Remove expired entries from the database tier"""
+    if ANALYSIS_CACHE_TTL_HOURS > 0:
+        deleted = await delete_expired_analyses(_ttl)
+        if deleted:
+            logging.info(f"Removed {deleted} expired cached analyses")
+
+
+def get_cache_stats() -> dict:
+    """
+    Get cache counters
+    Returns:
+        dict: memory_hits, db_hits and misses since start plus current size
+    """
+    return {**_stats, "size": len(_memory_cache)}
@@ -0,0 +1,73 @@
+"""Async facade over the database functions.
+
+SQLAlchemy calls in `database` are blocking, so awaiting them directly from a
+handler stalls every other update. Each function here runs its synchronous
+counterpart in a dedicated thread pool sized to the connection pool.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+from database import DB_POOL_SIZE
+
+# One worker per pooled connection, so queries never wait on the pool itself
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+
+def _run_in_executor(func):
+    """Wrap a blocking database function into a coroutine function"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _executor, functools.partial(func, *args, **kwargs)
+        )
+
+    return wrapper
+
+
+get_user_timezone = _run_in_executor(database.get_user_timezone)
+save_user_timezone = _run_in_executor(database.save_user_timezone)
+get_user_today = _run_in_executor(database.get_user_today)
+save_gpt_response = _run_in_executor(database.save_gpt_response)
+get_daily_calories = _run_in_executor(database.get_daily_calories)
+get_daily_totals = _run_in_executor(database.get_daily_totals)
+get_totals_by_day = _run_in_executor(database.get_totals_by_day)
+save_nutrition_goals = _run_in_executor(database.save_nutrition_goals)
+get_nutrition_goals = _run_in_executor(database.get_nutrition_goals)
+get_nutrition_targets = _run_in_executor(database.get_nutrition_targets)
+get_all_active_users = _run_in_executor(database.get_all_active_users)
+get_timezones = _run_in_executor(database.get_timezones)
+get_timezone_users = _run_in_executor(database.get_timezone_users)
+get_daily_food_records = _run_in_executor(database.get_daily_food_records)
+get_daily_summary_data = _run_in_executor(database.get_daily_summary_data)
+save_weight_goal = _run_in_executor(database.save_weight_goal)
+get_weight_goal = _run_in_executor(database.get_weight_goal)
+save_weight_measurement = _run_in_executor(database.save_weight_measurement)
+get_weight_history = _run_in_executor(database.get_weight_history)
+get_weekly_nutrition = _run_in_executor(database.get_weekly_nutrition)
+claim_scheduled_job = _run_in_executor(database.claim_scheduled_job)
+renew_scheduled_job = _run_in_executor(database.renew_scheduled_job)
+finish_scheduled_job = _run_in_executor(database.finish_scheduled_job)
+get_job_deliveries = _run_in_executor(database.get_job_deliveries)
+save_job_deliveries = _run_in_executor(database.save_job_deliveries)
+save_summary_batch = _run_in_executor(database.save_summary_batch)
+get_pending_summary_batches = _run_in_executor(database.get_pending_summary_batches)
+claim_summary_batch = _run_in_executor(database.claim_summary_batch)
+finish_summary_batch = _run_in_executor(database.finish_summary_batch)
+save_usage = _run_in_executor(database.save_usage)
+get_tokens_used = _run_in_executor(database.get_tokens_used)
+get_usage_summary = _run_in_executor(database.get_usage_summary)
+save_weight_reminder = _run_in_executor(database.save_weight_reminder)
+pop_due_weight_reminders = _run_in_executor(database.pop_due_weight_reminders)
+get_cached_analysis = _run_in_executor(database.get_cached_analysis)
+save_cached_analysis = _run_in_executor(database.save_cached_analysis)
+delete_expired_analyses = _run_in_executor(database.delete_expired_analyses)
+find_similar_meal = _run_in_executor(database.find_similar_meal)
+load_bot_state = _run_in_executor(database.load_bot_state)
+save_bot_state = _run_in_executor(database.save_bot_state)
+delete_bot_state = _run_in_executor(database.delete_bot_state)
+delete_expired_bot_state = _run_in_executor(database.delete_expired_bot_state)
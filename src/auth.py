@@ -1,5 +1,5 @@
 import logging
-from config import ALLOWED_USERS
+from config import ALLOWED_USERS, ADMIN_USERS
 
 
 def check_user_access(user_id: int, username: str) -> bool:
@@ -13,3 +13,8 @@ def check_user_access(user_id: int, username: str) -> bool:
         f"Unauthorized access attempt from user @{username} (ID: {user_id})"
     )
     return False
+
+
+def is_admin(username: str) -> bool:
+    """Check if user may see data of all users"""
+    return bool(username) and username in ADMIN_USERS
@@ -1,3 +1,4 @@
+import json
 import os
 from dotenv import load_dotenv
 
@@ -16,10 +17,152 @@ ALLOWED_USERS = [
     if username.strip()
 ]
 
+# Usernames that may see everyone's OpenAI usage with /usage
+ADMIN_USERS = [
+    username.strip()
+    for username in os.getenv("ADMIN_USERS", "").split(",")
+    if username.strip()
+]
+
 # OpenAI configuration
 GPT_MODEL = os.getenv(
-    "GPT_MODEL", "gpt-4-vision-preview"
-)  # Default to GPT-4 Vision if not specified
+    "GPT_MODEL", "gpt-4o"
+)  # Default to GPT-4o (vision and JSON mode) if not specified
+
+
+def _model_chain(name: str, default: str) -> list:
+    """Read a comma-separated chain of models, primary first, without repeats"""
+    chain = []
+    for model in os.getenv(name, default).split(","):
+        model = model.strip()
+        if model and model not in chain:
+            chain.append(model)
+    return chain
+
+
+# Models per task, each a chain tried in order when a model is rate-limited,
+# slow or failing: text-only meals, meals with photos, corrections of an
+# analysis, the daily nutrition analysis, the weekly weight analysis and voice
+# transcription
+MODEL_ROUTES = {
+    "text_meal": _model_chain("MODEL_TEXT_MEAL", f"gpt-4o-mini,{GPT_MODEL}"),
+    "vision_meal": _model_chain("MODEL_VISION_MEAL", f"{GPT_MODEL},gpt-4o-mini"),
+    "meal_correction": _model_chain(
+        "MODEL_MEAL_CORRECTION", f"gpt-4o-mini,{GPT_MODEL}"
+    ),
+    "daily_analysis": _model_chain("MODEL_DAILY_ANALYSIS", f"gpt-4o-mini,{GPT_MODEL}"),
+    "weekly_analysis": _model_chain(
+        "MODEL_WEEKLY_ANALYSIS", f"{GPT_MODEL},gpt-4o-mini"
+    ),
+    "transcription": _model_chain("MODEL_TRANSCRIPTION", "whisper-1"),
+}
+
+# Estimated prices in USD per million input and output tokens, and per
+# minute of transcribed audio; models are matched by the longest name prefix
+# and the Batch API costs half. MODEL_PRICES adds or overrides token prices
+# as JSON, e.g. {"gpt-4o": [2.5, 10]}
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4-vision-preview": (10.0, 30.0),
+    **json.loads(os.getenv("MODEL_PRICES", "{}")),
+}
+AUDIO_PRICES = {"whisper-1": 0.006}
+
+# Tokens each user may use per day (0 means no limit)
+USER_DAILY_TOKEN_BUDGET = int(os.getenv("USER_DAILY_TOKEN_BUDGET", "0"))
+
+# OpenAI calls: deadline of one attempt (seconds), retries of rate-limited,
+# timed out and 5xx calls, concurrent calls per model, and consecutive failed
+# calls after which a model is paused for OPENAI_BREAKER_RESET seconds
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "8"))
+OPENAI_BREAKER_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5"))
+OPENAI_BREAKER_RESET = float(os.getenv("OPENAI_BREAKER_RESET", "30"))
+# Deadline of a model that has a fallback; it is not retried either
+OPENAI_FALLBACK_TIMEOUT = float(os.getenv("OPENAI_FALLBACK_TIMEOUT", "20"))
+
+# Photo preprocessing: longest edge in pixels, JPEG quality and the detail
+# level requested from the vision model ("auto", "low" or "high")
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_DETAIL = os.getenv("IMAGE_DETAIL", "auto")
+
+# Near-duplicate photos: "off", "dedup" (drop near-identical photos from a
+# meal) or "reuse" (also reuse the confirmed analysis of a recent meal with
+# the same photos); maximum differing hash bits and how far back to look
+PHOTO_DEDUP_MODE = os.getenv("PHOTO_DEDUP_MODE", "dedup")
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))
+PHASH_LOOKBACK_DAYS = int(os.getenv("PHASH_LOOKBACK_DAYS", "14"))
+
+# Vision analysis cache: entries kept in process memory and how long
+# entries live in the database tier (0 disables the database tier)
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "256"))
+ANALYSIS_CACHE_TTL_HOURS = float(os.getenv("ANALYSIS_CACHE_TTL_HOURS", "24"))
+
+# Album photos: an album is analyzed once no new photo of it has arrived for
+# this many seconds, or at once when it reaches the photo limit
+MEDIA_GROUP_DEBOUNCE = float(os.getenv("MEDIA_GROUP_DEBOUNCE", "1.0"))
+MEDIA_GROUP_MAX_PHOTOS = int(os.getenv("MEDIA_GROUP_MAX_PHOTOS", "5"))
+
+# Meal drafts keep Telegram file ids; this many encoded photos stay in memory
+# so the analysis doesn't download them again
+PHOTO_CACHE_SIZE = int(os.getenv("PHOTO_CACHE_SIZE", "64"))
+
+# Drafts and conversation states: "database" (bot_state table), "file"
+# (pickle file at STATE_FILE) or "memory" (lost on restart). They are written
+# every STATE_UPDATE_INTERVAL seconds and dropped after DRAFT_TTL_MINUTES of
+# user inactivity (0 keeps them)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "database")
+STATE_FILE = os.getenv("STATE_FILE", "bot_state.pickle")
+STATE_UPDATE_INTERVAL = float(os.getenv("STATE_UPDATE_INTERVAL", "60"))
+DRAFT_TTL_MINUTES = int(os.getenv("DRAFT_TTL_MINUTES", "180"))
+
+# Downloaded media stays in memory up to this size and spills to a temporary
+# file above it
+MEDIA_SPILL_BYTES = int(os.getenv("MEDIA_SPILL_BYTES", str(10 * 1024 * 1024)))
+
+# Daily summary fan-out: parallel OpenAI analyses and Telegram messages per
+# second (Telegram allows about 30 messages per second per bot)
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "5"))
+TELEGRAM_SEND_RATE = float(os.getenv("TELEGRAM_SEND_RATE", "25"))
+SUMMARY_MAX_RETRIES = int(os.getenv("SUMMARY_MAX_RETRIES", "3"))
+
+# How daily summary analyses are made: "direct" (chat completions at
+# midnight) or "batch" (one OpenAI Batch API job per timezone, half the
+# price; summaries are sent when the batch finishes, within 24 hours)
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "direct")
+
+# Scheduled jobs: how often due jobs are checked (seconds) and how long a
+# started run blocks a retry if the bot dies before finishing it (minutes)
+SCHEDULER_INTERVAL = int(os.getenv("SCHEDULER_INTERVAL", "60"))
+JOB_LEASE_MINUTES = int(os.getenv("JOB_LEASE_MINUTES", "60"))
+
+# Estimated token budget of the week summary sent for the weekly weight
+# analysis; products beyond it are dropped, least frequent first
+WEEKLY_PROMPT_TOKEN_BUDGET = int(os.getenv("WEEKLY_PROMPT_TOKEN_BUDGET", "600"))
+
+# Minimum seconds between edits of a message showing a streamed answer
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+# Updates of different users are processed in parallel, up to this many at a
+# time; the updates of one user always run one by one in order. Beyond
+# UPDATE_MAX_IN_FLIGHT queued or running updates, no more are accepted until
+# some are done
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+UPDATE_MAX_IN_FLIGHT = int(os.getenv("UPDATE_MAX_IN_FLIGHT", "256"))
+
+# Webhook mode, used when WEBHOOK_URL is set (the bot's public HTTPS base
+# URL); otherwise the bot long-polls. Telegram posts to
+# WEBHOOK_URL/WEBHOOK_PATH using up to WEBHOOK_MAX_CONNECTIONS connections
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
 
 # Check for required keys
 if not TELEGRAM_TOKEN or not OPENAI_API_KEY:
@@ -6,6 +6,7 @@ AWAITING_CONTEXT = 1
 AWAITING_GOALS = 2
 AWAITING_WEIGHT = 3
 AWAITING_TARGET_WEIGHT = 4
+AWAITING_TIMEZONE = 5
 
 # Telegram formatting instructions
 TELEGRAM_FORMATTING = """Отвечай, используя только HTML-разметку Telegram:  
@@ -17,5 +18,20 @@ TELEGRAM_FORMATTING = """Отвечай, используя только HTML-р
 Не используй `*`, `_` или другие символы Markdown.  
 """
 
+# Reply when a user has used up the daily token budget
+TOKEN_BUDGET_MESSAGE = (
+    "⏳ Дневной лимит запросов к модели исчерпан.\n"
+    "Попробуйте завтра или обратитесь к администратору."
+)
+
+# Reply to a button of a draft that was cancelled or has expired
+DRAFT_EXPIRED_MESSAGE = (
+    "⌛ Этот черновик уже отменен или устарел.\n"
+    "Отправьте фото или описание блюда заново."
+)
+
 # Default timezone for the application
 DEFAULT_TIMEZONE = "Europe/Moscow"
+
+# Longest period /usage reports, in days
+MAX_USAGE_DAYS = 366
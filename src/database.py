@@ -1,13 +1,35 @@
-from sqlalchemy import create_engine, Column, String, Date, Time, Text, Integer, Float
+from sqlalchemy import (
+    create_engine,
+    func,
+    Column,
+    String,
+    Date,
+    DateTime,
+    Time,
+    Text,
+    Integer,
+    Float,
+    BigInteger,
+    Index,
+    insert,
+    inspect,
+    or_,
+    select,
+    text,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime, date, timedelta
 import os
 from dotenv import load_dotenv
 import pytz
+import json
 import logging
-import re
+from typing import Optional
 from constants import DEFAULT_TIMEZONE
+from nutrition import extract_calories, meal_summary_line, parse_nutrition_goals
 
 # Load environment variables
 load_dotenv()
@@ -15,8 +37,16 @@ load_dotenv()
 # Get database URL from environment
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Number of connections kept in the pool (also the number of worker threads
+# that run queries on behalf of the async handlers)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+
 # Create database engine
-engine = create_engine(DATABASE_URL)
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    pool_pre_ping=True,
+)
 
 # Create declarative base
 Base = declarative_base()
@@ -26,18 +56,74 @@ class DailyData(Base):
     """Table for storing daily ChatGPT responses"""
 
     __tablename__ = "daily_data"
+    __table_args__ = (
+        Index("ix_daily_data_username_date_time", "username", "date", "time"),
+    )
 
-    # Using composite primary key of date and time
-    date = Column(Date, primary_key=True)
-    time = Column(Time, primary_key=True)
+    id = Column(Integer, primary_key=True)
+    date = Column(Date, nullable=False)
+    time = Column(Time, nullable=False)
     username = Column(String)
     gpt_response = Column(String)
     calories = Column(Float)  # Add calories column
+    protein = Column(Float)
+    fat = Column(Float)
+    carbs = Column(Float)
+    analysis_json = Column(Text)  # Structured MealAnalysis the HTML was rendered from
 
     def __repr__(self):
         return f"<DailyData(date={self.date}, time={self.time}, username={self.username}, calories={self.calories})>"
 
 
+class DailyTotals(Base):
+    """Per-user, per-day rollup of daily_data maintained on every save"""
+
+    __tablename__ = "daily_totals"
+
+    username = Column(String, primary_key=True)
+    date = Column(Date, primary_key=True)
+    calories = Column(Float, nullable=False, default=0)
+    records_count = Column(Integer, nullable=False, default=0)
+    protein = Column(Float, nullable=False, default=0, server_default="0")
+    fat = Column(Float, nullable=False, default=0, server_default="0")
+    carbs = Column(Float, nullable=False, default=0, server_default="0")
+
+    def __repr__(self):
+        return f"<DailyTotals(username={self.username}, date={self.date}, calories={self.calories}, records_count={self.records_count})>"
+
+
+class UserSettings(Base):
+    """Table for storing per-user preferences"""
+
+    __tablename__ = "user_settings"
+
+    username = Column(String, primary_key=True)
+    timezone = Column(String, nullable=False, default=DEFAULT_TIMEZONE)
+
+    def __repr__(self):
+        return f"<UserSettings(username={self.username}, timezone={self.timezone})>"
+
+
+class MealPhotoHash(Base):
+    """Table for storing perceptual hashes of photos of confirmed meals"""
+
+    __tablename__ = "meal_photo_hashes"
+    __table_args__ = (
+        Index("ix_meal_photo_hashes_username_created_at", "username", "created_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    # Id of the daily_data row; deliberately not a foreign key, so the table
+    # can be created before migrate_schema() gives old daily_data tables an id
+    daily_data_id = Column(Integer, index=True)
+    username = Column(String)
+    phash = Column(BigInteger)  # 64-bit dHash stored as a signed integer
+    created_at = Column(DateTime)  # UTC
+
+    def __repr__(self):
+        return f"<MealPhotoHash(username={self.username}, phash={self.phash})>"
+
+
 class NutritionGoals(Base):
     """Table for storing user nutrition goals"""
 
@@ -46,6 +132,11 @@ class NutritionGoals(Base):
     username = Column(String, primary_key=True)
     goals = Column(Text)
     updated_at = Column(Date)
+    # Daily targets parsed from the goals text when it is saved
+    calories_target = Column(Float)
+    protein_target = Column(Float)
+    fat_target = Column(Float)
+    carbs_target = Column(Float)
 
     def __repr__(self):
         return f"<NutritionGoals(username={self.username})>"
@@ -68,6 +159,9 @@ class WeightHistory(Base):
     """Table for storing user's weight measurements"""
 
     __tablename__ = "weight_history"
+    __table_args__ = (
+        Index("ix_weight_history_username_measured_at", "username", "measured_at"),
+    )
 
     id = Column(Integer, primary_key=True)
     username = Column(String)
@@ -78,48 +172,414 @@ class WeightHistory(Base):
         return f"<WeightHistory(username={self.username}, weight={self.weight}, date={self.measured_at})>"
 
 
-# Create all tables
+class ScheduledJob(Base):
+    """Table for storing the last completed run of each scheduled job"""
+
+    __tablename__ = "scheduled_jobs"
+
+    name = Column(String, primary_key=True)
+    last_run_at = Column(DateTime)  # UTC fire time of the last completed run
+    locked_until = Column(DateTime)  # UTC lease of the run in progress
+
+    def __repr__(self):
+        return f"<ScheduledJob(name={self.name}, last_run_at={self.last_run_at})>"
+
+
+class JobDelivery(Base):
+    """Table for storing which users a scheduled run has already reached"""
+
+    __tablename__ = "job_deliveries"
+
+    job = Column(String, primary_key=True)
+    fire_time = Column(DateTime, primary_key=True)  # UTC
+    username = Column(String, primary_key=True)
+
+    def __repr__(self):
+        return f"<JobDelivery(job={self.job}, fire_time={self.fire_time}, username={self.username})>"
+
+
+class WeightReminder(Base):
+    """Table for storing pending "remind me tomorrow" weight reminders"""
+
+    __tablename__ = "weight_reminders"
+
+    username = Column(String, primary_key=True)
+    remind_at = Column(DateTime, index=True)  # UTC
+
+    def __repr__(self):
+        return f"<WeightReminder(username={self.username}, remind_at={self.remind_at})>"
+
+
+class CachedAnalysis(Base):
+    """Table for caching vision analyses by a hash of their inputs"""
+
+    __tablename__ = "analysis_cache"
+
+    key = Column(String(64), primary_key=True)
+    response = Column(Text)
+    created_at = Column(DateTime, index=True)  # UTC
+
+    def __repr__(self):
+        return f"<CachedAnalysis(key={self.key}, created_at={self.created_at})>"
+
+
+class SummaryBatch(Base):
+    """Table for daily summaries waiting on an OpenAI batch of analyses"""
+
+    __tablename__ = "summary_batches"
+
+    batch_id = Column(String, primary_key=True)
+    timezone = Column(String)
+    summary_date = Column(Date)
+    usernames = Column(Text)  # JSON list of users whose analysis is batched
+    created_at = Column(DateTime)  # UTC
+    locked_until = Column(DateTime)  # UTC lease of the check in progress
+    delivered_at = Column(DateTime)  # UTC, None while pending
+
+    def __repr__(self):
+        return f"<SummaryBatch(batch_id={self.batch_id}, summary_date={self.summary_date})>"
+
+
+class OpenAIUsage(Base):
+    """Table for the tokens and estimated cost of each OpenAI call"""
+
+    __tablename__ = "openai_usage"
+    __table_args__ = (Index("ix_openai_usage_username_date", "username", "date"),)
+
+    id = Column(Integer, primary_key=True)
+    username = Column(String)
+    date = Column(Date)  # Day of the call in the user's timezone
+    created_at = Column(DateTime)  # UTC
+    call_type = Column(String)  # Model route, e.g. "vision_meal"
+    model = Column(String)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    images = Column(Integer, default=0)
+    audio_seconds = Column(Float, default=0)
+    latency = Column(Float)  # Seconds, None for batch requests
+    cost = Column(Float)  # Estimated USD
+
+    def __repr__(self):
+        return f"<OpenAIUsage(username={self.username}, call_type={self.call_type}, model={self.model})>"
+
+
+class BotState(Base):
+    """Table for user drafts and conversation states kept across restarts"""
+
+    __tablename__ = "bot_state"
+
+    kind = Column(String, primary_key=True)  # "user_data" or "conversation:<name>"
+    key = Column(String, primary_key=True)  # User id or JSON conversation key
+    data = Column(Text)  # JSON
+    updated_at = Column(DateTime, index=True)  # UTC
+
+    def __repr__(self):
+        return f"<BotState(kind={self.kind}, key={self.key}, updated_at={self.updated_at})>"
+
+
+def _targets_columns(goals: str) -> dict:
+    """Parse goals text into NutritionGoals target column values"""
+    targets = parse_nutrition_goals(goals)
+    return {
+        "calories_target": targets.calories,
+        "protein_target": targets.protein,
+        "fat_target": targets.fat,
+        "carbs_target": targets.carbs,
+    }
+
+
+def _aggregate_daily_data(username: str = None):
+    """Build a SELECT of per-user, per-day totals computed from daily_data"""
+    query = (
+        select(
+            DailyData.username,
+            DailyData.date,
+            func.coalesce(func.sum(DailyData.calories), 0),
+            func.count(),
+            func.coalesce(func.sum(DailyData.protein), 0),
+            func.coalesce(func.sum(DailyData.fat), 0),
+            func.coalesce(func.sum(DailyData.carbs), 0),
+        )
+        .where(DailyData.username.isnot(None))
+        .group_by(DailyData.username, DailyData.date)
+    )
+    if username:
+        query = query.where(DailyData.username == username)
+    return query
+
+
+def _insert_daily_totals(username: str = None):
+    """Build an INSERT of daily_totals rows computed from daily_data"""
+    return insert(DailyTotals).from_select(
+        [
+            DailyTotals.username,
+            DailyTotals.date,
+            DailyTotals.calories,
+            DailyTotals.records_count,
+            DailyTotals.protein,
+            DailyTotals.fat,
+            DailyTotals.carbs,
+        ],
+        _aggregate_daily_data(username),
+    )
+
+
+def migrate_schema():
+    """
+    Bring tables created by older versions up to the current schema:
+    replace the (date, time) primary key of daily_data with a surrogate id,
+    add columns and create indexes missing from existing tables, and fill
+    the daily_totals rollup if it is empty
+    """
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        columns = [column["name"] for column in inspector.get_columns("daily_data")]
+
+        if "id" not in columns:
+            logging.info("Migrating daily_data to a surrogate primary key")
+            if conn.dialect.name == "postgresql":
+                pk_name = inspector.get_pk_constraint("daily_data")["name"]
+                if pk_name:
+                    conn.execute(
+                        text(f'ALTER TABLE daily_data DROP CONSTRAINT "{pk_name}"')
+                    )
+                conn.execute(text("ALTER TABLE daily_data ADD COLUMN id SERIAL"))
+                conn.execute(text("ALTER TABLE daily_data ADD PRIMARY KEY (id)"))
+            else:
+                # SQLite can't alter primary keys: copy into a fresh table.
+                # Legacy mode keeps references in other tables pointing at
+                # daily_data instead of following the rename
+                conn.execute(text("PRAGMA legacy_alter_table=ON"))
+                conn.execute(text("ALTER TABLE daily_data RENAME TO daily_data_old"))
+                conn.execute(text("PRAGMA legacy_alter_table=OFF"))
+                DailyData.__table__.create(conn)
+                conn.execute(
+                    text(
+                        "INSERT INTO daily_data "
+                        "(date, time, username, gpt_response, calories) "
+                        "SELECT date, time, username, gpt_response, calories "
+                        "FROM daily_data_old ORDER BY date, time"
+                    )
+                )
+                conn.execute(text("DROP TABLE daily_data_old"))
+
+        # Fresh inspector: the one above has the pre-migration columns cached
+        inspector = inspect(conn)
+
+        # Earlier versions declared meal_photo_hashes.daily_data_id a foreign
+        # key, which the SQLite rename above redirected to the dropped
+        # daily_data_old; rebuild the table without it
+        if inspector.get_foreign_keys("meal_photo_hashes"):
+            logging.info("Dropping the foreign key of meal_photo_hashes")
+            if conn.dialect.name == "postgresql":
+                for foreign_key in inspector.get_foreign_keys("meal_photo_hashes"):
+                    conn.execute(
+                        text(
+                            "ALTER TABLE meal_photo_hashes "
+                            f'DROP CONSTRAINT "{foreign_key["name"]}"'
+                        )
+                    )
+            else:
+                conn.execute(
+                    text(
+                        "ALTER TABLE meal_photo_hashes RENAME TO meal_photo_hashes_old"
+                    )
+                )
+                for index in MealPhotoHash.__table__.indexes:
+                    conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+                MealPhotoHash.__table__.create(conn)
+                conn.execute(
+                    text(
+                        "INSERT INTO meal_photo_hashes "
+                        "(id, daily_data_id, username, phash, created_at) "
+                        "SELECT id, daily_data_id, username, phash, created_at "
+                        "FROM meal_photo_hashes_old"
+                    )
+                )
+                conn.execute(text("DROP TABLE meal_photo_hashes_old"))
+            inspector = inspect(conn)
+
+        goals_columns = {
+            column["name"] for column in inspector.get_columns("nutrition_goals")
+        }
+        for table in (
+            DailyData.__table__,
+            DailyTotals.__table__,
+            NutritionGoals.__table__,
+        ):
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or column.primary_key:
+                    continue
+                logging.info(f"Adding column {table.name}.{column.name}")
+                ddl = (
+                    f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                    f"{column.type.compile(conn.dialect)}"
+                )
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg} NOT NULL"
+                conn.execute(text(ddl))
+
+        if "calories_target" not in goals_columns:
+            # Parse goals saved before targets were stored
+            goals_table = NutritionGoals.__table__
+            for username, goals in conn.execute(
+                select(goals_table.c.username, goals_table.c.goals)
+            ):
+                conn.execute(
+                    goals_table.update()
+                    .where(goals_table.c.username == username)
+                    .values(**_targets_columns(goals))
+                )
+
+        for table in (
+            DailyData.__table__,
+            WeightHistory.__table__,
+            MealPhotoHash.__table__,
+        ):
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        # daily_totals is new to databases of older versions: fill it from
+        # daily_data, or totals would read 0 until rebuild-totals is run
+        if conn.execute(select(DailyTotals.username).limit(1)).first() is None:
+            rows = conn.execute(_insert_daily_totals()).rowcount
+            if rows:
+                logging.info(f"Filled daily_totals from daily_data: {rows} rows")
+
+
+# Create all tables and upgrade the ones left by older versions
 Base.metadata.create_all(engine)
+migrate_schema()
 
 # Create session factory
 SessionLocal = sessionmaker(bind=engine)
 
 
-def extract_calories(gpt_response: str) -> float:
+# Per-process cache of user timezones, read on every save and daily lookup
+_timezone_cache = {}
+
+
+def get_user_timezone(username: str) -> str:
     """
-    Extract total calories from GPT response
+    Get user's timezone name
     Args:
-        gpt_response: GPT response text
+        username: Telegram username of the user
     Returns:
-        float: Total calories or 0 if not found
+        str: Timezone name (DEFAULT_TIMEZONE if the user hasn't set one)
     """
+    if username in _timezone_cache:
+        return _timezone_cache[username]
+
+    session = SessionLocal()
     try:
-        # Ищем строки с упоминанием калорий
-        matches = re.findall(
-            r"(\d+(?:\.\d+)?)\s*(?:к?кал|ккал|калори[йя])", gpt_response.lower()
-        )
-        if matches:
-            # Берем последнее число (обычно это общая сумма)
-            return float(matches[-1])
-        return 0
+        settings = session.get(UserSettings, username)
+        timezone = settings.timezone if settings else DEFAULT_TIMEZONE
+        _timezone_cache[username] = timezone
+        return timezone
     except Exception as e:
-        logging.error(f"Error extracting calories: {str(e)}")
-        return 0
+        logging.error(f"Error getting user timezone: {str(e)}")
+        return DEFAULT_TIMEZONE
+    finally:
+        session.close()
+
+
+def save_user_timezone(username: str, timezone: str) -> bool:
+    """
+    Save or update user's timezone
+    Args:
+        username: Telegram username of the user
+        timezone: Timezone name, e.g. "Europe/Moscow"
+    Returns:
+        bool: True if successful, False if error occurred
+    """
+    session = SessionLocal()
+    try:
+        session.merge(UserSettings(username=username, timezone=timezone))
+        session.commit()
+        _timezone_cache[username] = timezone
+        return True
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error saving user timezone: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def get_user_today(username: str) -> date:
+    """Get the current date in the user's timezone"""
+    return datetime.now(pytz.timezone(get_user_timezone(username))).date()
+
+
+def _add_to_daily_totals(session, username: str, day: date, values: dict):
+    """
+    Increment the user's rollup row for the day within the given session
+    Args:
+        session: Open session; the caller commits
+        username: Telegram username of the user
+        day: Date of the record
+        values: Calories, protein, fat and carbs of the record
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = dialect_insert(DailyTotals).values(
+            username=username, date=day, records_count=1, **values
+        )
+        increments = {
+            name: getattr(DailyTotals, name) + getattr(stmt.excluded, name)
+            for name in values
+        }
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[DailyTotals.username, DailyTotals.date],
+            set_={**increments, "records_count": DailyTotals.records_count + 1},
+        )
+        session.execute(stmt)
+        return
+
+    # Generic fallback: lock the row and update it in place
+    totals = session.get(DailyTotals, (username, day), with_for_update=True)
+    if totals:
+        for name, value in values.items():
+            setattr(totals, name, getattr(totals, name) + value)
+        totals.records_count += 1
+    else:
+        session.add(DailyTotals(username=username, date=day, records_count=1, **values))
+
 
+def _to_signed64(value: int) -> int:
+    """Map an unsigned 64-bit hash onto the signed BIGINT range"""
+    return value - (1 << 64) if value >= 1 << 63 else value
 
-def save_gpt_response(response: str, username: str):
+
+def save_gpt_response(
+    response: str, username: str, photo_hashes: list = None, analysis: dict = None
+):
     """
     Save ChatGPT response to database with current date and time
     Args:
         response: GPT response text
         username: Telegram username of the user
+        photo_hashes: Perceptual hashes of the analyzed photos, if any
+        analysis: Structured analysis (MealAnalysis as a dict) the response
+            was rendered from; without it calories are parsed from the text
     """
     # Get current date and time in user's timezone
-    tz = pytz.timezone(DEFAULT_TIMEZONE)
+    tz = pytz.timezone(get_user_timezone(username))
     now = datetime.now(tz)
 
-    # Extract calories from response
-    calories = extract_calories(response)
+    if analysis:
+        total = analysis["total"]
+        values = {name: total[name] for name in ("calories", "protein", "fat", "carbs")}
+    else:
+        # Legacy free-form response: extract calories from the text
+        values = {
+            "calories": extract_calories(response),
+            "protein": 0,
+            "fat": 0,
+            "carbs": 0,
+        }
 
     session = SessionLocal()
     try:
@@ -128,9 +588,26 @@ def save_gpt_response(response: str, username: str):
             time=now.time(),
             username=username,
             gpt_response=response,
-            calories=calories,
+            analysis_json=(
+                json.dumps(analysis, ensure_ascii=False) if analysis else None
+            ),
+            **values,
         )
         session.add(daily_data)
+        if photo_hashes:
+            session.flush()
+            for phash in photo_hashes:
+                if phash is not None:
+                    session.add(
+                        MealPhotoHash(
+                            daily_data_id=daily_data.id,
+                            username=username,
+                            phash=_to_signed64(phash),
+                            created_at=_to_utc(now),
+                        )
+                    )
+        # Keep the rollup in the same transaction as the record itself
+        _add_to_daily_totals(session, username, now.date(), values)
         session.commit()
     except Exception as e:
         session.rollback()
@@ -149,27 +626,187 @@ def get_daily_calories(username: str, target_date: date = None) -> float:
         float: Total calories for the day
     """
     if target_date is None:
-        target_date = datetime.now(pytz.timezone(DEFAULT_TIMEZONE)).date()
+        target_date = get_user_today(username)
 
     session = SessionLocal()
     try:
-        daily_records = (
-            session.query(DailyData)
-            .filter(DailyData.username == username)
-            .filter(DailyData.date == target_date)
+        totals = session.get(DailyTotals, (username, target_date))
+        return totals.calories if totals else 0
+    except Exception as e:
+        logging.error(f"Error getting daily calories: {str(e)}")
+        return 0
+    finally:
+        session.close()
+
+
+def get_daily_totals(username: str, target_date: date = None) -> dict:
+    """
+    Get total calories and macronutrients for a specific date
+    Args:
+        username: Telegram username of the user
+        target_date: Date to get totals for (defaults to today)
+    Returns:
+        dict: calories, protein, fat and carbs for the day
+    """
+    if target_date is None:
+        target_date = get_user_today(username)
+
+    totals = {"calories": 0, "protein": 0, "fat": 0, "carbs": 0}
+    session = SessionLocal()
+    try:
+        row = session.get(DailyTotals, (username, target_date))
+        if row:
+            totals = {name: getattr(row, name) for name in totals}
+        return totals
+    except Exception as e:
+        logging.error(f"Error getting daily totals: {str(e)}")
+        return totals
+    finally:
+        session.close()
+
+
+def get_totals_by_day(username: str, start_date: date, days: int) -> dict:
+    """
+    Get per-day nutrition totals for a range of days in a single query
+    Args:
+        username: Telegram username of the user
+        start_date: First date of the range
+        days: Number of days in the range
+    Returns:
+        dict: Mapping of date to a dict with calories, protein, fat, carbs and
+            records_count, in date order (days without records are left out)
+    """
+    end_date = start_date + timedelta(days=days)
+
+    session = SessionLocal()
+    try:
+        rows = (
+            session.query(
+                DailyTotals.date,
+                DailyTotals.calories,
+                DailyTotals.protein,
+                DailyTotals.fat,
+                DailyTotals.carbs,
+                DailyTotals.records_count,
+            )
+            .filter(DailyTotals.username == username)
+            .filter(DailyTotals.date >= start_date)
+            .filter(DailyTotals.date < end_date)
+            .filter(DailyTotals.records_count > 0)
+            .order_by(DailyTotals.date)
             .all()
         )
+        return {
+            row.date: {
+                "calories": row.calories,
+                "protein": row.protein,
+                "fat": row.fat,
+                "carbs": row.carbs,
+                "records_count": row.records_count,
+            }
+            for row in rows
+        }
+    except Exception as e:
+        logging.error(f"Error getting totals by day: {str(e)}")
+        return {}
+    finally:
+        session.close()
 
-        total_calories = sum(
-            record.calories for record in daily_records if record.calories is not None
-        )
-        return total_calories
+
+def rebuild_daily_totals(username: str = None) -> int:
+    """
+    Recompute the daily_totals rollup from daily_data
+    Args:
+        username: Rebuild only this user's rows (defaults to all users)
+    Returns:
+        int: Number of rollup rows written
+    """
+    session = SessionLocal()
+    try:
+        delete_query = session.query(DailyTotals)
+        if username:
+            delete_query = delete_query.filter(DailyTotals.username == username)
+        delete_query.delete(synchronize_session=False)
+
+        result = session.execute(_insert_daily_totals(username))
+        session.commit()
+        return result.rowcount
     except Exception as e:
-        logging.error(f"Error getting daily calories: {str(e)}")
-        return 0
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+def check_daily_totals(username: str = None) -> list:
+    """
+    Compare the daily_totals rollup against totals computed from daily_data
+    Args:
+        username: Check only this user's rows (defaults to all users)
+    Returns:
+        list: Tuples (username, date, stored, actual) for every mismatch, where
+            stored and actual are (calories, records_count, protein, fat,
+            carbs) or None if missing
+    """
+    session = SessionLocal()
+    try:
+        actual = {
+            (row[0], row[1]): (
+                float(row[2]),
+                row[3],
+                float(row[4]),
+                float(row[5]),
+                float(row[6]),
+            )
+            for row in session.execute(_aggregate_daily_data(username))
+        }
+
+        stored_query = session.query(
+            DailyTotals.username,
+            DailyTotals.date,
+            DailyTotals.calories,
+            DailyTotals.records_count,
+            DailyTotals.protein,
+            DailyTotals.fat,
+            DailyTotals.carbs,
+        )
+        if username:
+            stored_query = stored_query.filter(DailyTotals.username == username)
+        stored = {(row[0], row[1]): tuple(row[2:]) for row in stored_query}
     finally:
         session.close()
 
+    mismatches = []
+    for key in sorted(actual.keys() | stored.keys()):
+        expected = actual.get(key)
+        found = stored.get(key)
+        if (
+            expected is None
+            or found is None
+            or expected[1] != found[1]
+            or any(abs(expected[i] - found[i]) > 0.01 for i in (0, 2, 3, 4))
+        ):
+            mismatches.append((key[0], key[1], found, expected))
+    return mismatches
+
+
+# Per-process caches of goals, invalidated when the user saves new ones
+_goals_cache = {}
+_weight_goal_cache = {}
+
+
+def _goals_entry(goals: NutritionGoals) -> dict:
+    """Convert a NutritionGoals row into its cached form"""
+    if goals is None:
+        return None
+    return {
+        "text": goals.goals,
+        "calories": goals.calories_target,
+        "protein": goals.protein_target,
+        "fat": goals.fat_target,
+        "carbs": goals.carbs_target,
+    }
+
 
 def save_nutrition_goals(username: str, goals: str) -> bool:
     """
@@ -180,6 +817,9 @@ def save_nutrition_goals(username: str, goals: str) -> bool:
     Returns:
         bool: True if successful, False if error occurred
     """
+    # Parse the numeric targets once, here, instead of on every read
+    targets = _targets_columns(goals)
+
     session = SessionLocal()
     try:
         # Check if goals already exist for this user
@@ -191,35 +831,48 @@ def save_nutrition_goals(username: str, goals: str) -> bool:
             # Update existing goals
             existing_goals.goals = goals
             existing_goals.updated_at = datetime.now().date()
+            for name, value in targets.items():
+                setattr(existing_goals, name, value)
         else:
             # Create new goals
-            new_goals = NutritionGoals(
-                username=username, goals=goals, updated_at=datetime.now().date()
+            existing_goals = NutritionGoals(
+                username=username,
+                goals=goals,
+                updated_at=datetime.now().date(),
+                **targets,
             )
-            session.add(new_goals)
+            session.add(existing_goals)
 
         session.commit()
+        _goals_cache[username] = _goals_entry(existing_goals)
         return True
     except Exception as e:
         session.rollback()
+        _goals_cache.pop(username, None)
         logging.error(f"Error saving nutrition goals: {str(e)}")
         return False
     finally:
         session.close()
 
 
-def get_nutrition_goals(username: str) -> str:
+def get_nutrition_targets(username: str) -> dict:
     """
-    Get user's nutrition goals
+    Get user's nutrition goals with the targets parsed from them
     Args:
         username: Telegram username of the user
     Returns:
-        str: User's nutrition goals or None if not found
+        dict: "text" with the goals as entered plus "calories", "protein",
+            "fat" and "carbs" targets (None if not stated), or None if the
+            user has no goals
     """
+    if username in _goals_cache:
+        return _goals_cache[username]
+
     session = SessionLocal()
     try:
         goals = session.query(NutritionGoals).filter_by(username=username).first()
-        return goals.goals if goals else None
+        _goals_cache[username] = _goals_entry(goals)
+        return _goals_cache[username]
     except Exception as e:
         logging.error(f"Error getting nutrition goals: {str(e)}")
         return None
@@ -227,6 +880,18 @@ def get_nutrition_goals(username: str) -> str:
         session.close()
 
 
+def get_nutrition_goals(username: str) -> str:
+    """
+    Get user's nutrition goals
+    Args:
+        username: Telegram username of the user
+    Returns:
+        str: User's nutrition goals or None if not found
+    """
+    targets = get_nutrition_targets(username)
+    return targets["text"] if targets else None
+
+
 def get_all_active_users() -> list:
     """
     Get list of all users who have used the bot
@@ -249,6 +914,116 @@ def get_all_active_users() -> list:
         session.close()
 
 
+def get_timezones() -> list:
+    """
+    Get the timezones users have chosen
+    Returns:
+        list: Distinct timezone names from user settings
+    """
+    session = SessionLocal()
+    try:
+        return [
+            timezone
+            for (timezone,) in session.query(UserSettings.timezone).distinct()
+            if timezone
+        ]
+    except Exception as e:
+        logging.error(f"Error getting timezones: {str(e)}")
+        return []
+    finally:
+        session.close()
+
+
+def get_timezone_users(timezone: str) -> list:
+    """
+    Get the users who have used the bot and live in a timezone
+    Args:
+        timezone: Timezone name; users without settings count as
+            DEFAULT_TIMEZONE
+    Returns:
+        list: Usernames
+    """
+    session = SessionLocal()
+    try:
+        query = (
+            session.query(DailyData.username)
+            .outerjoin(UserSettings, UserSettings.username == DailyData.username)
+            .filter(DailyData.username.isnot(None))
+        )
+        if timezone == DEFAULT_TIMEZONE:
+            query = query.filter(
+                or_(
+                    UserSettings.timezone.is_(None),
+                    UserSettings.timezone == DEFAULT_TIMEZONE,
+                )
+            )
+        else:
+            query = query.filter(UserSettings.timezone == timezone)
+        return [username for (username,) in query.distinct()]
+    except Exception as e:
+        logging.error(f"Error getting users of timezone {timezone}: {str(e)}")
+        return []
+    finally:
+        session.close()
+
+
+def get_daily_summary_data(target_date: date, timezone: str = None) -> dict:
+    """
+    Load everything the daily summary needs for all active users at once
+    Args:
+        target_date: Date to summarize
+        timezone: Only load users in this timezone (defaults to all users)
+    Returns:
+        dict: Mapping of username to a dict with keys "food_records" (list of
+            (time, gpt_response) tuples), "total_calories" and "goals" (as
+            returned by get_nutrition_targets)
+    """
+    if timezone:
+        usernames = get_timezone_users(timezone)
+    else:
+        usernames = get_all_active_users()
+    if not usernames:
+        return {}
+
+    session = SessionLocal()
+    try:
+        summaries = {
+            username: {"food_records": [], "total_calories": 0, "goals": None}
+            for username in usernames
+        }
+
+        records = (
+            session.query(DailyData.username, DailyData.time, DailyData.gpt_response)
+            .filter(DailyData.date == target_date)
+            .filter(DailyData.username.in_(usernames))
+            .order_by(DailyData.username, DailyData.time)
+            .all()
+        )
+        for username, time, gpt_response in records:
+            summaries[username]["food_records"].append((time, gpt_response))
+
+        totals = (
+            session.query(DailyTotals.username, DailyTotals.calories)
+            .filter(DailyTotals.date == target_date)
+            .filter(DailyTotals.username.in_(usernames))
+        )
+        for username, calories in totals:
+            summaries[username]["total_calories"] = calories
+
+        goals = session.query(NutritionGoals).filter(
+            NutritionGoals.username.in_(usernames)
+        )
+        for user_goals in goals:
+            summaries[user_goals.username]["goals"] = _goals_entry(user_goals)
+
+        return summaries
+    except Exception as e:
+        logging.error(f"Error getting daily summary data: {str(e)}")
+        return {}
+    finally:
+        session.close()
+
+
 def get_daily_food_records(username: str, target_date: date = None) -> list:
     """
     Get all food records for a specific date
@@ -259,12 +1034,12 @@ def get_daily_food_records(username: str, target_date: date = None) -> list:
         list: List of tuples (time, gpt_response) for the day
     """
     if target_date is None:
-        target_date = datetime.now(pytz.timezone(DEFAULT_TIMEZONE)).date()
+        target_date = get_user_today(username)
 
     session = SessionLocal()
     try:
         daily_records = (
-            session.query(DailyData)
+            session.query(DailyData.time, DailyData.gpt_response)
             .filter(DailyData.username == username)
             .filter(DailyData.date == target_date)
             .order_by(DailyData.time)
@@ -304,9 +1079,11 @@ def save_weight_goal(username: str, target_weight: float) -> bool:
             session.add(new_goal)
 
         session.commit()
+        _weight_goal_cache[username] = target_weight
         return True
     except Exception as e:
         session.rollback()
+        _weight_goal_cache.pop(username, None)
         logging.error(f"Error saving weight goal: {str(e)}")
         return False
     finally:
@@ -321,10 +1098,14 @@ def get_weight_goal(username: str) -> float:
     Returns:
         float: Target weight or None if not found
     """
+    if username in _weight_goal_cache:
+        return _weight_goal_cache[username]
+
     session = SessionLocal()
     try:
         goal = session.query(WeightGoal).filter_by(username=username).first()
-        return goal.target_weight if goal else None
+        _weight_goal_cache[username] = goal.target_weight if goal else None
+        return _weight_goal_cache[username]
     except Exception as e:
         logging.error(f"Error getting weight goal: {str(e)}")
         return None
@@ -345,7 +1126,7 @@ def save_weight_measurement(
         bool: True if successful, False if error occurred
     """
     if measured_at is None:
-        measured_at = datetime.now(pytz.timezone(DEFAULT_TIMEZONE)).date()
+        measured_at = get_user_today(username)
 
     session = SessionLocal()
     try:
@@ -392,21 +1173,29 @@ def get_weight_history(username: str, limit: int = None) -> list:
         session.close()
 
 
-def get_weekly_food_records(username: str, start_date: date) -> list:
+def get_weekly_nutrition(username: str, start_date: date) -> list:
     """
-    Get all food records for a week starting from start_date
+    Get per-day nutrition totals and eaten products for a week
     Args:
         username: Telegram username of the user
         start_date: Start date of the week
     Returns:
-        list: List of GPT responses for the week
+        list: One dict per day with records, with keys date, calories,
+            protein, fat, carbs, records_count and items (product names)
     """
     end_date = start_date + timedelta(days=7)
+    # The numbers come from the daily rollup; the meals only name products
+    totals = get_totals_by_day(username, start_date, 7)
+    days = {day: {"date": day, **values, "items": []} for day, values in totals.items()}
 
     session = SessionLocal()
     try:
-        daily_records = (
-            session.query(DailyData)
+        records = (
+            session.query(
+                DailyData.date,
+                DailyData.analysis_json,
+                DailyData.gpt_response,
+            )
             .filter(DailyData.username == username)
             .filter(DailyData.date >= start_date)
             .filter(DailyData.date < end_date)
@@ -414,9 +1203,715 @@ def get_weekly_food_records(username: str, start_date: date) -> list:
             .all()
         )
 
-        return [record.gpt_response for record in daily_records]
+        for record in records:
+            day = days.get(record.date)
+            if day is None:
+                continue
+            if record.analysis_json:
+                analysis = json.loads(record.analysis_json)
+                day["items"].extend(item["name"] for item in analysis["items"])
+            else:
+                # Legacy free-form response: keep its first line
+                day["items"].append(meal_summary_line(record.gpt_response))
+
+        return list(days.values())
     except Exception as e:
-        logging.error(f"Error getting weekly food records: {str(e)}")
+        logging.error(f"Error getting weekly nutrition: {str(e)}")
         return []
     finally:
         session.close()
+
+
+def _to_utc(moment: datetime) -> datetime:
+    """Convert an aware datetime to the naive UTC form stored in the database"""
+    return moment.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def claim_scheduled_job(name: str, fire_time: datetime, lease: timedelta) -> bool:
+    """
+    Take the run of a scheduled job for the given fire time
+    Args:
+        name: Job name
+        fire_time: Aware datetime of the run to claim
+        lease: How long the claim blocks other claimers if never completed
+    Returns:
+        bool: True if the caller should run the job now, False if the run was
+            already completed or is held by someone else
+    """
+    fire_time = _to_utc(fire_time)
+    now = _to_utc(datetime.now(pytz.utc))
+
+    session = SessionLocal()
+    try:
+        if session.get(ScheduledJob, name) is None:
+            # First start: runs from before the job existed aren't caught up
+            session.add(ScheduledJob(name=name, last_run_at=fire_time))
+            session.commit()
+            return False
+
+        claimed = (
+            session.query(ScheduledJob)
+            .filter(ScheduledJob.name == name)
+            .filter(
+                or_(
+                    ScheduledJob.last_run_at.is_(None),
+                    ScheduledJob.last_run_at < fire_time,
+                )
+            )
+            .filter(
+                or_(
+                    ScheduledJob.locked_until.is_(None),
+                    ScheduledJob.locked_until < now,
+                )
+            )
+            .update({"locked_until": now + lease}, synchronize_session=False)
+        )
+        session.commit()
+        return claimed == 1
+    except IntegrityError:
+        # Another instance created the row first
+        session.rollback()
+        return False
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error claiming scheduled job {name}: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def renew_scheduled_job(name: str, lease: timedelta) -> bool:
+    """
+    Extend the lease of a run in progress
+    Args:
+        name: Job name
+        lease: How long from now the claim keeps blocking other claimers
+    Returns:
+        bool: True if the lease was extended, False if the run isn't held
+    """
+    now = _to_utc(datetime.now(pytz.utc))
+
+    session = SessionLocal()
+    try:
+        renewed = (
+            session.query(ScheduledJob)
+            .filter(ScheduledJob.name == name)
+            .filter(ScheduledJob.locked_until.isnot(None))
+            .update({"locked_until": now + lease}, synchronize_session=False)
+        )
+        session.commit()
+        return renewed == 1
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error renewing scheduled job {name}: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def finish_scheduled_job(name: str, fire_time: datetime = None) -> bool:
+    """
+    Release a claimed run, marking it completed if fire_time is given
+    Args:
+        name: Job name
+        fire_time: Aware datetime of the completed run, or None if it failed
+            and should be retried
+    Returns:
+        bool: True if successful, False if error occurred
+    """
+    values = {"locked_until": None}
+    if fire_time is not None:
+        values["last_run_at"] = _to_utc(fire_time)
+
+    session = SessionLocal()
+    try:
+        session.query(ScheduledJob).filter(ScheduledJob.name == name).update(
+            values, synchronize_session=False
+        )
+        if fire_time is not None:
+            # A completed run is never retried, its delivery marks can go
+            session.query(JobDelivery).filter(JobDelivery.job == name).filter(
+                JobDelivery.fire_time <= values["last_run_at"]
+            ).delete(synchronize_session=False)
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error finishing scheduled job {name}: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def get_job_deliveries(name: str, fire_time: datetime) -> set:
+    """
+    Get the users a run of a scheduled job has already reached
+    Args:
+        name: Job name
+        fire_time: Aware datetime of the run
+    Returns:
+        set: Usernames
+    """
+    session = SessionLocal()
+    try:
+        return {
+            username
+            for (username,) in session.query(JobDelivery.username)
+            .filter(JobDelivery.job == name)
+            .filter(JobDelivery.fire_time == _to_utc(fire_time))
+        }
+    except Exception as e:
+        logging.error(f"Error getting deliveries of job {name}: {str(e)}")
+        return set()
+    finally:
+        session.close()
+
+
+def save_job_deliveries(name: str, fire_time: datetime, usernames: list) -> bool:
+    """
+    Remember that a run of a scheduled job has reached users, so a retry
+    of the run skips them
+    Args:
+        name: Job name
+        fire_time: Aware datetime of the run
+        usernames: Users the run's message was sent to
+    Returns:
+        bool: True if successful, False if error occurred
+    """
+    fire_time = _to_utc(fire_time)
+
+    session = SessionLocal()
+    try:
+        for username in usernames:
+            session.merge(JobDelivery(job=name, fire_time=fire_time, username=username))
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error saving deliveries of job {name}: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def save_summary_batch(
+    batch_id: str, timezone: str, summary_date: date, usernames: list
+) -> bool:
+    """
+    Remember a submitted batch of daily summary analyses
+    Args:
+        batch_id: OpenAI batch id
+        timezone: Timezone bucket of the summaries
+        summary_date: Day the summaries are for
+        usernames: Users whose analysis is in the batch
+    Returns:
+        bool: True if successful, False if error occurred
+    """
+    session = SessionLocal()
+    try:
+        session.add(
+            SummaryBatch(
+                batch_id=batch_id,
+                timezone=timezone,
+                summary_date=summary_date,
+                usernames=json.dumps(usernames),
+                created_at=_to_utc(datetime.now(pytz.utc)),
+            )
+        )
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error saving summary batch {batch_id}: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def get_pending_summary_batches() -> list:
+    """
+    Get batches whose summaries haven't been delivered yet
+    Returns:
+        list: Dicts with batch_id, timezone, summary_date and usernames
+    """
+    session = SessionLocal()
+    try:
+        batches = (
+            session.query(SummaryBatch)
+            .filter(SummaryBatch.delivered_at.is_(None))
+            .order_by(SummaryBatch.created_at)
+            .all()
+        )
+        return [
+            {
+                "batch_id": batch.batch_id,
+                "timezone": batch.timezone,
+                "summary_date": batch.summary_date,
+                "usernames": json.loads(batch.usernames),
+            }
+            for batch in batches
+        ]
+    except Exception as e:
+        logging.error(f"Error getting pending summary batches: {str(e)}")
+        return []
+    finally:
+        session.close()
+
+
+def claim_summary_batch(batch_id: str, lease: timedelta) -> bool:
+    """
+    Take a pending batch for checking and delivery
+    Args:
+        batch_id: OpenAI batch id
+        lease: How long the claim blocks other claimers if never released
+    Returns:
+        bool: True if the caller holds the batch now
+    """
+    now = _to_utc(datetime.now(pytz.utc))
+
+    session = SessionLocal()
+    try:
+        claimed = (
+            session.query(SummaryBatch)
+            .filter(SummaryBatch.batch_id == batch_id)
+            .filter(SummaryBatch.delivered_at.is_(None))
+            .filter(
+                or_(
+                    SummaryBatch.locked_until.is_(None),
+                    SummaryBatch.locked_until < now,
+                )
+            )
+            .update({"locked_until": now + lease}, synchronize_session=False)
+        )
+        session.commit()
+        return claimed == 1
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error claiming summary batch {batch_id}: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def finish_summary_batch(batch_id: str, delivered: bool) -> bool:
+    """
+    Release a claimed batch, marking it delivered if it was
+    Args:
+        batch_id: OpenAI batch id
+        delivered: Whether its summaries were sent
+    Returns:
+        bool: True if successful, False if error occurred
+    """
+    values = {"locked_until": None}
+    if delivered:
+        values["delivered_at"] = _to_utc(datetime.now(pytz.utc))
+
+    session = SessionLocal()
+    try:
+        session.query(SummaryBatch).filter(SummaryBatch.batch_id == batch_id).update(
+            values, synchronize_session=False
+        )
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error finishing summary batch {batch_id}: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def save_usage(
+    username: str,
+    call_type: str,
+    model: str,
+    prompt_tokens: int,
+    completion_tokens: int,
+    images: int,
+    audio_seconds: float,
+    latency: float,
+    cost: float,
+) -> bool:
+    """
+    Record one OpenAI call
+    Args:
+        username: User the call was made for, or None
+        call_type: Model route of the call
+        model: Model that answered
+        prompt_tokens: Input tokens, images included
+        completion_tokens: Output tokens
+        images: Number of images sent
+        audio_seconds: Length of transcribed audio
+        latency: Call duration in seconds, None if unknown
+        cost: Estimated cost in USD
+    Returns:
+        bool: True if successful, False if error occurred
+    """
+    now = datetime.now(pytz.utc)
+    day = get_user_today(username) if username else now.date()
+
+    session = SessionLocal()
+    try:
+        session.add(
+            OpenAIUsage(
+                username=username,
+                date=day,
+                created_at=_to_utc(now),
+                call_type=call_type,
+                model=model,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                images=images,
+                audio_seconds=audio_seconds,
+                latency=latency,
+                cost=cost,
+            )
+        )
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error saving OpenAI usage: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def get_tokens_used(username: str) -> int:
+    """
+    Get the tokens used for a user today in their timezone
+    Args:
+        username: Telegram username of the user
+    Returns:
+        int: Prompt plus completion tokens
+    """
+    session = SessionLocal()
+    try:
+        used = (
+            session.query(
+                func.sum(OpenAIUsage.prompt_tokens + OpenAIUsage.completion_tokens)
+            )
+            .filter(OpenAIUsage.username == username)
+            .filter(OpenAIUsage.date == get_user_today(username))
+            .scalar()
+        )
+        return int(used or 0)
+    except Exception as e:
+        logging.error(f"Error getting tokens used: {str(e)}")
+        return 0
+    finally:
+        session.close()
+
+
+def get_usage_summary(since: date, username: str = None) -> list:
+    """
+    Get OpenAI usage per user and call type
+    Args:
+        since: First day to include
+        username: Only this user's usage if given
+    Returns:
+        list: Dicts with username, call_type, calls, prompt_tokens,
+            completion_tokens, images, audio_seconds, latency (average
+            seconds) and cost, ordered by username and call type
+    """
+    session = SessionLocal()
+    try:
+        query = (
+            session.query(
+                OpenAIUsage.username,
+                OpenAIUsage.call_type,
+                func.count(OpenAIUsage.id).label("calls"),
+                func.sum(OpenAIUsage.prompt_tokens).label("prompt_tokens"),
+                func.sum(OpenAIUsage.completion_tokens).label("completion_tokens"),
+                func.sum(OpenAIUsage.images).label("images"),
+                func.sum(OpenAIUsage.audio_seconds).label("audio_seconds"),
+                func.avg(OpenAIUsage.latency).label("latency"),
+                func.sum(OpenAIUsage.cost).label("cost"),
+            )
+            .filter(OpenAIUsage.date >= since)
+            .group_by(OpenAIUsage.username, OpenAIUsage.call_type)
+            .order_by(OpenAIUsage.username, OpenAIUsage.call_type)
+        )
+        if username:
+            query = query.filter(OpenAIUsage.username == username)
+        return [row._asdict() for row in query.all()]
+    except Exception as e:
+        logging.error(f"Error getting usage summary: {str(e)}")
+        return []
+    finally:
+        session.close()
+
+
+def save_weight_reminder(username: str, remind_at: datetime) -> bool:
+    """
+    Save or replace the user's pending weight reminder
+    Args:
+        username: Telegram username of the user
+        remind_at: Aware datetime when the reminder is due
+    Returns:
+        bool: True if successful, False if error occurred
+    """
+    session = SessionLocal()
+    try:
+        session.merge(WeightReminder(username=username, remind_at=_to_utc(remind_at)))
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error saving weight reminder: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def pop_due_weight_reminders() -> list:
+    """
+    Remove and return all weight reminders that are due
+    Returns:
+        list: Usernames to remind
+    """
+    now = _to_utc(datetime.now(pytz.utc))
+
+    session = SessionLocal()
+    try:
+        reminders = (
+            session.query(WeightReminder)
+            .filter(WeightReminder.remind_at <= now)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        usernames = [reminder.username for reminder in reminders]
+        for reminder in reminders:
+            session.delete(reminder)
+        session.commit()
+        return usernames
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error getting due weight reminders: {str(e)}")
+        return []
+    finally:
+        session.close()
+
+
+def get_cached_analysis(key: str, max_age: timedelta) -> str:
+    """
+    Get a cached analysis if it is fresh enough
+    Args:
+        key: Cache key
+        max_age: Entries older than this are ignored
+    Returns:
+        str: Cached response or None if missing or expired
+    """
+    session = SessionLocal()
+    try:
+        cached = session.get(CachedAnalysis, key)
+        if cached and cached.created_at >= _to_utc(datetime.now(pytz.utc)) - max_age:
+            return cached.response
+        return None
+    except Exception as e:
+        logging.error(f"Error getting cached analysis: {str(e)}")
+        return None
+    finally:
+        session.close()
+
+
+def save_cached_analysis(key: str, response: str) -> bool:
+    """
+    Save or refresh a cached analysis
+    Args:
+        key: Cache key
+        response: Analysis to cache
+    Returns:
+        bool: True if successful, False if error occurred
+    """
+    session = SessionLocal()
+    try:
+        session.merge(
+            CachedAnalysis(
+                key=key, response=response, created_at=_to_utc(datetime.now(pytz.utc))
+            )
+        )
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error saving cached analysis: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def delete_expired_analyses(max_age: timedelta) -> int:
+    """
+    Remove cached analyses older than max_age
+    Returns:
+        int: Number of removed entries
+    """
+    session = SessionLocal()
+    try:
+        deleted = (
+            session.query(CachedAnalysis)
+            .filter(
+                CachedAnalysis.created_at < _to_utc(datetime.now(pytz.utc)) - max_age
+            )
+            .delete(synchronize_session=False)
+        )
+        session.commit()
+        return deleted
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error deleting expired analyses: {str(e)}")
+        return 0
+    finally:
+        session.close()
+
+
+def load_bot_state(kind: str, max_age: timedelta = None) -> dict:
+    """
+    Get the stored state entries of a kind
+    Args:
+        kind: "user_data" or "conversation:<name>"
+        max_age: Entries not updated for this long are skipped
+    Returns:
+        dict: Mapping of key to the decoded data
+    """
+    session = SessionLocal()
+    try:
+        query = session.query(BotState).filter(BotState.kind == kind)
+        if max_age is not None:
+            query = query.filter(
+                BotState.updated_at >= _to_utc(datetime.now(pytz.utc)) - max_age
+            )
+        return {state.key: json.loads(state.data) for state in query}
+    except Exception as e:
+        logging.error(f"Error loading bot state: {str(e)}")
+        return {}
+    finally:
+        session.close()
+
+
+def save_bot_state(kind: str, key: str, data) -> bool:
+    """
+    Save or replace a state entry
+    Args:
+        kind: "user_data" or "conversation:<name>"
+        key: User id or JSON conversation key
+        data: JSON-serializable state
+    Returns:
+        bool: True if successful, False if error occurred
+    """
+    session = SessionLocal()
+    try:
+        session.merge(
+            BotState(
+                kind=kind,
+                key=key,
+                data=json.dumps(data, ensure_ascii=False),
+                updated_at=_to_utc(datetime.now(pytz.utc)),
+            )
+        )
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error saving bot state: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def delete_bot_state(kind: str, key: str) -> bool:
+    """
+    Remove a state entry
+    Returns:
+        bool: True if successful, False if error occurred
+    """
+    session = SessionLocal()
+    try:
+        session.query(BotState).filter(
+            BotState.kind == kind, BotState.key == key
+        ).delete(synchronize_session=False)
+        session.commit()
+        return True
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error deleting bot state: {str(e)}")
+        return False
+    finally:
+        session.close()
+
+
+def delete_expired_bot_state(max_age: timedelta) -> int:
+    """
+    Remove state entries not updated for max_age
+    Returns:
+        int: Number of removed entries
+    """
+    session = SessionLocal()
+    try:
+        deleted = (
+            session.query(BotState)
+            .filter(BotState.updated_at < _to_utc(datetime.now(pytz.utc)) - max_age)
+            .delete(synchronize_session=False)
+        )
+        session.commit()
+        return deleted
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error deleting expired bot state: {str(e)}")
+        return 0
+    finally:
+        session.close()
+
+
+def find_similar_meal(
+    username: str, photo_hashes: list, max_distance: int, lookback: timedelta
+) -> Optional[dict]:
+    """
+    Find a recent confirmed meal whose photos match all of the given photos
+    Args:
+        username: Telegram username of the user
+        photo_hashes: Perceptual hashes of the new photos
+        max_distance: Maximum number of differing bits for a match
+        lookback: How far back to search
+    Returns:
+        dict: Structured analysis (MealAnalysis as a dict) of the most recent
+            matching meal or None
+    """
+    if not photo_hashes or None in photo_hashes:
+        return None
+
+    since = _to_utc(datetime.now(pytz.utc)) - lookback
+
+    session = SessionLocal()
+    try:
+        rows = (
+            session.query(MealPhotoHash.daily_data_id, MealPhotoHash.phash)
+            .filter(MealPhotoHash.username == username)
+            .filter(MealPhotoHash.created_at >= since)
+            .order_by(MealPhotoHash.created_at.desc())
+            .all()
+        )
+
+        meals = {}
+        for daily_data_id, phash in rows:
+            meals.setdefault(daily_data_id, []).append(phash & ((1 << 64) - 1))
+
+        # Dicts keep insertion order, so the newest meal is checked first
+        for daily_data_id, meal_hashes in meals.items():
+            if all(
+                any(
+                    bin(new_hash ^ meal_hash).count("1") <= max_distance
+                    for meal_hash in meal_hashes
+                )
+                for new_hash in photo_hashes
+            ):
+                meal = session.get(DailyData, daily_data_id)
+                if meal and meal.analysis_json:
+                    return json.loads(meal.analysis_json)
+        return None
+    except Exception as e:
+        logging.error(f"Error finding similar meal: {str(e)}")
+        return None
+    finally:
+        session.close()
@@ -0,0 +1,110 @@
+"""Bounded-concurrency fan-out for jobs that message many users at once."""
+
+import asyncio
+import logging
+import random
+import time
+
+
+class RateLimiter:
+    """
+    Spaces out acquisitions so that at most `rate` happen per second; share
+    one instance between everything that draws on the same budget
+    """
+
+    def __init__(self, rate: float):
+        self._interval = 1 / rate
+        self._next_slot = 0.0
+
+    async def acquire(self):
+        """Wait for the next free slot"""
+        # Slots are taken without awaiting in between, so no lock is needed
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+async def _with_retries(func, max_retries: int, retry_delay: float):
+    """
+    Await func() retrying failures with jittered exponential backoff
+    Args:
+        func: Coroutine function without arguments
+        max_retries: Number of retries after the first attempt
+        retry_delay: Base delay in seconds, doubled on every retry
+    Returns:
+        Result of func()
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return await func()
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            # Telegram's RetryAfter tells exactly how long to back off
+            delay = getattr(e, "retry_after", None)
+            if delay is None:
+                delay = retry_delay * 2**attempt * random.uniform(0.5, 1.5)
+            logging.warning(
+                f"Attempt {attempt + 1} failed: {str(e)}; retrying in {delay:.1f}s"
+            )
+            await asyncio.sleep(float(delay))
+
+
+async def fan_out(
+    usernames: list,
+    prepare,
+    deliver,
+    concurrency: int,
+    limiter: RateLimiter,
+    max_retries: int = 3,
+    retry_delay: float = 1.0,
+) -> dict:
+    """
+    Prepare and deliver a message for every user in parallel
+    Args:
+        usernames: Users to process
+        prepare: Coroutine function (username) -> message or None to skip;
+            at most `concurrency` of these run at once
+        deliver: Coroutine function (username, message) sending the message;
+            each start takes a slot of `limiter`
+        concurrency: Maximum number of concurrent prepare calls
+        limiter: Rate limit of deliveries, shared with concurrent fan-outs
+        max_retries: Retries for each stage before the user is marked failed
+        retry_delay: Base backoff delay in seconds
+    Returns:
+        dict: Mapping of username to status ("sent", "skipped" or "failed: ...")
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+
+    async def process(username):
+        try:
+            async with semaphore:
+                message = await _with_retries(
+                    lambda: prepare(username), max_retries, retry_delay
+                )
+            if message is None:
+                return "skipped"
+
+            async def send():
+                await limiter.acquire()
+                await deliver(username, message)
+
+            await _with_retries(send, max_retries, retry_delay)
+            return "sent"
+        except Exception as e:
+            logging.error(f"Error processing user {username}: {str(e)}")
+            return f"failed: {str(e)}"
+
+    results = await asyncio.gather(*(process(username) for username in usernames))
+    statuses = dict(zip(usernames, results))
+
+    sent = sum(1 for status in results if status == "sent")
+    failed = sum(1 for status in results if status.startswith("failed"))
+    logging.info(
+        f"Fan-out finished in {time.monotonic() - started:.1f}s: "
+        f"{sent} sent, {failed} failed, {len(results) - sent - failed} skipped"
+    )
+    return statuses
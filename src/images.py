@@ -0,0 +1,79 @@
+"""Photo preprocessing before sending to the vision model."""
+
+import io
+import logging
+
+from PIL import Image, ImageOps
+
+from config import IMAGE_MAX_EDGE, IMAGE_JPEG_QUALITY, IMAGE_DETAIL
+
+
+def prepare_image(data: bytes) -> bytes:
+    """
+    Downscale and recompress a photo for the vision model
+    Args:
+        data: Raw image bytes as downloaded from Telegram
+    Returns:
+        bytes: JPEG no larger than IMAGE_MAX_EDGE on its longest side, without
+            EXIF metadata (or the original bytes if the image can't be decoded)
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # Apply the EXIF orientation before the metadata is dropped
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+
+            output = io.BytesIO()
+            # Saving without exif= strips all metadata
+            image.save(output, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+            return output.getvalue()
+    except Exception as e:
+        logging.error(f"Error preparing image, sending original: {str(e)}")
+        return data
+
+
+def dhash(data: bytes) -> int:
+    """
+    Compute the 64-bit difference hash of a photo
+    Args:
+        data: Image bytes
+    Returns:
+        int: Perceptual hash; near-duplicate photos differ in few bits
+            (or None if the image can't be decoded)
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            pixels = list(
+                ImageOps.exif_transpose(image)
+                .convert("L")
+                .resize((9, 8), Image.LANCZOS)
+                .getdata()
+            )
+    except Exception as e:
+        logging.error(f"Error hashing image: {str(e)}")
+        return None
+
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(first: int, second: int) -> int:
+    """Count the bits that differ between two perceptual hashes"""
+    return bin(first ^ second).count("1")
+
+
+def image_detail() -> str:
+    """
+    Get the detail level to request from the vision model
+    Returns:
+        str: IMAGE_DETAIL if set explicitly, otherwise "low" when images are
+            small enough for a single low-detail tile and "high" for the rest
+    """
+    if IMAGE_DETAIL != "auto":
+        return IMAGE_DETAIL
+    return "low" if IMAGE_MAX_EDGE <= 512 else "high"
@@ -1,4 +1,5 @@
 import logging
+import openai
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -13,46 +14,110 @@ from telegram.ext import (
     ContextTypes,
     filters,
     CallbackQueryHandler,
+    CallbackContext,
     ConversationHandler,
+    TypeHandler,
+)
+from config import (
+    TELEGRAM_TOKEN,
+    LOG_LEVEL,
+    SUMMARY_CONCURRENCY,
+    TELEGRAM_SEND_RATE,
+    SUMMARY_MAX_RETRIES,
+    SUMMARY_MODE,
+    JOB_LEASE_MINUTES,
+    SCHEDULER_INTERVAL,
+    MEDIA_SPILL_BYTES,
+    PHOTO_DEDUP_MODE,
+    PHASH_MAX_DISTANCE,
+    PHASH_LOOKBACK_DAYS,
+    WEEKLY_PROMPT_TOKEN_BUDGET,
+    STREAM_EDIT_INTERVAL,
+    MEDIA_GROUP_DEBOUNCE,
+    MEDIA_GROUP_MAX_PHOTOS,
+    PHOTO_CACHE_SIZE,
+    DRAFT_TTL_MINUTES,
+    UPDATE_CONCURRENCY,
+    UPDATE_MAX_IN_FLIGHT,
+    WEBHOOK_URL,
+    USER_DAILY_TOKEN_BUDGET,
 )
-from config import TELEGRAM_TOKEN, LOG_LEVEL
 from constants import (
     AWAITING_FEEDBACK,
     AWAITING_CONTEXT,
     AWAITING_GOALS,
     AWAITING_WEIGHT,
     AWAITING_TARGET_WEIGHT,
+    AWAITING_TIMEZONE,
     TELEGRAM_FORMATTING,
     DEFAULT_TIMEZONE,
+    TOKEN_BUDGET_MESSAGE,
+    DRAFT_EXPIRED_MESSAGE,
+    MAX_USAGE_DAYS,
+)
+from auth import check_user_access, is_admin
+from dispatch import RateLimiter, fan_out
+from streaming import stream_reply
+from media_groups import MediaGroupClosed, MediaGroupCollector
+from persistence import DatabasePersistence, build_persistence
+from update_processor import UpdateQueue, UserOrderedUpdateProcessor
+from usage import TokenBudgetExceeded
+from openai_client import CircuitOpenError
+from openai_batch import (
+    BATCH_FAILED_STATUSES,
+    get_batch,
+    get_batch_results,
+    submit_batch,
 )
-from auth import check_user_access
-from PIL import Image
-import io
+from scheduler import last_fire_time, run_scheduled_job, undelivered, mark_delivered
+from analysis_cache import purge_expired
+from images import dhash, hamming_distance
+from nutrition import MealAnalysis, MealAnalysisError, compact_week
 import tempfile
-import os
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
 import asyncio
+import functools
+from collections import OrderedDict
 import pytz
-from database import (
+from async_database import (
+    delete_expired_bot_state,
+    get_user_timezone,
+    save_user_timezone,
+    get_user_today,
+    get_timezones,
+    get_timezone_users,
     save_gpt_response,
     save_nutrition_goals,
     get_nutrition_goals,
+    get_nutrition_targets,
     get_daily_calories,
-    get_all_active_users,
+    get_daily_totals,
     get_daily_food_records,
+    get_daily_summary_data,
     save_weight_goal,
     get_weight_goal,
     save_weight_measurement,
     get_weight_history,
-    get_weekly_food_records,
+    get_weekly_nutrition,
+    save_weight_reminder,
+    pop_due_weight_reminders,
+    find_similar_meal,
+    save_summary_batch,
+    get_pending_summary_batches,
+    claim_summary_batch,
+    finish_summary_batch,
+    get_tokens_used,
+    get_usage_summary,
 )
-import re
 import platform
 from openai_utils import (
     analyze_image_with_gpt,
+    correct_meal_analysis,
     transcribe_audio,
     analyze_nutrition_vs_goals,
-    analyze_weight_progress,
+    nutrition_batch_request,
+    stream_nutrition_vs_goals,
+    stream_weight_progress,
     encode_image,
 )
 
@@ -85,6 +150,234 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+async def download_telegram_file(telegram_file):
+    """
+    Download a Telegram file into a memory buffer that spills to disk only
+    when the file is larger than MEDIA_SPILL_BYTES
+    Returns:
+        SpooledTemporaryFile: Buffer positioned at the start; close it when done
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPILL_BYTES)
+    try:
+        await telegram_file.download_to_memory(buffer)
+    except Exception:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+
+def _encode_photo(data: bytes) -> tuple:
+    """Preprocess a photo for the model and compute its perceptual hash"""
+    return encode_image(data), dhash(data)
+
+
+# Encoded photos by Telegram file id, most recently used last
+_photo_cache = OrderedDict()
+
+
+async def _download_photo(bot, file_id: str) -> tuple:
+    """Download, preprocess and hash a photo and put it into the photo cache"""
+    photo = await bot.get_file(file_id)
+    with await download_telegram_file(photo) as photo_file:
+        data = photo_file.read()
+    photo_base64, phash = await asyncio.to_thread(_encode_photo, data)
+
+    _photo_cache[file_id] = photo_base64
+    _photo_cache.move_to_end(file_id)
+    while len(_photo_cache) > PHOTO_CACHE_SIZE:
+        _photo_cache.popitem(last=False)
+    return photo_base64, phash
+
+
+async def prepare_photo(bot, file_id: str) -> tuple:
+    """
+    Download, preprocess and hash a photo
+    Returns:
+        tuple: (file id, perceptual hash or None), what a draft keeps
+    """
+    _, phash = await _download_photo(bot, file_id)
+    return file_id, phash
+
+
+async def load_photos(bot, file_ids: list) -> list:
+    """
+    Get the encoded images of draft photos, downloading again those that
+    are no longer cached (e.g. after a restart)
+    Returns:
+        list: Base64 JPEGs for the model, in draft order
+    """
+
+    async def load(file_id):
+        if file_id in _photo_cache:
+            _photo_cache.move_to_end(file_id)
+            return _photo_cache[file_id]
+        photo_base64, _ = await _download_photo(bot, file_id)
+        return photo_base64
+
+    return list(await asyncio.gather(*[load(file_id) for file_id in file_ids]))
+
+
+def _add_prepared_photo(user_data: dict, file_id: str, phash) -> bool:
+    """
+    Add a prepared photo to the user's draft
+    Returns:
+        bool: False if the photo was dropped as a near-duplicate of a photo
+            already in the draft
+    """
+    if PHOTO_DEDUP_MODE != "off" and phash is not None:
+        for existing_hash in user_data["photo_hashes"]:
+            if (
+                existing_hash is not None
+                and hamming_distance(phash, existing_hash) <= PHASH_MAX_DISTANCE
+            ):
+                logging.info("Dropped near-duplicate photo from the draft")
+                return False
+
+    user_data["photo_ids"].append(file_id)
+    user_data["photo_hashes"].append(phash)
+    return True
+
+
+async def add_photo_to_draft(context: ContextTypes.DEFAULT_TYPE, photo_size) -> bool:
+    """
+    Download, preprocess and hash a photo and add it to the user's draft
+    Returns:
+        bool: False if the photo was dropped as a near-duplicate
+    """
+    file_id, phash = await prepare_photo(context.bot, photo_size.file_id)
+    return _add_prepared_photo(context.user_data, file_id, phash)
+
+
+async def analyze_meal(
+    context: ContextTypes.DEFAULT_TYPE,
+    username: str,
+    photo_ids: list,
+    photo_hashes: list,
+    additional_info: str,
+) -> MealAnalysis:
+    """Analyze a meal, reusing a recent confirmed analysis of the same photos"""
+    # Remember which photos the analysis is about to index them on confirm,
+    # and what it was given for a later re-analysis with another photo
+    context.user_data["analyzed_photo_hashes"] = list(photo_hashes)
+    context.user_data["analyzed_photo_ids"] = list(photo_ids)
+    context.user_data["analyzed_info"] = additional_info
+
+    if PHOTO_DEDUP_MODE == "reuse" and photo_ids and not additional_info:
+        previous_response = await find_similar_meal(
+            username,
+            photo_hashes,
+            PHASH_MAX_DISTANCE,
+            timedelta(days=PHASH_LOOKBACK_DAYS),
+        )
+        if previous_response:
+            logging.info(f"Reused analysis of a similar recent meal for @{username}")
+            return MealAnalysis.model_validate(previous_response)
+
+    photos_base64 = await load_photos(context.bot, photo_ids)
+    return await analyze_image_with_gpt(photos_base64, additional_info, username)
+
+
+def remember_analysis(
+    context: ContextTypes.DEFAULT_TYPE, analysis: MealAnalysis, correction: str = None
+) -> str:
+    """
+    Keep the analysis in the user's draft until it is confirmed
+    Args:
+        context: Context of the user
+        analysis: New analysis
+        correction: User's correction the analysis was made for, None for a
+            new analysis
+    Returns:
+        str: The analysis rendered as Telegram HTML
+    """
+    gpt_response = analysis.render_html()
+    context.user_data["current_gpt_response"] = gpt_response
+    # An unparsed answer is saved by the calories in its text
+    context.user_data["current_analysis"] = (
+        analysis.model_dump() if analysis.parsed else None
+    )
+
+    # Chat turns a correction is made from, see correct_meal_analysis
+    answer = {"role": "assistant", "content": analysis.model_dump_json()}
+    if correction is None:
+        context.user_data["analysis_turns"] = [answer]
+    else:
+        context.user_data["analysis_turns"].extend(
+            [{"role": "user", "content": correction}, answer]
+        )
+    return gpt_response
+
+
+async def show_draft_status(message, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Reply with what the draft holds and the buttons to continue
+    Returns:
+        int: AWAITING_FEEDBACK
+    """
+    status_message = "📋 Текущая информация:\n\n"
+    if context.user_data.get("photo_ids"):
+        status_message += f"📸 Фото: {len(context.user_data['photo_ids'])} шт.\n"
+    if context.user_data.get("additional_info"):
+        status_message += (
+            f"📝 Текст: {len(context.user_data['additional_info'])} сообщений\n"
+        )
+    if context.user_data.get("has_voice"):
+        status_message += "🎤 Голосовое сообщение: добавлено\n"
+
+    status_message += "\nХотите добавить еще информацию или начать анализ?"
+
+    # Create keyboard with buttons
+    keyboard = [
+        [
+            InlineKeyboardButton("➕ Добавить еще", callback_data="add_more"),
+            InlineKeyboardButton("✅ Начать анализ", callback_data="start_analysis"),
+        ],
+        [InlineKeyboardButton("🚫 Отменить", callback_data="cancel")],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await message.reply_text(status_message, reply_markup=reply_markup)
+    return AWAITING_FEEDBACK
+
+
+def feedback_markup() -> InlineKeyboardMarkup:
+    """Buttons asking the user whether an analysis result is right"""
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ Верно", callback_data="correct"),
+            InlineKeyboardButton("❌ Добавить контекст", callback_data="add_context"),
+        ],
+        [InlineKeyboardButton("🚫 Отменить", callback_data="cancel")],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def collect_album_photo(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, reanalyze: bool = False
+):
+    """
+    Start downloading a photo of an album and add it to the album's batch
+    Args:
+        reanalyze: Whether the album adds to the last analysis instead of
+            the draft; only the album's first photo decides this
+    """
+    if update.message.photo:
+        media_groups.add(
+            (update.effective_user.id, update.message.media_group_id),
+            update.message.message_id,
+            prepare_photo(context.bot, update.message.photo[-1].file_id),
+            update.message.caption,
+            data={
+                "application": context.application,
+                "user_id": update.effective_user.id,
+                "chat_id": update.effective_chat.id,
+                "username": update.effective_user.username,
+                "reanalyze": reanalyze,
+            },
+        )
+
+
 async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for receiving messages with photos, text or voice"""
     user_id = update.effective_user.id
@@ -97,40 +390,16 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info(f"Received message from user {user_id} (@{username})")
 
     # Initialize user data if not exists
-    if "photos_base64" not in context.user_data:
-        context.user_data["photos_base64"] = []
+    if "photo_ids" not in context.user_data:
+        context.user_data["photo_ids"] = []
+        context.user_data["photo_hashes"] = []
         context.user_data["additional_info"] = []
         context.user_data["has_voice"] = False
 
-    # Check if we have photos in media group
-    media_group_id = update.message.media_group_id
-
-    # If this is part of a media group and we haven't processed it yet
-    if media_group_id:
-        if context.user_data.get("current_media_group") != media_group_id:
-            context.user_data["current_media_group"] = media_group_id
-            context.user_data["photos_base64"] = []
-            context.user_data["additional_info"] = []
-            context.user_data["has_voice"] = False
-
-        # If we have a photo, add it to the list
-        if update.message.photo:
-            try:
-                photo = await update.message.photo[-1].get_file()
-                with tempfile.NamedTemporaryFile(
-                    delete=False, suffix=".jpg"
-                ) as temp_file:
-                    await photo.download_to_drive(temp_file.name)
-                    photo_base64 = encode_image(temp_file.name)
-                    context.user_data["photos_base64"].append(photo_base64)
-                    os.unlink(temp_file.name)
-
-                # If we have collected 5 photos or this is the last photo, process them
-                if len(context.user_data["photos_base64"]) >= 5:
-                    return await process_photos_group(update, context)
-
-            except Exception as e:
-                logging.error(f"Error processing photo in media group: {str(e)}")
+    # Photos of an album arrive as separate messages: download each one right
+    # away and analyze the album once, after its last photo
+    if update.message.media_group_id:
+        collect_album_photo(update, context)
         return
 
     # Process single message
@@ -140,23 +409,23 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("🎤 Распознаю голосовое сообщение...")
             voice = await update.message.voice.get_file()
 
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as temp_file:
-                await voice.download_to_drive(temp_file.name)
-                transcribed_text = await transcribe_audio(temp_file.name)
-                os.unlink(temp_file.name)
-
-                if transcribed_text:
-                    await update.message.reply_text(
-                        f"📝 Распознанный текст:\n{transcribed_text}", parse_mode="HTML"
-                    )
-                    context.user_data["additional_info"].append(transcribed_text)
-                    context.user_data["has_voice"] = True
-                else:
-                    await update.message.reply_text(
-                        "Извините, не удалось распознать голосовое сообщение.\n"
-                        "Пожалуйста, попробуйте еще раз или отправьте текстовое сообщение."
-                    )
-                    return ConversationHandler.END
+            with await download_telegram_file(voice) as voice_file:
+                transcribed_text = await transcribe_audio(
+                    voice_file, username, update.message.voice.duration
+                )
+
+            if transcribed_text:
+                await update.message.reply_text(
+                    f"📝 Распознанный текст:\n{transcribed_text}", parse_mode="HTML"
+                )
+                context.user_data["additional_info"].append(transcribed_text)
+                context.user_data["has_voice"] = True
+            else:
+                await update.message.reply_text(
+                    "Извините, не удалось распознать голосовое сообщение.\n"
+                    "Пожалуйста, попробуйте еще раз или отправьте текстовое сообщение."
+                )
+                return ConversationHandler.END
         # Process text message
         elif update.message.text or update.message.caption:
             text = update.message.text or update.message.caption
@@ -165,44 +434,19 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Process photo
         elif update.message.photo:
             await update.message.reply_text("📸 Обрабатываю фото...")
-            photo = await update.message.photo[-1].get_file()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
-                await photo.download_to_drive(temp_file.name)
-                photo_base64 = encode_image(temp_file.name)
-                context.user_data["photos_base64"].append(photo_base64)
-                os.unlink(temp_file.name)
-            await update.message.reply_text("✅ Фото добавлено")
-
-        # Show current status and confirmation button
-        status_message = "📋 Текущая информация:\n\n"
-        if context.user_data["photos_base64"]:
-            status_message += (
-                f"📸 Фото: {len(context.user_data['photos_base64'])} шт.\n"
-            )
-        if context.user_data["additional_info"]:
-            status_message += (
-                f"📝 Текст: {len(context.user_data['additional_info'])} сообщений\n"
-            )
-        if context.user_data["has_voice"]:
-            status_message += "🎤 Голосовое сообщение: добавлено\n"
-
-        status_message += "\nХотите добавить еще информацию или начать анализ?"
-
-        # Create keyboard with buttons
-        keyboard = [
-            [
-                InlineKeyboardButton("➕ Добавить еще", callback_data="add_more"),
-                InlineKeyboardButton(
-                    "✅ Начать анализ", callback_data="start_analysis"
-                ),
-            ],
-            [InlineKeyboardButton("🚫 Отменить", callback_data="cancel")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+            if await add_photo_to_draft(context, update.message.photo[-1]):
+                await update.message.reply_text("✅ Фото добавлено")
+            else:
+                await update.message.reply_text(
+                    "♻️ Это фото почти не отличается от уже добавленного, пропускаю"
+                )
 
-        await update.message.reply_text(status_message, reply_markup=reply_markup)
-        return AWAITING_FEEDBACK
+        return await show_draft_status(update.message, context)
 
+    except TokenBudgetExceeded as e:
+        logging.info(str(e))
+        await update.message.reply_text(TOKEN_BUDGET_MESSAGE)
+        return ConversationHandler.END
     except Exception as e:
         logging.error(f"Error processing message: {str(e)}")
         await update.message.reply_text(
@@ -212,51 +456,129 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 
-async def process_photos_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def queue_media_group(data: dict, photos: list, captions: list):
+    """Queue a complete album behind the user's updates received so far"""
+    await data["application"].update_queue.put(
+        MediaGroupClosed(data["user_id"], data, photos, captions)
+    )
+
+
+media_groups = MediaGroupCollector(
+    MEDIA_GROUP_DEBOUNCE, MEDIA_GROUP_MAX_PHOTOS, queue_media_group
+)
+
+
+async def finish_media_group(album: MediaGroupClosed, _: ContextTypes.DEFAULT_TYPE):
+    """Add a complete album to the user's draft and analyze the draft"""
+    data = album.data
+    context = CallbackContext(
+        data["application"], chat_id=data["chat_id"], user_id=data["user_id"]
+    )
+    if data.get("reanalyze"):
+        await reanalyze_photos_group(context, data["chat_id"], data["username"], album)
+        return
+
+    # Texts or voice messages sent along with the album stay in the draft
+    user_data = context.user_data
+    user_data.setdefault("photo_ids", [])
+    user_data.setdefault("photo_hashes", [])
+    user_data.setdefault("additional_info", [])
+    user_data.setdefault("has_voice", False)
+    user_data["additional_info"].extend(album.captions)
+    for file_id, phash in album.results:
+        _add_prepared_photo(user_data, file_id, phash)
+    # Not an Update, so the application doesn't know the user data changed
+    context.application.mark_data_for_update_persistence(user_ids=data["user_id"])
+
+    await process_photos_group(context, data["chat_id"], data["username"])
+
+
+async def process_photos_group(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int, username: str
+):
     """Process collected photos from media group"""
     try:
-        photos_base64 = context.user_data.get("photos_base64", [])
-        additional_info = context.user_data.get("additional_info", "")
+        photo_ids = context.user_data.get("photo_ids", [])
+        photo_hashes = context.user_data.get("photo_hashes", [])
+        additional_info = "\n".join(context.user_data.get("additional_info", []))
 
         # Clear media group data
-        context.user_data["current_media_group"] = None
-        context.user_data["photos_base64"] = []
+        context.user_data["photo_ids"] = []
+        context.user_data["photo_hashes"] = []
         context.user_data["additional_info"] = []
 
         # Get response from GPT
-        gpt_response = await analyze_image_with_gpt(photos_base64, additional_info)
+        analysis = await analyze_meal(
+            context,
+            username,
+            photo_ids,
+            photo_hashes,
+            additional_info,
+        )
 
         # Store GPT response in context for later saving
-        context.user_data["current_gpt_response"] = gpt_response
-
-        # Create keyboard with buttons
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Верно", callback_data="correct"),
-                InlineKeyboardButton(
-                    "❌ Добавить контекст", callback_data="add_context"
-                ),
-            ],
-            [InlineKeyboardButton("🚫 Отменить", callback_data="cancel")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        gpt_response = remember_analysis(context, analysis)
 
-        # Send response with buttons
-        await update.message.reply_text(
+        reply_markup = feedback_markup()
+
+        # Send response with buttons; they are handled by button_callback as
+        # an entry point, since the album was closed outside of a handler
+        await context.bot.send_message(
+            chat_id,
             f"{gpt_response}\n\nРезультат верный?",
             reply_markup=reply_markup,
             parse_mode="HTML",
         )
 
-        return AWAITING_FEEDBACK
+    except TokenBudgetExceeded as e:
+        logging.info(str(e))
+        await context.bot.send_message(chat_id, TOKEN_BUDGET_MESSAGE)
+    except Exception as e:
+        logging.error(f"Error processing photos group: {str(e)}")
+        await context.bot.send_message(
+            chat_id,
+            "Произошла ошибка при обработке фотографий.\n"
+            "Пожалуйста, попробуйте еще раз.",
+        )
+
+
+async def reanalyze_photos_group(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    username: str,
+    album: MediaGroupClosed,
+):
+    """Analyze the meal again with an album sent as additional context"""
+    try:
+        gpt_response = await reanalyze_meal(
+            context, username, album.results, "\n".join(album.captions)
+        )
+        if gpt_response is None:
+            await context.bot.send_message(
+                chat_id,
+                "♻️ Эти фото почти не отличаются от уже добавленных, "
+                "результат прежний.\n\nРезультат верный?",
+                reply_markup=feedback_markup(),
+            )
+            return
+
+        await context.bot.send_message(
+            chat_id,
+            f"{gpt_response}\n\nРезультат верный?",
+            reply_markup=feedback_markup(),
+            parse_mode="HTML",
+        )
 
+    except TokenBudgetExceeded as e:
+        logging.info(str(e))
+        await context.bot.send_message(chat_id, TOKEN_BUDGET_MESSAGE)
     except Exception as e:
         logging.error(f"Error processing photos group: {str(e)}")
-        await update.message.reply_text(
+        await context.bot.send_message(
+            chat_id,
             "Произошла ошибка при обработке фотографий.\n"
-            "Пожалуйста, попробуйте еще раз."
+            "Пожалуйста, попробуйте еще раз.",
         )
-        return ConversationHandler.END
 
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -266,14 +588,30 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username
     await query.answer()
 
+    # Buttons of an earlier message can outlive the draft they belong to
+    if (
+        query.data in ("correct", "add_context")
+        and "current_gpt_response" not in context.user_data
+    ) or (
+        query.data == "start_analysis"
+        and not context.user_data.get("photo_ids")
+        and not context.user_data.get("additional_info")
+    ):
+        await query.edit_message_reply_markup(reply_markup=None)
+        await query.message.reply_text(DRAFT_EXPIRED_MESSAGE)
+        return ConversationHandler.END
+
     if query.data == "correct":
         # Save the confirmed response to database
-        gpt_response = context.user_data.get("current_gpt_response")
-        if gpt_response:
-            save_gpt_response(gpt_response, username)
-            logging.info(
-                f"Saved confirmed GPT response to database for user @{username}"
-            )
+        # Taken out of the draft, so the button can't save the meal twice
+        gpt_response = context.user_data.pop("current_gpt_response")
+        await save_gpt_response(
+            gpt_response,
+            username,
+            context.user_data.get("analyzed_photo_hashes"),
+            context.user_data.pop("current_analysis", None),
+        )
+        logging.info(f"Saved confirmed GPT response to database for user @{username}")
 
         await query.edit_message_reply_markup(reply_markup=None)
         await query.message.reply_text("Отлично! Рад был помочь! 😊")
@@ -284,7 +622,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_reply_markup(reply_markup=None)
         await query.message.reply_text(
             "Пожалуйста, отправьте дополнительную информацию о блюде "
-            "(например: размер порции, ингредиенты, способ приготовления)"
+            "(например: размер порции, ингредиенты, способ приготовления) "
+            "или еще одно фото"
         )
         return AWAITING_CONTEXT
 
@@ -310,40 +649,91 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("🔄 Начинаю анализ...")
 
         # Combine all additional info
-        combined_info = (
-            "\n".join(context.user_data["additional_info"])
-            if context.user_data["additional_info"]
-            else ""
-        )
+        combined_info = "\n".join(context.user_data.get("additional_info", []))
 
         # Get response from GPT
-        gpt_response = await analyze_image_with_gpt(
-            context.user_data["photos_base64"], combined_info
-        )
+        try:
+            analysis = await analyze_meal(
+                context,
+                username,
+                context.user_data.get("photo_ids", []),
+                context.user_data.get("photo_hashes", []),
+                combined_info,
+            )
+        except TokenBudgetExceeded as e:
+            logging.info(str(e))
+            await query.message.reply_text(TOKEN_BUDGET_MESSAGE)
+            return ConversationHandler.END
+        except MealAnalysisError as e:
+            logging.error(f"Error analyzing meal: {str(e)}")
+            await query.message.reply_text(
+                "Не удалось разобрать ответ модели.\n"
+                "Пожалуйста, нажмите «Начать анализ» еще раз."
+            )
+            return await show_draft_status(query.message, context)
+        except (openai.OpenAIError, CircuitOpenError, asyncio.TimeoutError) as e:
+            # The model is failing even after retries; the draft is kept
+            logging.error(f"Error analyzing meal: {type(e).__name__}: {str(e)}")
+            await query.message.reply_text(
+                "Сервис анализа сейчас недоступен.\n"
+                "Пожалуйста, нажмите «Начать анализ» еще раз чуть позже."
+            )
+            return await show_draft_status(query.message, context)
 
         # Store GPT response in context for later saving
-        context.user_data["current_gpt_response"] = gpt_response
-
-        # Create keyboard with buttons
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Верно", callback_data="correct"),
-                InlineKeyboardButton(
-                    "❌ Добавить контекст", callback_data="add_context"
-                ),
-            ],
-            [InlineKeyboardButton("🚫 Отменить", callback_data="cancel")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        gpt_response = remember_analysis(context, analysis)
+
+        reply_markup = feedback_markup()
 
         # Send response with buttons
         await query.message.reply_text(
-            f"{gpt_response}\n\nРезультат верный?", reply_markup=reply_markup
+            f"{gpt_response}\n\nРезультат верный?",
+            reply_markup=reply_markup,
+            parse_mode="HTML",
         )
 
         return AWAITING_FEEDBACK
 
 
+async def reanalyze_meal(
+    context: ContextTypes.DEFAULT_TYPE, username: str, photos: list, text: str
+):
+    """
+    Analyze the meal again with new photos and everything the user has said
+    about it
+    Args:
+        photos: Prepared (file_id, phash) photos to add to the analyzed ones;
+            near-duplicates of those are dropped
+        text: What the user sent with the photos
+    Returns:
+        str: New result message, None if all photos were near-duplicates and
+            there was no text, so there is nothing new to analyze
+    """
+    analyzed = {
+        "photo_ids": list(context.user_data.get("analyzed_photo_ids", [])),
+        "photo_hashes": list(context.user_data.get("analyzed_photo_hashes", [])),
+    }
+    added = [_add_prepared_photo(analyzed, file_id, phash) for file_id, phash in photos]
+    if not any(added) and not text:
+        return None
+
+    descriptions = [context.user_data.get("analyzed_info")]
+    descriptions += [
+        turn["content"]
+        for turn in context.user_data.get("analysis_turns") or []
+        if turn["role"] == "user"
+    ]
+    descriptions.append(text)
+    analysis = await analyze_meal(
+        context,
+        username,
+        analyzed["photo_ids"],
+        analyzed["photo_hashes"],
+        "\n".join(filter(None, descriptions)),
+    )
+    return remember_analysis(context, analysis)
+
+
 async def process_additional_context(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ):
@@ -352,39 +742,56 @@ async def process_additional_context(
     username = update.effective_user.username
     logging.info(f"Received additional context from user {user_id} (@{username})")
     try:
-        new_context = update.message.text
-        combined_context = f"{context.user_data['last_additional_info']}. Additional context: {new_context}"
-
-        # Get new response from GPT with additional context
-        gpt_response = await analyze_image_with_gpt(
-            context.user_data["photos_base64"], combined_context
-        )
-
-        # Store new GPT response in context for later saving
-        context.user_data["current_gpt_response"] = gpt_response
+        turns = context.user_data.get("analysis_turns")
+        if turns and not update.message.photo:
+            # A text correction doesn't need the photos again: the previous
+            # result and the correction go to a cheaper text-only call
+            new_context = update.message.text
+            analysis = await correct_meal_analysis(turns, new_context, username)
+            gpt_response = remember_analysis(context, analysis, correction=new_context)
+        else:
+            # A new photo needs the vision model: all photos are analyzed
+            # again with everything the user has said about them
+            if update.message.media_group_id:
+                # The rest of the album comes after this handler ended the
+                # conversation, so the whole album is analyzed once it's
+                # complete and its result buttons work as entry points
+                collect_album_photo(update, context, reanalyze=True)
+                return ConversationHandler.END
+            photos = []
+            if update.message.photo:
+                await update.message.reply_text("📸 Обрабатываю фото...")
+                photos.append(
+                    await prepare_photo(context.bot, update.message.photo[-1].file_id)
+                )
+            gpt_response = await reanalyze_meal(
+                context,
+                username,
+                photos,
+                update.message.text or update.message.caption,
+            )
+            if gpt_response is None:
+                await update.message.reply_text(
+                    "♻️ Это фото почти не отличается от уже добавленного, пропускаю.\n"
+                    "Отправьте другое фото или опишите, что нужно исправить"
+                )
+                return AWAITING_CONTEXT
 
-        # Create keyboard with buttons
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Верно", callback_data="correct"),
-                InlineKeyboardButton(
-                    "❌ Добавить контекст", callback_data="add_context"
-                ),
-            ],
-            [InlineKeyboardButton("🚫 Отменить", callback_data="cancel")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = feedback_markup()
 
         # Send new response with buttons
         await update.message.reply_text(
-            f"{gpt_response}\n\nРезультат верный?", reply_markup=reply_markup
+            f"{gpt_response}\n\nРезультат верный?",
+            reply_markup=reply_markup,
+            parse_mode="HTML",
         )
 
-        # Update saved context
-        context.user_data["last_additional_info"] = combined_context
-
         return AWAITING_FEEDBACK
 
+    except TokenBudgetExceeded as e:
+        logging.info(str(e))
+        await update.message.reply_text(TOKEN_BUDGET_MESSAGE)
+        return ConversationHandler.END
     except Exception as e:
         logging.error(f"Error processing additional context: {str(e)}")
         await update.message.reply_text(
@@ -413,7 +820,7 @@ async def goals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     # Get current goals if they exist
-    current_goals = get_nutrition_goals(username)
+    current_goals = await get_nutrition_goals(username)
 
     if current_goals:
         await update.message.reply_text(
@@ -438,7 +845,7 @@ async def set_goals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     # Get current goals if they exist
-    current_goals = get_nutrition_goals(username)
+    current_goals = await get_nutrition_goals(username)
 
     if current_goals:
         await update.message.reply_text(
@@ -464,7 +871,7 @@ async def process_goals(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username
     new_goals = update.message.text
 
-    if save_nutrition_goals(username, new_goals):
+    if await save_nutrition_goals(username, new_goals):
         await update.message.reply_text(
             "Ваши цели питания успешно сохранены!\n"
             "Вы можете просмотреть их с помощью команды /goals"
@@ -488,9 +895,11 @@ async def analyze_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     # Get today's data
-    food_records = get_daily_food_records(username)
-    total_calories = get_daily_calories(username)
-    goals = get_nutrition_goals(username)
+    food_records, total_calories, goals = await asyncio.gather(
+        get_daily_food_records(username),
+        get_daily_calories(username),
+        get_nutrition_targets(username),
+    )
 
     if not food_records:
         await update.message.reply_text(
@@ -504,26 +913,36 @@ async def analyze_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message += f"🔢 Всего употреблено: {total_calories:.0f} ккал\n"
 
     # Add calorie goal info if available
-    daily_goal = None
-    if goals:
-        matches = re.findall(r"калори[йя]:\s*(\d+)", goals.lower())
-        if matches:
-            daily_goal = float(matches[0])
-            diff = daily_goal - total_calories
-            message += f"🎯 Ваша цель: {daily_goal:.0f} ккал\n"
-            if diff > 0:
-                message += f"✅ Осталось: {diff:.0f} ккал\n"
-            else:
-                message += f"⚠️ Превышение: {abs(diff):.0f} ккал\n"
+    daily_goal = goals["calories"] if goals else None
+    if daily_goal:
+        diff = daily_goal - total_calories
+        message += f"🎯 Ваша цель: {daily_goal:.0f} ккал\n"
+        if diff > 0:
+            message += f"✅ Осталось: {diff:.0f} ккал\n"
+        else:
+            message += f"⚠️ Превышение: {abs(diff):.0f} ккал\n"
 
-    # Add detailed analysis if goals are set
-    if goals:
-        await update.message.reply_text("🔄 Анализирую ваше питание...")
-        analysis = await analyze_nutrition_vs_goals(food_records, goals)
-        if analysis:
-            message += f"\n📋 Детальный анализ:\n{analysis}"
+    if not goals:
+        await update.message.reply_text(message, parse_mode="HTML")
+        return ConversationHandler.END
 
-    await update.message.reply_text(message, parse_mode="HTML")
+    # Show the numbers right away and stream the detailed analysis below them
+    status = await update.message.reply_text(
+        f"{message}\n🔄 Анализирую ваше питание...", parse_mode="HTML"
+    )
+    try:
+        analysis = await stream_reply(
+            status,
+            stream_nutrition_vs_goals(food_records, goals["text"], username),
+            prefix=f"{message}\n📋 Детальный анализ:\n",
+            interval=STREAM_EDIT_INTERVAL,
+        )
+    except TokenBudgetExceeded as e:
+        logging.info(str(e))
+        await status.edit_text(f"{message}\n{TOKEN_BUDGET_MESSAGE}", parse_mode="HTML")
+        return ConversationHandler.END
+    if not analysis:
+        await status.edit_text(message, parse_mode="HTML")
     return ConversationHandler.END
 
 
@@ -548,11 +967,13 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/setgoals - установить цели по калориям и БЖУ\n"
         "/calories - показать калории за сегодня\n"
         "/analyze - детальный анализ питания\n"
+        "/usage - расход токенов и стоимость запросов к модели\n"
         "/weight - внести текущий вес\n"
         "/targetweight - установить целевой вес\n"
+        "/timezone - установить часовой пояс\n"
         "/help - показать это сообщение\n\n"
         "📊 Автоматические функции:\n"
-        "• Ежедневный отчет о питании в полночь\n"
+        "• Ежедневный отчет о питании в полночь по вашему времени\n"
         "• Еженедельный запрос веса по воскресеньям\n"
         "• Анализ прогресса и рекомендации\n\n"
         "📝 Для лучших результатов:\n"
@@ -575,20 +996,20 @@ async def calories_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Извините, у вас нет доступа к этому боту.")
         return ConversationHandler.END
 
-    # Get today's calories
-    total_calories = get_daily_calories(username)
+    # Get today's calories and macronutrients
+    totals = await get_daily_totals(username)
+    total_calories = totals["calories"]
 
-    # Get user's goals
-    goals = get_nutrition_goals(username)
-    daily_goal = None
-    if goals:
-        # Try to extract daily calorie goal
-        matches = re.findall(r"калори[йя]:\s*(\d+)", goals.lower())
-        if matches:
-            daily_goal = float(matches[0])
+    # Get user's daily calorie goal, parsed when the goals were saved
+    goals = await get_nutrition_targets(username)
+    daily_goal = goals["calories"] if goals else None
 
     # Prepare message
     message = f"Сегодня вы употребили: {total_calories:.0f} ккал\n"
+    message += (
+        f"Белки: {totals['protein']:.0f} г, Жиры: {totals['fat']:.0f} г, "
+        f"Углеводы: {totals['carbs']:.0f} г\n"
+    )
     if daily_goal:
         remaining = daily_goal - total_calories
         message += f"Ваша цель на день: {daily_goal:.0f} ккал\n"
@@ -601,66 +1022,226 @@ async def calories_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
-async def send_daily_summary(application: Application):
-    """Send daily calorie summary to all users"""
-    while True:
-        try:
-            # Wait until midnight
-            now = datetime.now(pytz.timezone(DEFAULT_TIMEZONE))
-            tomorrow = now.replace(
-                hour=0, minute=0, second=0, microsecond=0
-            ) + timedelta(days=1)
-            wait_seconds = (tomorrow - now).total_seconds()
-            await asyncio.sleep(wait_seconds)
-
-            # Get all active users
-            users = get_all_active_users()
-
-            for username in users:
-                try:
-                    # Get yesterday's date
-                    yesterday = (now - timedelta(days=1)).date()
-
-                    # Get all food records and total calories
-                    food_records = get_daily_food_records(username, yesterday)
-                    total_calories = get_daily_calories(username, yesterday)
-
-                    # Get user's goals
-                    goals = get_nutrition_goals(username)
-                    daily_goal = None
-                    if goals:
-                        matches = re.findall(r"калори[йя]:\s*(\d+)", goals.lower())
-                        if matches:
-                            daily_goal = float(matches[0])
-
-                    # Prepare base message
-                    message = f"📊 Итоги дня ({yesterday}):\n\n"
-                    message += f"🔢 Всего употреблено: {total_calories:.0f} ккал\n"
-                    if daily_goal:
-                        diff = total_calories - daily_goal
-                        message += f"🎯 Ваша цель: {daily_goal:.0f} ккал\n"
-                        if diff > 0:
-                            message += f"⚠️ Превышение: {diff:.0f} ккал\n"
-                        else:
-                            message += f"✅ Осталось: {abs(diff):.0f} ккал\n"
-
-                    # Add nutrition analysis if we have both goals and food records
-                    if goals and food_records:
-                        analysis = await analyze_nutrition_vs_goals(food_records, goals)
-                        if analysis:
-                            message += f"\n📋 Анализ питания:\n{analysis}"
-
-                    # Send message to user
-                    await application.bot.send_message(
-                        chat_id=username, text=message, parse_mode="HTML"
-                    )
-
-                except Exception as e:
-                    logging.error(f"Error sending summary to user {username}: {str(e)}")
+async def usage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler for /usage command: OpenAI tokens and cost, of all users for admins"""
+    user_id = update.effective_user.id
+    username = update.effective_user.username
+
+    if not check_user_access(user_id, username):
+        await update.message.reply_text("Извините, у вас нет доступа к этому боту.")
+        return ConversationHandler.END
+
+    # Optional number of days, today only by default
+    try:
+        days = min(max(int(context.args[0]), 1), MAX_USAGE_DAYS) if context.args else 1
+    except ValueError:
+        days = 1
+    since = await get_user_today(username) - timedelta(days=days - 1)
+    rows = await get_usage_summary(since, None if is_admin(username) else username)
+
+    if not rows:
+        await update.message.reply_text("Запросов к модели за этот период не было.")
+        return ConversationHandler.END
+
+    period = "сегодня" if days == 1 else f"за {days} дн."
+    message = f"📈 Использование модели {period}:\n"
+    total_tokens = 0
+    total_cost = 0.0
+    current_user = None
+    for row in rows:
+        if row["username"] != current_user:
+            current_user = row["username"]
+            message += f"\n👤 @{current_user}\n"
+        tokens = (row["prompt_tokens"] or 0) + (row["completion_tokens"] or 0)
+        cost = row["cost"] or 0
+        total_tokens += tokens
+        total_cost += cost
+
+        line = f"• {row['call_type']}: {row['calls']} запр., {tokens} токенов"
+        if row["images"]:
+            line += f", фото: {row['images']}"
+        if row["audio_seconds"]:
+            line += f", аудио: {row['audio_seconds']:.0f} с"
+        if row["latency"]:
+            line += f", в среднем {row['latency']:.1f} с"
+        message += f"{line}, ${cost:.4f}\n"
+
+    message += f"\nИтого: {total_tokens} токенов, ${total_cost:.4f}"
+    if USER_DAILY_TOKEN_BUDGET > 0:
+        used = await get_tokens_used(username)
+        message += (
+            f"\nВаш лимит на сегодня: {used} из {USER_DAILY_TOKEN_BUDGET} токенов"
+        )
+
+    await update.message.reply_text(message)
+    return ConversationHandler.END
 
+
+async def build_daily_summary(
+    username: str, summary_date, summary: dict, analysis=None
+) -> str:
+    """Build the daily summary message for one user, analyzing the day unless
+    the analysis was already made in a batch"""
+    food_records = summary["food_records"]
+    total_calories = summary["total_calories"]
+    goals = summary["goals"]
+    daily_goal = goals["calories"] if goals else None
+
+    # Prepare base message
+    message = f"📊 Итоги дня ({summary_date}):\n\n"
+    message += f"🔢 Всего употреблено: {total_calories:.0f} ккал\n"
+    if daily_goal:
+        diff = total_calories - daily_goal
+        message += f"🎯 Ваша цель: {daily_goal:.0f} ккал\n"
+        if diff > 0:
+            message += f"⚠️ Превышение: {diff:.0f} ккал\n"
+        else:
+            message += f"✅ Осталось: {abs(diff):.0f} ккал\n"
+
+    # Add nutrition analysis if we have both goals and food records
+    if goals and food_records:
+        if analysis is None:
+            analysis = await analyze_nutrition_vs_goals(
+                food_records, goals["text"], username
+            )
+        if analysis:
+            message += f"\n📋 Анализ питания:\n{analysis}"
+
+    return message
+
+
+# Telegram's limit on messages is global to the bot, so every background
+# fan-out (summaries of several timezones, reminders, batch deliveries)
+# draws on this one budget
+telegram_send_limiter = RateLimiter(TELEGRAM_SEND_RATE)
+
+
+async def deliver_daily_summaries(
+    application: Application, summary_date, summaries: dict, analyses: dict = None
+):
+    """
+    Build and send daily summaries
+    Args:
+        application: Telegram application
+        summary_date: Day the summaries are for
+        summaries: Per-user data from get_daily_summary_data
+        analyses: Per-user analyses made in a batch; missing ones are made now
+    """
+    analyses = analyses or {}
+
+    async def prepare(username):
+        return await build_daily_summary(
+            username, summary_date, summaries[username], analyses.get(username)
+        )
+
+    async def deliver(username, message):
+        await application.bot.send_message(
+            chat_id=username, text=message, parse_mode="HTML"
+        )
+        await mark_delivered(username)
+
+    # Analyze and send in parallel within OpenAI and Telegram limits
+    await fan_out(
+        list(summaries),
+        prepare,
+        deliver,
+        concurrency=SUMMARY_CONCURRENCY,
+        limiter=telegram_send_limiter,
+        max_retries=SUMMARY_MAX_RETRIES,
+    )
+
+
+async def send_daily_summary(
+    application: Application, fire_time: datetime, timezone: str
+):
+    """Send daily calorie summary to all users in the timezone"""
+    # Summarize the day that ended at fire time; load records, totals and
+    # goals of all users in a constant number of queries
+    summary_date = (fire_time - timedelta(days=1)).date()
+    summaries = await get_daily_summary_data(summary_date, timezone)
+    # A retried run skips users who got their summary before it failed
+    summaries = {
+        username: summaries[username] for username in await undelivered(summaries)
+    }
+
+    if SUMMARY_MODE == "batch":
+        requests = {
+            username: nutrition_batch_request(
+                summary["food_records"], summary["goals"]["text"]
+            )
+            for username, summary in summaries.items()
+            if summary["goals"] and summary["food_records"]
+        }
+        if requests:
+            batch_id = await submit_batch(requests)
+            if batch_id and await save_summary_batch(
+                batch_id, timezone, summary_date, list(requests)
+            ):
+                # The rest is sent by poll_summary_batches once the batch
+                # is done; users without an analysis get theirs now
+                logging.info(
+                    f"Submitted batch {batch_id} with {len(requests)} analyses"
+                )
+                # The batch has them now: a retried run mustn't submit again
+                await mark_delivered(*requests)
+                summaries = {
+                    username: summary
+                    for username, summary in summaries.items()
+                    if username not in requests
+                }
+
+    await deliver_daily_summaries(application, summary_date, summaries)
+
+
+async def deliver_summary_batch(application: Application, pending: dict, batch: dict):
+    """Send the daily summaries of a finished batch and mark it delivered"""
+    batch_id = pending["batch_id"]
+    try:
+        # Analyses missing from a failed batch are made directly
+        analyses = await get_batch_results(batch, "daily_analysis")
+        logging.info(
+            f"Batch {batch_id} {batch.get('status')}: "
+            f"{len(analyses)} of {len(pending['usernames'])} analyses"
+        )
+        summaries = await get_daily_summary_data(
+            pending["summary_date"], pending["timezone"]
+        )
+        summaries = {
+            username: summaries[username]
+            for username in pending["usernames"]
+            if username in summaries
+        }
+        await deliver_daily_summaries(
+            application, pending["summary_date"], summaries, analyses
+        )
+    except Exception as e:
+        logging.error(f"Error delivering batch {batch_id}: {str(e)}")
+        await finish_summary_batch(batch_id, delivered=False)
+        return
+    await finish_summary_batch(batch_id, delivered=True)
+
+
+async def poll_summary_batches(application: Application):
+    """Send the daily summaries of batches that have finished"""
+    lease = timedelta(minutes=JOB_LEASE_MINUTES)
+    for pending in await get_pending_summary_batches():
+        batch_id = pending["batch_id"]
+        if not await claim_summary_batch(batch_id, lease):
+            continue
+
+        try:
+            batch = await get_batch(batch_id)
         except Exception as e:
-            logging.error(f"Error in daily summary task: {str(e)}")
-            await asyncio.sleep(60)  # Wait a minute before retrying
+            logging.error(f"Error checking batch {batch_id}: {str(e)}")
+            await finish_summary_batch(batch_id, delivered=False)
+            continue
+
+        status = batch.get("status")
+        if status != "completed" and status not in BATCH_FAILED_STATUSES:
+            await finish_summary_batch(batch_id, delivered=False)
+            continue
+
+        application.create_task(deliver_summary_batch(application, pending, batch))
 
 
 async def weight_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -696,38 +1277,47 @@ async def process_weight(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return AWAITING_WEIGHT
 
     # Save weight measurement
-    if not save_weight_measurement(username, weight):
+    if not await save_weight_measurement(username, weight):
         await update.message.reply_text(
             "Произошла ошибка при сохранении веса.\n" "Пожалуйста, попробуйте позже."
         )
         return ConversationHandler.END
 
-    await update.message.reply_text("🔄 Анализирую ваш прогресс...")
+    status = await update.message.reply_text("🔄 Анализирую ваш прогресс...")
 
-    # Get weekly food records
-    start_date = datetime.now(pytz.timezone(DEFAULT_TIMEZONE)).date() - timedelta(
-        days=7
-    )
-    food_records = get_weekly_food_records(username, start_date)
+    # Get the week's nutrition, compacted to a bounded prompt size
+    start_date = await get_user_today(username) - timedelta(days=7)
+    days = await get_weekly_nutrition(username, start_date)
 
     # Analyze progress
-    if food_records:
+    if days:
         # Получаем необходимые данные для анализа
-        history = get_weight_history(username, limit=2)
-        target_weight = get_weight_goal(username)
-        nutrition_goals = get_nutrition_goals(username)
+        history = await get_weight_history(username, limit=2)
+        target_weight = await get_weight_goal(username)
+        nutrition_goals = await get_nutrition_goals(username)
 
-        analysis = await analyze_weight_progress(
-            username, weight, food_records, history, target_weight, nutrition_goals
-        )
-        if analysis:
-            await update.message.reply_text(
-                f"📋 Анализ прогресса:\n\n{analysis}", parse_mode="HTML"
+        week_summary = compact_week(days, WEEKLY_PROMPT_TOKEN_BUDGET)
+        try:
+            await stream_reply(
+                status,
+                stream_weight_progress(
+                    username,
+                    weight,
+                    week_summary,
+                    history,
+                    target_weight,
+                    nutrition_goals,
+                ),
+                prefix="📋 Анализ прогресса:\n\n",
+                interval=STREAM_EDIT_INTERVAL,
             )
+        except TokenBudgetExceeded as e:
+            logging.info(str(e))
+            await status.edit_text(TOKEN_BUDGET_MESSAGE)
 
     # Calculate time to target if exists
-    target_weight = get_weight_goal(username)
-    history = get_weight_history(username, limit=2)
+    target_weight = await get_weight_goal(username)
+    history = await get_weight_history(username, limit=2)
 
     if target_weight and len(history) >= 2:
         weight_diff = history[0][1] - history[1][1]  # Weekly weight change
@@ -751,7 +1341,7 @@ async def target_weight_command(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Извините, у вас нет доступа к этому боту.")
         return ConversationHandler.END
 
-    current_target = get_weight_goal(username)
+    current_target = await get_weight_goal(username)
     if current_target:
         await update.message.reply_text(
             f"Ваш текущий целевой вес: {current_target} кг\n"
@@ -781,7 +1371,7 @@ async def process_target_weight(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Пожалуйста, введите число (например: 65.5)")
         return AWAITING_TARGET_WEIGHT
 
-    if save_weight_goal(username, weight):
+    if await save_weight_goal(username, weight):
         await update.message.reply_text(
             f"Целевой вес {weight} кг успешно сохранен!\n"
             "Теперь я буду учитывать его при анализе прогресса."
@@ -795,40 +1385,38 @@ async def process_target_weight(update: Update, context: ContextTypes.DEFAULT_TY
     return ConversationHandler.END
 
 
-async def ask_weekly_weight(application: Application):
-    """Ask users for weight measurement every Sunday morning"""
-    while True:
-        try:
-            # Wait until next Sunday 9:00
-            now = datetime.now(pytz.timezone(DEFAULT_TIMEZONE))
-            days_until_sunday = (6 - now.weekday()) % 7
-            if days_until_sunday == 0 and now.hour >= 9:
-                days_until_sunday = 7
-            next_sunday = now.replace(
-                hour=9, minute=0, second=0, microsecond=0
-            ) + timedelta(days=days_until_sunday)
-            wait_seconds = (next_sunday - now).total_seconds()
-            await asyncio.sleep(wait_seconds)
-
-            # Get all active users
-            users = get_all_active_users()
-
-            for username in users:
-                try:
-                    keyboard = [["Внести вес сейчас"], ["Напомнить завтра"]]
-                    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
-
-                    await application.bot.send_message(
-                        chat_id=username,
-                        text="Доброе утро! Пора записать ваш текущий вес.",
-                        reply_markup=reply_markup,
-                    )
-                except Exception as e:
-                    logging.error(f"Error asking weight from user {username}: {str(e)}")
+async def send_weight_requests(application: Application, usernames: list, text: str):
+    """Send the weight request keyboard to the given users"""
+    keyboard = [["Внести вес сейчас"], ["Напомнить завтра"]]
+    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
 
-        except Exception as e:
-            logging.error(f"Error in weekly weight task: {str(e)}")
-            await asyncio.sleep(60)  # Wait a minute before retrying
+    async def prepare(username):
+        return text
+
+    async def deliver(username, message):
+        await application.bot.send_message(
+            chat_id=username, text=message, reply_markup=reply_markup
+        )
+        await mark_delivered(username)
+
+    await fan_out(
+        await undelivered(usernames),
+        prepare,
+        deliver,
+        concurrency=SUMMARY_CONCURRENCY,
+        limiter=telegram_send_limiter,
+        max_retries=SUMMARY_MAX_RETRIES,
+    )
+
+
+async def ask_weekly_weight(
+    application: Application, fire_time: datetime, timezone: str
+):
+    """Ask users in the timezone for weight measurement every Sunday morning"""
+    users = await get_timezone_users(timezone)
+    await send_weight_requests(
+        application, users, "Доброе утро! Пора записать ваш текущий вес."
+    )
 
 
 async def handle_weight_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -842,39 +1430,147 @@ async def handle_weight_button(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return AWAITING_WEIGHT
     elif text == "Напомнить завтра":
-        # Schedule reminder for tomorrow at 9:00
-        now = datetime.now(pytz.timezone(DEFAULT_TIMEZONE))
-        tomorrow = now.replace(hour=9, minute=0, second=0, microsecond=0) + timedelta(
-            days=1
-        )
-        delay = (tomorrow - now).total_seconds()
-
-        context.job_queue.run_once(
-            remind_weight, delay, data=update.effective_user.username
-        )
+        # Schedule reminder for tomorrow at 9:00 user's time; it is stored in
+        # the database and sent by the scheduler tick
+        username = update.effective_user.username
+        tz = pytz.timezone(await get_user_timezone(username))
+        tomorrow = datetime.now(tz).date() + timedelta(days=1)
+        remind_at = tz.localize(datetime.combine(tomorrow, time(9)))
+
+        await save_weight_reminder(username, remind_at)
         await update.message.reply_text(
             "Хорошо, я напомню вам завтра в 9:00.", reply_markup=ReplyKeyboardRemove()
         )
         return ConversationHandler.END
 
 
-async def remind_weight(context: ContextTypes.DEFAULT_TYPE):
-    """Callback for weight reminder"""
-    username = context.job.data
-    keyboard = [["Внести вес сейчас"], ["Напомнить завтра"]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+async def remind_weight(application: Application):
+    """Send all weight reminders that are due"""
+    users = await pop_due_weight_reminders()
+    if users:
+        await send_weight_requests(
+            application, users, "Напоминаю о необходимости записать ваш текущий вес."
+        )
+
+
+async def scheduler_tick(context: ContextTypes.DEFAULT_TYPE):
+    """Start scheduled jobs that are due and send due reminders"""
+    application = context.application
+
+    # Jobs fire at local time, one bucket per timezone, which spreads the
+    # load of users in different timezones across the day
+    timezones = set(await get_timezones()) | {DEFAULT_TIMEZONE}
+    for timezone in sorted(timezones):
+        # Daily summary at midnight
+        await run_scheduled_job(
+            application,
+            f"daily_summary:{timezone}",
+            last_fire_time(timezone, hour=0),
+            functools.partial(send_daily_summary, timezone=timezone),
+        )
+
+        # Weekly weight request on Sunday at 9:00
+        await run_scheduled_job(
+            application,
+            f"weekly_weight:{timezone}",
+            last_fire_time(timezone, hour=9, weekday=6),
+            functools.partial(ask_weekly_weight, timezone=timezone),
+        )
+
+    await poll_summary_batches(application)
+    await remind_weight(application)
+    await purge_expired()
+    await expire_drafts(application)
+
+
+async def remember_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Note when a user was last active, see expire_drafts"""
+    if update.effective_user:
+        context.user_data["last_seen"] = datetime.now(pytz.utc).timestamp()
+
+
+async def expire_drafts(application: Application):
+    """Drop the drafts of users inactive for DRAFT_TTL_MINUTES"""
+    if DRAFT_TTL_MINUTES <= 0:
+        return
+    ttl = timedelta(minutes=DRAFT_TTL_MINUTES)
+    cutoff = (datetime.now(pytz.utc) - ttl).timestamp()
+    expired = [
+        user_id
+        for user_id, user_data in application.user_data.items()
+        if user_data.get("last_seen", 0) < cutoff
+    ]
+    for user_id in expired:
+        application.drop_user_data(user_id)
+    if expired:
+        logging.info(f"Dropped {len(expired)} abandoned drafts")
+
+    # Entries of users who haven't come back since a restart
+    if isinstance(application.persistence, DatabasePersistence):
+        await delete_expired_bot_state(ttl)
+
+
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler for /timezone command"""
+    user_id = update.effective_user.id
+    username = update.effective_user.username
+
+    if not check_user_access(user_id, username):
+        await update.message.reply_text("Извините, у вас нет доступа к этому боту.")
+        return ConversationHandler.END
 
-    await context.bot.send_message(
-        chat_id=username,
-        text="Напоминаю о необходимости записать ваш текущий вес.",
-        reply_markup=reply_markup,
+    current_timezone = await get_user_timezone(username)
+    await update.message.reply_text(
+        f"Ваш текущий часовой пояс: {current_timezone}\n"
+        "Введите новый часовой пояс (например: Europe/Moscow, Asia/Yekaterinburg)"
     )
+    return AWAITING_TIMEZONE
+
+
+async def process_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler for processing timezone input"""
+    username = update.effective_user.username
+    timezone = update.message.text.strip()
+
+    if timezone not in pytz.all_timezones_set:
+        await update.message.reply_text(
+            "Неизвестный часовой пояс. Введите его в формате Europe/Moscow"
+        )
+        return AWAITING_TIMEZONE
+
+    if await save_user_timezone(username, timezone):
+        await update.message.reply_text(
+            f"Часовой пояс {timezone} сохранен!\n"
+            "Дневные итоги будут приходить в полночь по вашему времени."
+        )
+    else:
+        await update.message.reply_text(
+            "Произошла ошибка при сохранении часового пояса.\n"
+            "Пожалуйста, попробуйте позже."
+        )
+
+    return ConversationHandler.END
 
 
 def main():
     """Main bot launch function"""
     # Create application
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Different users' updates run in parallel, each user's in order, with
+    # intake paused while too many updates are in flight
+    update_queue = UpdateQueue(UPDATE_MAX_IN_FLIGHT)
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .update_queue(update_queue)
+        .concurrent_updates(
+            UserOrderedUpdateProcessor(UPDATE_CONCURRENCY, update_queue)
+        )
+    )
+    persistence = build_persistence()
+    if persistence:
+        builder = builder.persistence(persistence)
+    application = builder.build()
+    persistent = persistence is not None
 
     # Create conversation handler for messages and photos
     message_conv_handler = ConversationHandler(
@@ -882,17 +1578,27 @@ def main():
             MessageHandler(
                 filters.PHOTO | (filters.TEXT & ~filters.COMMAND) | filters.VOICE,
                 process_message,
-            )
+            ),
+            # Album analyses are sent after the conversation handler returned
+            CallbackQueryHandler(
+                button_callback, pattern="^(correct|add_context|cancel)$"
+            ),
         ],
         states={
             AWAITING_FEEDBACK: [CallbackQueryHandler(button_callback)],
             AWAITING_CONTEXT: [
                 MessageHandler(
-                    filters.TEXT & ~filters.COMMAND, process_additional_context
+                    (filters.TEXT & ~filters.COMMAND) | filters.PHOTO,
+                    process_additional_context,
                 )
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=(
+            timedelta(minutes=DRAFT_TTL_MINUTES) if DRAFT_TTL_MINUTES else None
+        ),
+        name="meal",
+        persistent=persistent,
     )
 
     # Create conversation handler for goals
@@ -904,6 +1610,8 @@ def main():
             ]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="goals",
+        persistent=persistent,
     )
 
     # Create conversation handler for weight
@@ -921,6 +1629,8 @@ def main():
             ]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="weight",
+        persistent=persistent,
     )
 
     # Create conversation handler for target weight
@@ -932,33 +1642,56 @@ def main():
             ]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="target_weight",
+        persistent=persistent,
+    )
+
+    # Create conversation handler for timezone
+    timezone_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("timezone", timezone_command)],
+        states={
+            AWAITING_TIMEZONE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, process_timezone)
+            ]
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="timezone",
+        persistent=persistent,
     )
 
     # Add handlers
+    application.add_handler(TypeHandler(Update, remember_activity), group=-1)
+    application.add_handler(TypeHandler(MediaGroupClosed, finish_media_group))
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("goals", goals_command))
     application.add_handler(CommandHandler("calories", calories_command))
     application.add_handler(CommandHandler("analyze", analyze_command))
+    application.add_handler(CommandHandler("usage", usage_command))
 
     # Регистрируем сначала обработчики конверсаций для команд
     application.add_handler(goals_conv_handler)
     application.add_handler(weight_conv_handler)
     application.add_handler(target_weight_conv_handler)
+    application.add_handler(timezone_conv_handler)
 
     # Регистрируем обработчик сообщений последним, чтобы он не перехватывал команды
     application.add_handler(message_conv_handler)
 
-    # Start daily summary task
-    application.job_queue.run_custom(
-        send_daily_summary, job_kwargs={"max_instances": 1}
+    # Check scheduled jobs and reminders periodically; runs missed while the
+    # bot was down are caught up on the first tick
+    application.job_queue.run_repeating(
+        scheduler_tick, interval=SCHEDULER_INTERVAL, first=0
     )
 
-    # Start weekly weight task
-    application.job_queue.run_custom(ask_weekly_weight, job_kwargs={"max_instances": 1})
-
     # Launch bot
-    application.run_polling()
+    if WEBHOOK_URL:
+        # Imported here so polling works without the webhook server packages
+        from webhook import run_webhook
+
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
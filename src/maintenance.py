@@ -0,0 +1,63 @@
+"""Maintenance commands for the bot database.
+
+Usage:
+    python src/maintenance.py migrate
+    python src/maintenance.py rebuild-totals [--user USERNAME]
+    python src/maintenance.py check-totals [--user USERNAME]
+"""
+
+import argparse
+import logging
+import sys
+
+from database import migrate_schema, rebuild_daily_totals, check_daily_totals
+
+
+def main():
+    """Parse the command line and run the requested command"""
+    parser = argparse.ArgumentParser(description="Nutritioner bot maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser(
+        "migrate", help="Upgrade tables created by older versions of the bot"
+    )
+
+    rebuild_parser = subparsers.add_parser(
+        "rebuild-totals", help="Recompute the daily_totals rollup from daily_data"
+    )
+    rebuild_parser.add_argument("--user", help="Only rebuild this username")
+
+    check_parser = subparsers.add_parser(
+        "check-totals", help="Compare the daily_totals rollup with daily_data"
+    )
+    check_parser.add_argument("--user", help="Only check this username")
+
+    args = parser.parse_args()
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+
+    if args.command == "migrate":
+        migrate_schema()
+        logging.info("Schema is up to date")
+        return 0
+
+    if args.command == "rebuild-totals":
+        rows = rebuild_daily_totals(args.user)
+        logging.info(f"Rebuilt daily totals: {rows} rows written")
+        return 0
+
+    if args.command == "check-totals":
+        mismatches = check_daily_totals(args.user)
+        for username, day, stored, actual in mismatches:
+            logging.warning(
+                f"Mismatch for @{username} on {day}: "
+                f"stored={stored}, actual={actual}"
+            )
+        logging.info(f"Checked daily totals: {len(mismatches)} mismatches")
+        return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
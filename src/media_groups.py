@@ -0,0 +1,126 @@
+"""Collection of album (media group) parts into one batch per album."""
+
+import asyncio
+import logging
+from collections import OrderedDict
+
+# How many closed groups are remembered to drop their late parts
+_CLOSED_GROUPS_KEPT = 1000
+
+
+class MediaGroupClosed:
+    """
+    A complete album, put into the application's update queue so that it is
+    processed in order with the user's other updates
+    """
+
+    def __init__(self, user_id: int, data, results: list, captions: list):
+        """
+        Args:
+            user_id: User who sent the album; updates are ordered by it
+            data: What the album's first part passed to add()
+            results: Results of the parts in message order
+            captions: Captions of the parts in message order
+        """
+        self.user_id = user_id
+        self.data = data
+        self.results = results
+        self.captions = captions
+
+
+class MediaGroupCollector:
+    """
+    Gathers the parts of albums, which Telegram delivers as separate updates
+    in no guaranteed order. Each part's processing starts as soon as it
+    arrives; a group closes once no new part has come for `debounce`
+    seconds or it has `max_items` parts, and then `on_close` is called
+    exactly once with the results in message order.
+    """
+
+    def __init__(self, debounce: float, max_items: int, on_close):
+        """
+        Args:
+            debounce: Seconds of quiet after which a group is complete
+            max_items: Number of parts that closes a group at once
+            on_close: Coroutine function (data, results, captions) where
+                data is what the group's first add() passed
+        """
+        self.debounce = debounce
+        self.max_items = max_items
+        self.on_close = on_close
+        self._groups = {}
+        self._closed = OrderedDict()
+        self._tasks = set()
+
+    def add(self, key, order: int, item=None, caption: str = None, data=None) -> bool:
+        """
+        Add a part to its group, opening the group if it is the first one
+        Args:
+            key: Group identity, e.g. (user id, media group id)
+            order: Position of the part, e.g. its message id
+            item: Coroutine processing the part, started right away
+            caption: Text sent with the part
+            data: Anything on_close needs, kept from the first part
+        Returns:
+            bool: False if the part came after its group was closed
+        """
+        if key in self._closed:
+            if item is not None:
+                item.close()
+            logging.info(f"Dropped a part of already closed media group {key}")
+            return False
+
+        loop = asyncio.get_running_loop()
+        group = self._groups.get(key)
+        if group is None:
+            group = {"items": [], "captions": [], "timer": None, "data": data}
+            self._groups[key] = group
+
+        if item is not None:
+            group["items"].append((order, loop.create_task(item)))
+        if caption:
+            group["captions"].append((order, caption))
+
+        if group["timer"] is not None:
+            group["timer"].cancel()
+        if len(group["items"]) >= self.max_items:
+            self._close(key)
+        else:
+            group["timer"] = loop.call_later(self.debounce, self._close, key)
+        return True
+
+    def _close(self, key):
+        """Stop accepting parts of a group and hand it over to on_close"""
+        group = self._groups.pop(key, None)
+        if group is None:
+            return
+        if group["timer"] is not None:
+            group["timer"].cancel()
+
+        self._closed[key] = True
+        while len(self._closed) > _CLOSED_GROUPS_KEPT:
+            self._closed.popitem(last=False)
+
+        # Keep a reference so the task isn't garbage collected mid-way
+        task = asyncio.get_running_loop().create_task(self._finish(key, group))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _finish(self, key, group: dict):
+        """Wait for the parts of a closed group and pass them to on_close"""
+        items = sorted(group["items"], key=lambda item: item[0])
+        outcomes = await asyncio.gather(
+            *[task for _, task in items], return_exceptions=True
+        )
+        results = []
+        for (order, _), outcome in zip(items, outcomes):
+            if isinstance(outcome, Exception):
+                logging.error(f"Error processing part {order} of {key}: {outcome}")
+            else:
+                results.append(outcome)
+        captions = [caption for _, caption in sorted(group["captions"])]
+
+        try:
+            await self.on_close(group["data"], results, captions)
+        except Exception as e:
+            logging.error(f"Error handling media group {key}: {str(e)}")
@@ -0,0 +1,252 @@
+"""Structured nutrition data returned by the meal analysis."""
+
+import html
+import json
+import logging
+import re
+from typing import List, Optional
+
+from pydantic import BaseModel, Field, ValidationError
+
+
+class NutritionValues(BaseModel):
+    """Calories and macronutrients in kcal and grams"""
+
+    calories: float = 0
+    protein: float = 0
+    fat: float = 0
+    carbs: float = 0
+
+
+class MealItem(NutritionValues):
+    """One product of a meal"""
+
+    name: str
+    grams: Optional[float] = None
+
+
+class MealAnalysis(BaseModel):
+    """Per-item and total nutrition of a meal"""
+
+    items: List[MealItem] = []
+    total: NutritionValues = NutritionValues()
+    comment: str = ""
+    # False for a fallback built from an answer that wasn't valid JSON; such
+    # an analysis is neither cached nor stored as structured data
+    parsed: bool = Field(default=True, exclude=True)
+
+    def render_html(self) -> str:
+        """Render the analysis as Telegram HTML"""
+        lines = []
+        for item in self.items:
+            portion = f" ({item.grams:.0f} г)" if item.grams else ""
+            lines.append(
+                f"🍽 <b>{html.escape(item.name)}</b>{portion}: "
+                f"{item.calories:.0f} ккал, Б {item.protein:.0f} г, "
+                f"Ж {item.fat:.0f} г, У {item.carbs:.0f} г"
+            )
+        if lines:
+            lines.append("")
+
+        lines.append(f"📊 <b>Итого: {self.total.calories:.0f} ккал</b>")
+        lines.append(
+            f"Белки: {self.total.protein:.0f} г, Жиры: {self.total.fat:.0f} г, "
+            f"Углеводы: {self.total.carbs:.0f} г"
+        )
+        if self.comment:
+            lines.append("")
+            lines.append(f"<i>{html.escape(self.comment)}</i>")
+        return "\n".join(lines)
+
+
+# JSON layout requested from the model
+MEAL_ANALYSIS_FORMAT = """Ответь только JSON-объектом без пояснений в формате:
+{"items": [{"name": "название продукта", "grams": 150, "calories": 250, "protein": 10, "fat": 5, "carbs": 30}],
+ "total": {"calories": 250, "protein": 10, "fat": 5, "carbs": 30},
+ "comment": "короткое замечание или пустая строка"}
+Калории в ккал, белки, жиры и углеводы в граммах."""
+
+
+def extract_calories(gpt_response: str) -> float:
+    """
+    Extract total calories from GPT response
+    Args:
+        gpt_response: GPT response text
+    Returns:
+        float: Total calories or 0 if not found
+    """
+    try:
+        # Ищем строки с упоминанием калорий
+        matches = re.findall(
+            r"(\d+(?:\.\d+)?)\s*(?:к?кал|ккал|калори[йя])", gpt_response.lower()
+        )
+        if matches:
+            # Берем последнее число (обычно это общая сумма)
+            return float(matches[-1])
+        return 0
+    except Exception as e:
+        logging.error(f"Error extracting calories: {str(e)}")
+        return 0
+
+
+class MealAnalysisError(ValueError):
+    """Raised when the model's answer holds no usable meal analysis"""
+
+
+def parse_meal_analysis(text: str) -> MealAnalysis:
+    """
+    Parse the model's JSON answer into a MealAnalysis
+    Args:
+        text: Model response, expected to contain a JSON object
+    Returns:
+        MealAnalysis: Parsed analysis; if the answer isn't valid JSON (e.g.
+            cut off), an unparsed analysis whose comment holds the raw answer
+            and whose calories are taken from its text
+    Raises:
+        MealAnalysisError: If the answer isn't valid JSON and mentions no
+            calories either
+    """
+    try:
+        # Tolerate code fences or stray text around the object
+        match = re.search(r"\{.*\}", text or "", re.DOTALL)
+        analysis = MealAnalysis.model_validate(json.loads(match.group(0)))
+    except (AttributeError, ValueError, ValidationError) as e:
+        logging.error(f"Error parsing meal analysis: {str(e)}")
+        calories = extract_calories(text or "")
+        if not calories:
+            raise MealAnalysisError("The meal analysis could not be parsed")
+        return MealAnalysis(
+            total=NutritionValues(calories=calories),
+            comment=text,
+            parsed=False,
+        )
+
+    # Fill in the total if the model only listed items
+    if analysis.items and not analysis.total.calories:
+        analysis.total = NutritionValues(
+            calories=sum(item.calories for item in analysis.items),
+            protein=sum(item.protein for item in analysis.items),
+            fat=sum(item.fat for item in analysis.items),
+            carbs=sum(item.carbs for item in analysis.items),
+        )
+    return analysis
+
+
+class NutritionTargets(BaseModel):
+    """Daily targets parsed from the user's goals text"""
+
+    calories: Optional[float] = None
+    protein: Optional[float] = None
+    fat: Optional[float] = None
+    carbs: Optional[float] = None
+
+
+_NUMBER = r"(\d+(?:[.,]\d+)?)"
+
+# Keyword followed by its value, e.g. "Дневная норма калорий: 2000 ккал"
+_GOAL_PATTERNS = {
+    "calories": [rf"калори\w*\D{{0,20}}?{_NUMBER}", rf"{_NUMBER}\s*к?кал"],
+    "protein": [rf"бел[ко]\w*\D{{0,20}}?{_NUMBER}"],
+    "fat": [rf"жир\w*\D{{0,20}}?{_NUMBER}"],
+    "carbs": [rf"углевод\w*\D{{0,20}}?{_NUMBER}"],
+}
+
+
+def parse_nutrition_goals(text: str) -> NutritionTargets:
+    """
+    Extract numeric daily targets from free-form goals text
+    Args:
+        text: Goals as entered by the user
+    Returns:
+        NutritionTargets: Targets found in the text; missing ones are None
+    """
+    targets = NutritionTargets()
+    lowered = (text or "").lower()
+    for name, patterns in _GOAL_PATTERNS.items():
+        for pattern in patterns:
+            match = re.search(pattern, lowered)
+            if match:
+                setattr(targets, name, float(match.group(1).replace(",", ".")))
+                break
+    return targets
+
+
+def meal_summary_line(response: str, max_length: int = 80) -> str:
+    """
+    Shorten a legacy free-form meal response to its first line of text
+    Args:
+        response: Stored HTML response
+        max_length: Maximum length of the result
+    Returns:
+        str: First non-empty line without HTML tags
+    """
+    text = html.unescape(re.sub(r"<[^>]+>", "", response or ""))
+    for line in text.splitlines():
+        line = line.strip()
+        if line:
+            return line[:max_length]
+    return ""
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Roughly estimate the number of model tokens in a text
+    Args:
+        text: Prompt text
+    Returns:
+        int: Token estimate, on the high side for Russian text
+    """
+    return len(text) // 3 + 1
+
+
+def compact_week(days: list, token_budget: int) -> str:
+    """
+    Summarize a week of meals for a prompt: per-day totals and a deduplicated
+    list of products, cut to fit the token budget
+    Args:
+        days: Per-day dicts as returned by get_weekly_nutrition
+        token_budget: Maximum estimated tokens of the summary
+    Returns:
+        str: Summary text
+    """
+    lines = ["Итоги по дням (ккал; белки/жиры/углеводы, г; приёмов пищи):"]
+    for day in days:
+        lines.append(
+            f"{day['date']:%d.%m}: {day['calories']:.0f} ккал; "
+            f"{day['protein']:.0f}/{day['fat']:.0f}/{day['carbs']:.0f}; "
+            f"{day['records_count']}"
+        )
+    if days:
+        average = sum(day["calories"] for day in days) / len(days)
+        lines.append(f"В среднем: {average:.0f} ккал в день")
+
+    # Count each product once per spelling, most frequent first
+    counts = {}
+    names = {}
+    for day in days:
+        for name in day["items"]:
+            key = " ".join(name.lower().split())[:40]
+            if key:
+                counts[key] = counts.get(key, 0) + 1
+                names.setdefault(key, name.strip()[:40])
+    products = sorted(counts, key=lambda key: -counts[key])
+
+    summary = "\n".join(lines)
+    if not products:
+        return summary
+
+    summary += "\n\nПродукты за неделю (сколько раз):\n"
+    used = estimate_tokens(summary)
+    listed = []
+    for key in products:
+        entry = names[key] + (f" ×{counts[key]}" if counts[key] > 1 else "")
+        # Reserve room for the "and N more" tail
+        if used + estimate_tokens(entry + ", ") + 5 > token_budget:
+            break
+        listed.append(entry)
+        used += estimate_tokens(entry + ", ")
+
+    summary += ", ".join(listed)
+    if len(listed) < len(products):
+        summary += f" и ещё {len(products) - len(listed)}"
+    return summary
@@ -0,0 +1,105 @@
+"""OpenAI Batch API for analyses nobody waits on: half the price, no burst."""
+
+import json
+import logging
+
+import httpx
+
+from openai_client import client
+from usage import record_usage
+
+# Terminal batch states without (complete) results
+BATCH_FAILED_STATUSES = ("failed", "expired", "cancelled")
+
+
+async def submit_batch(requests: dict) -> str:
+    """
+    Upload chat completion requests and start a batch job for them
+    Args:
+        requests: Mapping of custom id to the chat completion request body
+    Returns:
+        str: Batch id, or None if the batch couldn't be created
+    """
+    lines = [
+        json.dumps(
+            {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body,
+            },
+            ensure_ascii=False,
+        )
+        for custom_id, body in requests.items()
+    ]
+
+    try:
+        # The SDK in use predates client.batches, so the endpoint is called
+        # through the client's generic request methods
+        input_file = await client.files.create(
+            file=("requests.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        response = await client.post(
+            "/batches",
+            body={
+                "input_file_id": input_file.id,
+                "endpoint": "/v1/chat/completions",
+                "completion_window": "24h",
+            },
+            cast_to=httpx.Response,
+        )
+        return response.json()["id"]
+    except Exception as e:
+        logging.error(f"Error submitting batch: {str(e)}")
+        return None
+
+
+async def get_batch(batch_id: str) -> dict:
+    """
+    Get the state of a batch job
+    Args:
+        batch_id: Batch id from submit_batch
+    Returns:
+        dict: Batch object with status and output_file_id
+    """
+    response = await client.get(f"/batches/{batch_id}", cast_to=httpx.Response)
+    return response.json()
+
+
+async def get_batch_results(batch: dict, call_type: str) -> dict:
+    """
+    Download the answers of a finished batch job and record their usage
+    Args:
+        batch: Batch object from get_batch; custom ids are usernames
+        call_type: Model route the requests were made for
+    Returns:
+        dict: Mapping of custom id to the message content of each request
+            that succeeded
+    """
+    if not batch.get("output_file_id"):
+        return {}
+
+    content = await client.files.content(batch["output_file_id"])
+    results = {}
+    for line in content.text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            logging.warning(
+                f"Batch request {result.get('custom_id')} failed: "
+                f"{result.get('error') or response.get('body')}"
+            )
+            continue
+        body = response["body"]
+        results[result["custom_id"]] = body["choices"][0]["message"]["content"]
+        await record_usage(
+            result["custom_id"],
+            call_type,
+            body.get("model", ""),
+            body.get("usage"),
+            batch=True,
+        )
+    return results
@@ -0,0 +1,182 @@
+"""Shared OpenAI client with deadlines, retries, concurrency caps and a circuit breaker."""
+
+import asyncio
+import logging
+import random
+import time
+
+import openai
+from openai import AsyncOpenAI
+
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_TIMEOUT,
+    OPENAI_MAX_RETRIES,
+    OPENAI_CONCURRENCY,
+    OPENAI_BREAKER_THRESHOLD,
+    OPENAI_BREAKER_RESET,
+)
+
+# Retries are done here, so the SDK's own retry loop is switched off
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=0)
+
+# Failures worth another attempt: rate limits, timeouts, network and 5xx errors
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+# Longest wait before a retry; a longer Retry-After fails the call instead
+MAX_RETRY_DELAY = 30
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a model that keeps failing"""
+
+
+class CircuitBreaker:
+    """
+    Stops calls after `threshold` consecutive failures and lets a single
+    trial call through once `reset_timeout` seconds have passed
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # When the trial call started; a trial that never reported back
+        # (e.g. cancelled) expires after reset_timeout too
+        self._trial_started = None
+
+    @property
+    def state(self) -> str:
+        """'closed', 'open' or 'half-open'"""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Whether a call may be made now"""
+        state = self.state
+        if state == "closed":
+            return True
+        now = time.monotonic()
+        if state == "half-open" and (
+            self._trial_started is None
+            or now - self._trial_started >= self.reset_timeout
+        ):
+            self._trial_started = now
+            return True
+        return False
+
+    def record_success(self):
+        """Close the circuit after a successful call"""
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started = None
+
+    def record_failure(self):
+        """Count a failed call, opening the circuit at the threshold"""
+        self.failures += 1
+        self._trial_started = None
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+# One semaphore and breaker per model, created on first use
+_semaphores = {}
+_breakers = {}
+
+
+def _semaphore(model: str) -> asyncio.Semaphore:
+    """Get the semaphore capping concurrent calls to a model"""
+    if model not in _semaphores:
+        _semaphores[model] = asyncio.Semaphore(OPENAI_CONCURRENCY)
+    return _semaphores[model]
+
+
+def get_breaker(model: str) -> CircuitBreaker:
+    """Get the circuit breaker of a model"""
+    if model not in _breakers:
+        _breakers[model] = CircuitBreaker(
+            OPENAI_BREAKER_THRESHOLD, OPENAI_BREAKER_RESET
+        )
+    return _breakers[model]
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """
+    Seconds to wait before the next attempt
+    Args:
+        error: Failure of the previous attempt
+        attempt: Number of the failed attempt, starting at 0
+    Returns:
+        float: Retry-After of the response if given, else jittered backoff
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            pass
+    return min(2**attempt, MAX_RETRY_DELAY) * random.uniform(0.5, 1.5)
+
+
+async def call_openai(
+    model: str, func, retries: int = None, deadline: float = None, **kwargs
+):
+    """
+    Call an OpenAI API method with the shared limits
+    Args:
+        model: Model the call uses; limits and breaker are per model
+        func: Client coroutine method, e.g. client.chat.completions.create
+        retries: Retries after the first attempt, OPENAI_MAX_RETRIES if None
+        deadline: Seconds allowed per attempt, OPENAI_TIMEOUT if None
+        **kwargs: Arguments for func; `model` is passed along too
+    Returns:
+        The API response
+    Raises:
+        CircuitOpenError: If the model's circuit is open
+        openai.OpenAIError or asyncio.TimeoutError: If all attempts failed
+    """
+    breaker = get_breaker(model)
+    if not breaker.allow():
+        raise CircuitOpenError(f"OpenAI calls to {model} are paused")
+
+    if retries is None:
+        retries = OPENAI_MAX_RETRIES
+    if deadline is None:
+        deadline = OPENAI_TIMEOUT
+
+    for attempt in range(retries + 1):
+        try:
+            async with _semaphore(model):
+                response = await asyncio.wait_for(
+                    func(model=model, **kwargs), timeout=deadline
+                )
+            breaker.record_success()
+            return response
+        except RETRYABLE_ERRORS as e:
+            delay = _retry_delay(e, attempt)
+            # A Retry-After longer than MAX_RETRY_DELAY would keep the user
+            # waiting past any deadline: fail, so the route falls back to
+            # another model or the user gets an error right away
+            if attempt == retries or delay > MAX_RETRY_DELAY:
+                breaker.record_failure()
+                raise
+            logging.warning(
+                f"OpenAI call to {model} failed ({type(e).__name__}); "
+                f"retrying in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+        except Exception:
+            # The API answered (bad request, auth...), so it is reachable
+            breaker.record_success()
+            raise
@@ -1,74 +1,188 @@
 import logging
 import base64
-from openai import AsyncOpenAI
-from config import OPENAI_API_KEY, GPT_MODEL
 from constants import TELEGRAM_FORMATTING
-
-# OpenAI client initialization
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-
-
-async def analyze_image_with_gpt(photos_base64: list, additional_info: str) -> str:
-    """Sends request to OpenAI and returns response"""
+from images import prepare_image, image_detail
+from analysis_cache import cache_key, get_analysis, store_analysis, get_cache_stats
+from nutrition import MealAnalysis, MEAL_ANALYSIS_FORMAT, parse_meal_analysis
+from openai_client import client
+from routing import call_route, primary_model
+from usage import TokenBudgetExceeded
+
+
+async def analyze_image_with_gpt(
+    photos_base64: list, additional_info: str, username: str = None
+) -> MealAnalysis:
+    """Sends request to OpenAI and returns the structured meal analysis"""
     # Prepare base prompt
     prompt = (
         f"Определи КБЖУ блюда по {'фотографии' if photos_base64 else 'описанию'}. "
         f"Рассчитай КБЖУ для каждого продукта и суммарные значения. "
-        f"Если количество продукта не указано, используй стандартную порцию. "
-        f"Отвечай кратко, без вводных фраз и пояснений.\n\n"
-        f"{TELEGRAM_FORMATTING}"
+        f"Если количество продукта не указано, используй стандартную порцию.\n\n"
+        f"{MEAL_ANALYSIS_FORMAT}"
     )
 
     # Add additional info if not empty
     if additional_info:
         prompt += f"\n\nОписание блюда: {additional_info}"
 
+    route = "vision_meal" if photos_base64 else "text_meal"
+
+    # Same photos, description and model give the same answer
+    key = cache_key(photos_base64, prompt, primary_model(route))
+    cached = await get_analysis(key)
+    if cached is not None:
+        logging.debug(f"Image analysis cache hit: {get_cache_stats()}")
+        return parse_meal_analysis(cached)
+
     messages = [{"type": "text", "text": prompt}]
 
     # Add photos if any
+    detail = image_detail()
     for photo_base64 in photos_base64:
         messages.append(
             {
                 "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{photo_base64}"},
+                "image_url": {
+                    "url": f"data:image/jpeg;base64,{photo_base64}",
+                    "detail": detail,
+                },
             }
         )
 
     # Log the prompt at DEBUG level
     logging.debug(f"GPT Prompt for image analysis:\n{messages}")
 
-    response = await client.chat.completions.create(
-        model=GPT_MODEL,
+    response = await call_route(
+        route,
+        client.chat.completions.create,
+        username=username,
+        images=len(photos_base64),
         messages=[{"role": "user", "content": messages}],
-        max_tokens=500,
+        max_tokens=800,
+        response_format={"type": "json_object"},
+    )
+    analysis = parse_meal_analysis(response.choices[0].message.content)
+    # A retry should ask the model again rather than replay a broken answer
+    if analysis.parsed:
+        await store_analysis(key, analysis.model_dump_json())
+    return analysis
+
+
+# Earlier corrections of an analysis sent along with a new one
+MAX_CORRECTION_TURNS = 5
+
+
+async def correct_meal_analysis(
+    turns: list, correction: str, username: str = None
+) -> MealAnalysis:
+    """
+    Apply a user's correction to a meal analysis with a text-only call
+    Args:
+        turns: Conversation so far as chat messages: the analyses (as JSON)
+            from the assistant and the corrections from the user, starting
+            with the first analysis
+        correction: New correction, e.g. "порция 200 г"
+        username: User the analysis is for
+    Returns:
+        MealAnalysis: Corrected analysis
+    """
+    prompt = (
+        f"Ты проанализировал блюдо по фотографии или описанию. Пользователь "
+        f"уточняет результат. Пересчитай КБЖУ с учетом всех уточнений, "
+        f"остальное оставь как было.\n\n{MEAL_ANALYSIS_FORMAT}"
     )
-    return response.choices[0].message.content
+    # The first analysis plus the latest turns keep the prompt short
+    recent = turns[1:][-2 * MAX_CORRECTION_TURNS :]
+    messages = [
+        {"role": "system", "content": prompt},
+        turns[0],
+        *recent,
+        {"role": "user", "content": correction},
+    ]
+    logging.debug(f"GPT messages for meal correction:\n{messages}")
+
+    response = await call_route(
+        "meal_correction",
+        client.chat.completions.create,
+        username=username,
+        messages=messages,
+        max_tokens=800,
+        response_format={"type": "json_object"},
+    )
+    return parse_meal_analysis(response.choices[0].message.content)
 
 
-def encode_image(image_path):
-    """Function to encode the image"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+def encode_image(image_data: bytes) -> str:
+    """Function to downscale and encode the image"""
+    return base64.b64encode(prepare_image(image_data)).decode("utf-8")
 
 
-async def transcribe_audio(audio_file: str) -> str:
+async def transcribe_audio(
+    audio_file, username: str = None, duration: float = 0
+) -> str:
     """Transcribe audio using OpenAI Whisper"""
     try:
-        with open(audio_file, "rb") as audio:
-            response = await client.audio.transcriptions.create(
-                model="whisper-1", file=audio, language="ru"
-            )
-            return response.text
+
+        async def transcribe(**kwargs):
+            # A retry has to upload the buffer from the start again
+            audio_file.seek(0)
+            return await client.audio.transcriptions.create(**kwargs)
+
+        # Whisper detects the format from the file name, so name the buffer
+        response = await call_route(
+            "transcription",
+            transcribe,
+            username=username,
+            audio_seconds=duration,
+            file=("voice.ogg", audio_file),
+            language="ru",
+        )
+        return response.text
+    except TokenBudgetExceeded:
+        raise
     except Exception as e:
         logging.error(f"Error transcribing audio: {str(e)}")
         return None
 
 
-async def analyze_nutrition_vs_goals(food_records: list, goals: str) -> str:
-    """Analyze how well the daily nutrition matches user's goals"""
-    if not food_records or not goals:
-        return None
+async def _stream_completion(
+    route: str, prompt: str, max_tokens: int, purpose: str, username: str = None
+):
+    """
+    Yield the text of a completion piece by piece as it is generated
+    Args:
+        route: Model route of the task
+        prompt: User message sent to the model
+        max_tokens: Completion length limit
+        purpose: What the completion is for, used in error logs
+        username: User the completion is for
+    Yields:
+        str: Text deltas; on error the stream just ends
+    Raises:
+        TokenBudgetExceeded: If the user is over the daily token budget
+    """
+    try:
+        stream = await call_route(
+            route,
+            client.chat.completions.create,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens,
+            stream=True,
+            username=username,
+            # Ask for the token usage in the last chunk
+            extra_body={"stream_options": {"include_usage": True}},
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    except TokenBudgetExceeded:
+        raise
+    except Exception as e:
+        logging.error(f"Error streaming {purpose}: {str(e)}")
+
 
+def _nutrition_prompt(food_records: list, goals: str) -> str:
+    """Build the prompt comparing a day's meals with the user's goals"""
     # Prepare the daily nutrition summary with timing information
     daily_nutrition = []
     for time, record in food_records:
@@ -76,8 +190,7 @@ async def analyze_nutrition_vs_goals(food_records: list, goals: str) -> str:
 
     daily_nutrition_text = "\n\n".join(daily_nutrition)
 
-    try:
-        prompt = f"""Проанализируй, насколько питание человека за день соответствует его целям.
+    prompt = f"""Проанализируй, насколько питание человека за день соответствует его целям.
 
 Цели:
 {goals}
@@ -101,12 +214,26 @@ async def analyze_nutrition_vs_goals(food_records: list, goals: str) -> str:
 - Рекомендации на следующий день
 
 {TELEGRAM_FORMATTING}"""
+    return prompt
+
+
+async def analyze_nutrition_vs_goals(
+    food_records: list, goals: str, username: str = None
+) -> str:
+    """Analyze how well the daily nutrition matches user's goals"""
+    if not food_records or not goals:
+        return None
+
+    try:
+        prompt = _nutrition_prompt(food_records, goals)
 
         # Log the prompt at DEBUG level
         logging.debug(f"GPT Prompt for nutrition analysis:\n{prompt}")
 
-        response = await client.chat.completions.create(
-            model=GPT_MODEL,
+        response = await call_route(
+            "daily_analysis",
+            client.chat.completions.create,
+            username=username,
             messages=[{"role": "user", "content": prompt}],
             max_tokens=1000,
         )
@@ -116,15 +243,40 @@ async def analyze_nutrition_vs_goals(food_records: list, goals: str) -> str:
         return None
 
 
-async def analyze_weight_progress(
-    username: str,
+def nutrition_batch_request(food_records: list, goals: str) -> dict:
+    """Build the chat completion request body of a nutrition analysis for the Batch API"""
+    return {
+        "model": primary_model("daily_analysis"),
+        "messages": [
+            {"role": "user", "content": _nutrition_prompt(food_records, goals)}
+        ],
+        "max_tokens": 1000,
+    }
+
+
+async def stream_nutrition_vs_goals(
+    food_records: list, goals: str, username: str = None
+):
+    """Stream the analysis of the daily nutrition against user's goals"""
+    if not food_records or not goals:
+        return
+
+    prompt = _nutrition_prompt(food_records, goals)
+    logging.debug(f"GPT Prompt for nutrition analysis:\n{prompt}")
+    async for delta in _stream_completion(
+        "daily_analysis", prompt, 1000, "nutrition analysis", username
+    ):
+        yield delta
+
+
+def _weight_progress_prompt(
     current_weight: float,
-    food_records: list,
+    week_summary: str,
     weight_history,
     target_weight,
     nutrition_goals,
 ) -> str:
-    """Analyze weight progress and nutrition"""
+    """Build the prompt analyzing the week's weight change and nutrition"""
     history = weight_history
 
     if len(history) < 2:
@@ -137,8 +289,7 @@ async def analyze_weight_progress(
         else:
             weight_change = f"{'увеличился' if weight_diff > 0 else 'снизился'} на {abs(weight_diff):.1f} кг"
 
-    try:
-        prompt = f"""Проанализируй прогресс в снижении веса и питание за неделю.
+    prompt = f"""Проанализируй прогресс в снижении веса и питание за неделю.
 
 Информация о весе:
 - Текущий вес: {current_weight} кг
@@ -149,7 +300,7 @@ async def analyze_weight_progress(
 {nutrition_goals if nutrition_goals else 'не указаны'}
 
 Питание за неделю:
-{chr(10).join(food_records)}
+{week_summary}
 
 Проведи анализ как опытный нутрициолог. Важно:
 1. Анализ должен быть доказательным и адекватным
@@ -170,16 +321,23 @@ async def analyze_weight_progress(
 - Рекомендации по улучшению (с учетом целей)
 
 {TELEGRAM_FORMATTING}"""
+    return prompt
 
-        # Log the prompt at DEBUG level
-        logging.debug(f"GPT Prompt for weight progress analysis:\n{prompt}")
 
-        response = await client.chat.completions.create(
-            model=GPT_MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1000,
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        logging.error(f"Error analyzing weight progress: {str(e)}")
-        return None
+async def stream_weight_progress(
+    username: str,
+    current_weight: float,
+    week_summary: str,
+    weight_history,
+    target_weight,
+    nutrition_goals,
+):
+    """Stream the analysis of weight progress and nutrition"""
+    prompt = _weight_progress_prompt(
+        current_weight, week_summary, weight_history, target_weight, nutrition_goals
+    )
+    logging.debug(f"GPT Prompt for weight progress analysis:\n{prompt}")
+    async for delta in _stream_completion(
+        "weekly_analysis", prompt, 1000, "weight progress analysis", username
+    ):
+        yield delta
@@ -0,0 +1,114 @@
+"""Storage of user drafts and conversation states across restarts."""
+
+import json
+from datetime import timedelta
+
+from telegram.ext import BasePersistence, PersistenceInput, PicklePersistence
+
+from async_database import delete_bot_state, load_bot_state, save_bot_state
+from config import (
+    DRAFT_TTL_MINUTES,
+    STATE_BACKEND,
+    STATE_FILE,
+    STATE_UPDATE_INTERVAL,
+)
+
+# Only user data (the meal drafts) and conversation states are kept
+STORE_DATA = PersistenceInput(bot_data=False, chat_data=False, callback_data=False)
+
+USER_DATA = "user_data"
+
+
+def _conversation_kind(name: str) -> str:
+    """State kind of a conversation handler"""
+    return f"conversation:{name}"
+
+
+class DatabasePersistence(BasePersistence):
+    """
+    Keeps user data and conversation states in the bot_state table, one row
+    per user or conversation, written as they change
+    """
+
+    def __init__(self, max_age: timedelta = None, update_interval: float = 60):
+        """
+        Args:
+            max_age: Entries not updated for this long are not loaded
+            update_interval: Seconds between writes of changed entries
+        """
+        super().__init__(store_data=STORE_DATA, update_interval=update_interval)
+        self.max_age = max_age
+
+    async def get_user_data(self) -> dict:
+        data = await load_bot_state(USER_DATA, self.max_age)
+        return {int(user_id): user_data for user_id, user_data in data.items()}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        states = await load_bot_state(_conversation_kind(name), self.max_age)
+        return {tuple(json.loads(key)): state for key, state in states.items()}
+
+    async def update_conversation(self, name: str, key: tuple, new_state):
+        kind = _conversation_kind(name)
+        if new_state is None:
+            await delete_bot_state(kind, json.dumps(key))
+        else:
+            await save_bot_state(kind, json.dumps(key), new_state)
+
+    async def update_user_data(self, user_id: int, data: dict):
+        if data:
+            await save_bot_state(USER_DATA, str(user_id), data)
+        else:
+            await delete_bot_state(USER_DATA, str(user_id))
+
+    async def drop_user_data(self, user_id: int):
+        await delete_bot_state(USER_DATA, str(user_id))
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def flush(self):
+        # Every change is written when it is reported
+        pass
+
+
+def build_persistence() -> BasePersistence:
+    """
+    Create the state backend chosen by STATE_BACKEND
+    Returns:
+        BasePersistence: The backend, or None to keep state in memory only
+    """
+    if STATE_BACKEND == "database":
+        max_age = timedelta(minutes=DRAFT_TTL_MINUTES) if DRAFT_TTL_MINUTES else None
+        return DatabasePersistence(max_age, STATE_UPDATE_INTERVAL)
+    if STATE_BACKEND == "file":
+        return PicklePersistence(
+            STATE_FILE, store_data=STORE_DATA, update_interval=STATE_UPDATE_INTERVAL
+        )
+    return None
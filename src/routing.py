@@ -0,0 +1,159 @@
+"""Per-task model routing with fallback chains and per-route metrics."""
+
+import functools
+import logging
+import time
+
+from config import MODEL_ROUTES, OPENAI_FALLBACK_TIMEOUT
+from openai_client import RETRYABLE_ERRORS, CircuitOpenError, call_openai
+from usage import check_token_budget, record_usage, usage_tokens
+
+# Counters per route since start
+_stats = {}
+
+
+def primary_model(route: str) -> str:
+    """Get the first model of a route's chain"""
+    return MODEL_ROUTES[route][0]
+
+
+def _route_stats(route: str) -> dict:
+    """Get the counters of a route, creating them on first use"""
+    if route not in _stats:
+        _stats[route] = {
+            "calls": 0,
+            "failures": 0,
+            "fallbacks": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "models": {},
+        }
+    return _stats[route]
+
+
+async def _record(
+    route: str,
+    model: str,
+    started: float,
+    usage,
+    username: str,
+    images: int,
+    audio_seconds: float,
+):
+    """Account for a successful call in the route's counters and usage table"""
+    latency = time.monotonic() - started
+    stats = _route_stats(route)
+    stats["calls"] += 1
+    stats["latency_total"] += latency
+    stats["latency_max"] = max(stats["latency_max"], latency)
+    stats["models"][model] = stats["models"].get(model, 0) + 1
+
+    tokens = ""
+    if usage is not None:
+        prompt_tokens, completion_tokens = usage_tokens(usage)
+        stats["prompt_tokens"] += prompt_tokens
+        stats["completion_tokens"] += completion_tokens
+        tokens = f", tokens {prompt_tokens}/{completion_tokens}"
+    logging.info(f"OpenAI route {route}: {model} in {latency:.2f}s{tokens}")
+
+    await record_usage(
+        username,
+        route,
+        model,
+        usage,
+        images=images,
+        audio_seconds=audio_seconds,
+        latency=latency,
+    )
+
+
+async def _tracked_stream(stream, record):
+    """Pass a response stream through and account for it once it ends"""
+    usage = None
+    try:
+        async for chunk in stream:
+            # With stream_options.include_usage the last chunk carries usage
+            usage = getattr(chunk, "usage", None) or usage
+            yield chunk
+    finally:
+        await record(usage)
+
+
+async def call_route(
+    route: str,
+    func,
+    username: str = None,
+    images: int = 0,
+    audio_seconds: float = 0,
+    **kwargs,
+):
+    """
+    Call an OpenAI API method with the models of a route, falling back to
+    the next model when one is rate-limited, slow, failing or paused
+    Args:
+        route: Task name, a key of MODEL_ROUTES
+        func: Client coroutine method, e.g. client.chat.completions.create
+        username: User the call is made for; checked against the daily
+            token budget and recorded with the usage
+        images: Number of images sent, for the usage record
+        audio_seconds: Length of the audio sent, for the usage record
+        **kwargs: Arguments for func except `model`
+    Returns:
+        The API response of the first model that answered; a stream is
+        accounted for when it has been read to the end
+    Raises:
+        TokenBudgetExceeded: If the user is over the daily token budget
+    """
+    await check_token_budget(username)
+
+    models = MODEL_ROUTES[route]
+    # Latency includes time lost on models that failed over
+    started = time.monotonic()
+    for index, model in enumerate(models):
+        has_fallback = index < len(models) - 1
+        try:
+            # With a fallback available, fail over instead of waiting
+            response = await call_openai(
+                model,
+                func,
+                retries=0 if has_fallback else None,
+                deadline=OPENAI_FALLBACK_TIMEOUT if has_fallback else None,
+                **kwargs,
+            )
+        except (*RETRYABLE_ERRORS, CircuitOpenError) as e:
+            if not has_fallback:
+                _route_stats(route)["failures"] += 1
+                raise
+            _route_stats(route)["fallbacks"] += 1
+            logging.warning(
+                f"OpenAI route {route}: {model} failed ({type(e).__name__}), "
+                f"falling back to {models[index + 1]}"
+            )
+            continue
+
+        record = functools.partial(
+            _record,
+            route,
+            model,
+            started,
+            username=username,
+            images=images,
+            audio_seconds=audio_seconds,
+        )
+        if kwargs.get("stream"):
+            return _tracked_stream(response, record)
+        await record(getattr(response, "usage", None))
+        return response
+
+
+def get_route_stats() -> dict:
+    """
+    Get routing counters
+    Returns:
+        dict: Per route: calls, failures, fallbacks, latency_total and
+            latency_max in seconds, prompt_tokens, completion_tokens and
+            calls per model
+    """
+    return {route: dict(stats) for route, stats in _stats.items()}
@@ -0,0 +1,125 @@
+"""Persistent, idempotent scheduled jobs.
+
+Instead of long-sleeping loops, a short periodic tick asks for the most
+recent fire time of each job and runs it if the database says that run has
+not completed yet. Missed runs are caught up on the first tick after a
+restart, and a lease, renewed while the run lasts, keeps concurrent ticks
+(or instances) from running the same fire time twice. A run that failed
+midway is retried for the users it hasn't reached yet.
+"""
+
+import asyncio
+import contextvars
+import logging
+from datetime import datetime, time, timedelta
+
+import pytz
+
+from async_database import (
+    claim_scheduled_job,
+    renew_scheduled_job,
+    finish_scheduled_job,
+    get_job_deliveries,
+    save_job_deliveries,
+)
+from config import JOB_LEASE_MINUTES
+
+# Jobs with a run in progress in this process
+_running = set()
+
+# (name, fire_time) of the scheduled run the current task belongs to
+_current_run = contextvars.ContextVar("current_run", default=None)
+
+
+def last_fire_time(
+    timezone: str, hour: int, weekday: int = None, now: datetime = None
+) -> datetime:
+    """
+    Get the most recent fire time of a daily or weekly schedule
+    Args:
+        timezone: Name of the timezone the schedule is defined in
+        hour: Local hour of the day the job fires at
+        weekday: Day of the week (Monday is 0) for weekly jobs, None for daily
+        now: Current moment (defaults to now)
+    Returns:
+        datetime: Aware datetime of the latest fire time not after now
+    """
+    tz = pytz.timezone(timezone)
+    local_now = (now or datetime.now(pytz.utc)).astimezone(tz)
+
+    day = local_now.date()
+    if tz.localize(datetime.combine(day, time(hour))) > local_now:
+        day -= timedelta(days=1)
+    if weekday is not None:
+        day -= timedelta(days=(day.weekday() - weekday) % 7)
+    return tz.localize(datetime.combine(day, time(hour)))
+
+
+async def run_scheduled_job(application, name: str, fire_time: datetime, callback):
+    """
+    Run callback(application, fire_time) in the background unless this fire
+    time has already been handled or the job is still running
+    Args:
+        application: Telegram application
+        name: Unique job name
+        fire_time: Fire time to run for, from last_fire_time()
+        callback: Coroutine function doing the actual work
+    Returns:
+        bool: True if the run was started
+    """
+    if name in _running:
+        return False
+    lease = timedelta(minutes=JOB_LEASE_MINUTES)
+    if not await claim_scheduled_job(name, fire_time, lease):
+        return False
+    _running.add(name)
+
+    async def keep_lease():
+        # Renew well before expiry, so a long run is never claimed again
+        while True:
+            await asyncio.sleep(lease.total_seconds() / 3)
+            await renew_scheduled_job(name, lease)
+
+    async def run():
+        logging.info(f"Running scheduled job {name} for {fire_time}")
+        _current_run.set((name, fire_time))
+        renewal = asyncio.create_task(keep_lease())
+        try:
+            await callback(application, fire_time)
+        except Exception as e:
+            logging.error(f"Error in scheduled job {name}: {str(e)}")
+            # Release the claim so the next tick retries
+            await finish_scheduled_job(name)
+            return
+        finally:
+            renewal.cancel()
+            _running.discard(name)
+        await finish_scheduled_job(name, fire_time)
+
+    application.create_task(run())
+    return True
+
+
+async def undelivered(usernames: list) -> list:
+    """
+    Drop the users the current scheduled run has already reached, e.g.
+    before a crash; outside of a scheduled run all users are kept
+    Args:
+        usernames: Users the run is about to message
+    Returns:
+        list: Users still to message
+    """
+    run = _current_run.get()
+    if run is None:
+        return list(usernames)
+    delivered = await get_job_deliveries(*run)
+    if delivered:
+        logging.info(f"Skipping {len(delivered)} users already reached by {run[0]}")
+    return [username for username in usernames if username not in delivered]
+
+
+async def mark_delivered(*usernames: str):
+    """Remember that the current scheduled run has reached users"""
+    run = _current_run.get()
+    if run is not None and usernames:
+        await save_job_deliveries(*run, usernames)
@@ -0,0 +1,123 @@
+"""Progressive rendering of streamed model output into a Telegram message."""
+
+import asyncio
+import html
+import logging
+import re
+
+from telegram.error import BadRequest, RetryAfter
+
+# Telegram's limit on the length of one message
+MESSAGE_LIMIT = 4096
+
+_TAG = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^>]*>")
+
+
+def close_html(text: str) -> str:
+    """
+    Make a partial HTML text valid for Telegram
+    Args:
+        text: Beginning of an HTML text
+    Returns:
+        str: The text without a trailing cut-off tag or entity and with
+            all tags still open at its end closed
+    """
+    text = re.sub(r"<[^>]*$", "", text)
+    text = re.sub(r"&[#\w]*$", "", text)
+
+    open_tags = []
+    for match in _TAG.finditer(text):
+        closing, name = match.group(1), match.group(2).lower()
+        if not closing:
+            open_tags.append(name)
+        elif name in open_tags:
+            # Close the innermost matching tag and anything opened inside it
+            del open_tags[len(open_tags) - 1 - open_tags[::-1].index(name) :]
+    return text + "".join(f"</{name}>" for name in reversed(open_tags))
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> list:
+    """
+    Split a text into messages within Telegram's length limit
+    Args:
+        text: Text to split, preferably at line breaks
+        limit: Maximum length of one message
+    Returns:
+        list: Message texts
+    """
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    chunks.append(text)
+    return chunks
+
+
+async def _send_html(send, text: str):
+    """
+    Send or edit a message as HTML, as plain text if Telegram rejects the markup
+    Args:
+        send: Coroutine function (text, parse_mode=...) such as edit_text
+        text: HTML text
+    """
+    for _ in range(3):
+        try:
+            await send(text, parse_mode="HTML")
+            return
+        except RetryAfter as e:
+            await asyncio.sleep(float(e.retry_after))
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            logging.warning(f"Sending HTML failed: {str(e)}; sending plain text")
+            await send(html.unescape(re.sub(r"<[^>]+>", "", text)))
+            return
+
+
+async def stream_reply(message, deltas, prefix: str = "", interval: float = 1.0) -> str:
+    """
+    Show streamed text by repeatedly editing a message as it arrives
+    Args:
+        message: Bot's message to edit, e.g. the "Анализирую..." status
+        deltas: Async iterator of text pieces
+        prefix: HTML placed before the streamed text
+        interval: Minimum seconds between edits (Telegram rate-limits edits)
+    Returns:
+        str: The complete streamed text, empty if nothing arrived
+    """
+    loop = asyncio.get_running_loop()
+    text = ""
+    shown = None
+    next_edit = 0.0
+
+    async for delta in deltas:
+        text += delta
+        now = loop.time()
+        if now < next_edit:
+            continue
+
+        rendered = close_html(prefix + text)
+        if rendered == shown or len(rendered) > MESSAGE_LIMIT:
+            continue
+        next_edit = now + interval
+        try:
+            await message.edit_text(rendered, parse_mode="HTML")
+            shown = rendered
+        except RetryAfter as e:
+            next_edit = now + float(e.retry_after)
+        except BadRequest as e:
+            # A partial text can still be invalid; the next edit may fix it
+            logging.debug(f"Skipping streamed edit: {str(e)}")
+
+    if not text:
+        return ""
+
+    # Final text, continued in new messages if it outgrew the first one
+    chunks = split_message(prefix + text)
+    await _send_html(message.edit_text, chunks[0])
+    for chunk in chunks[1:]:
+        await _send_html(message.chat.send_message, chunk)
+    return text
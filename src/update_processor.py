@@ -0,0 +1,127 @@
+"""Concurrent update processing that keeps each user's updates in order."""
+
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def ordering_key(update: object):
+    """
+    Get the key whose updates must be processed one after another
+    Returns:
+        tuple: ("user", id) or ("chat", id), None for updates of neither
+    """
+    if isinstance(update, Update):
+        if update.effective_user:
+            return "user", update.effective_user.id
+        if update.effective_chat:
+            return "chat", update.effective_chat.id
+        return None
+    # Events the bot queues itself, e.g. a complete album, carry the user
+    user_id = getattr(update, "user_id", None)
+    if user_id is not None:
+        return "user", user_id
+    return None
+
+
+class UpdateQueue(asyncio.Queue):
+    """
+    Application update queue that applies backpressure: put() waits while
+    max_in_flight updates are queued or being processed, which holds back
+    polling and keeps webhook requests open, so Telegram slows down
+    """
+
+    def __init__(self, max_in_flight: int):
+        super().__init__()
+        self.max_in_flight = max_in_flight
+        self._admission = asyncio.Semaphore(max_in_flight)
+        # Ids of queued or running updates that hold an admission
+        self._admitted = set()
+        # Whether intake is held back, to log once per overload
+        self._paused = False
+
+    @property
+    def in_flight(self) -> int:
+        """Number of updates queued or being processed"""
+        return len(self._admitted)
+
+    async def put(self, item):
+        if isinstance(item, Update):
+            if self._admission.locked() and not self._paused:
+                self._paused = True
+                logging.warning(
+                    f"{self.in_flight} updates in flight, pausing intake of updates"
+                )
+            await self._admission.acquire()
+            self._admitted.add(id(item))
+        await super().put(item)
+
+    def finish(self, update: object):
+        """Free the admission of a processed update"""
+        if id(update) in self._admitted:
+            self._admitted.discard(id(update))
+            self._admission.release()
+            if self._paused and not self._admission.locked():
+                self._paused = False
+                logging.info("Resumed intake of updates")
+
+
+# Limit given to the base class, whose semaphore PTB takes before
+# do_process_update. Updates waiting for their user's turn must not hold
+# handler slots, so the real limit is applied in do_process_update, and the
+# number of updates in flight is bounded by the UpdateQueue
+_UNLIMITED = 2**31 - 1
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users in parallel, up to
+    max_concurrent_updates at a time, while the updates of one user (album
+    photos, texts, button presses) run one by one in the order they came,
+    so they never race on the user's draft or conversation state.
+    The max_concurrent_updates attribute of the base class is not that limit
+    """
+
+    def __init__(self, max_concurrent_updates: int, queue: UpdateQueue = None):
+        """
+        Args:
+            max_concurrent_updates: Updates processed at the same time
+            queue: Application's update queue, told when an update is done
+        """
+        super().__init__(_UNLIMITED)
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        self._handler_slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self.queue = queue
+        # Completion of the last update queued per ordering key
+        self._tails = {}
+
+    async def do_process_update(self, update: object, coroutine):
+        # Wait for the user's turn before taking a slot, so a user with many
+        # queued updates doesn't hold slots other users could run in
+        key = ordering_key(update)
+        previous = self._tails.get(key) if key is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._tails[key] = done
+        try:
+            if previous is not None:
+                # wait() rather than await, so a cancelled update doesn't
+                # cancel the one it waits for
+                await asyncio.wait([previous])
+            async with self._handler_slots:
+                await coroutine
+        finally:
+            done.set_result(None)
+            if key is not None and self._tails.get(key) is done:
+                del self._tails[key]
+            if self.queue is not None:
+                self.queue.finish(update)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
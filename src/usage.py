@@ -0,0 +1,113 @@
+"""Token and cost accounting of OpenAI calls, with optional daily budgets."""
+
+from async_database import get_tokens_used, save_usage
+from config import AUDIO_PRICES, MODEL_PRICES, USER_DAILY_TOKEN_BUDGET
+
+
+class TokenBudgetExceeded(Exception):
+    """Raised before a call for a user who has used up today's tokens"""
+
+
+def _price(prices: dict, model: str):
+    """Find the price of a model by the longest matching name prefix"""
+    for name in sorted(prices, key=len, reverse=True):
+        if model.startswith(name):
+            return prices[name]
+    return None
+
+
+def estimate_cost(
+    model: str,
+    prompt_tokens: int,
+    completion_tokens: int,
+    audio_seconds: float = 0,
+    batch: bool = False,
+) -> float:
+    """
+    Estimate the cost of a call
+    Args:
+        model: Model that answered
+        prompt_tokens: Input tokens
+        completion_tokens: Output tokens
+        audio_seconds: Length of transcribed audio
+        batch: Whether the call was made through the Batch API
+    Returns:
+        float: Cost in USD, 0 for models without a known price
+    """
+    cost = 0.0
+    token_prices = _price(MODEL_PRICES, model)
+    if token_prices:
+        input_price, output_price = token_prices
+        cost += (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+    audio_price = _price(AUDIO_PRICES, model)
+    if audio_price:
+        cost += audio_seconds / 60 * audio_price
+    return cost / 2 if batch else cost
+
+
+def usage_tokens(usage) -> tuple:
+    """
+    Read token counts from an API usage object or its dict form
+    Returns:
+        tuple: (prompt_tokens, completion_tokens), zeros if usage is None
+    """
+    if usage is None:
+        return 0, 0
+    if isinstance(usage, dict):
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    return usage.prompt_tokens, usage.completion_tokens
+
+
+async def check_token_budget(username: str):
+    """
+    Refuse a call for a user over the daily token budget
+    Raises:
+        TokenBudgetExceeded: If the user has used USER_DAILY_TOKEN_BUDGET
+            tokens today
+    """
+    if not username or USER_DAILY_TOKEN_BUDGET <= 0:
+        return
+    used = await get_tokens_used(username)
+    if used >= USER_DAILY_TOKEN_BUDGET:
+        raise TokenBudgetExceeded(
+            f"@{username} used {used} of {USER_DAILY_TOKEN_BUDGET} tokens today"
+        )
+
+
+async def record_usage(
+    username: str,
+    call_type: str,
+    model: str,
+    usage=None,
+    images: int = 0,
+    audio_seconds: float = 0,
+    latency: float = None,
+    batch: bool = False,
+):
+    """
+    Store the tokens and estimated cost of a call
+    Args:
+        username: User the call was made for, or None
+        call_type: Model route of the call
+        model: Model that answered
+        usage: API usage object or dict, None if the API reported none
+        images: Number of images sent
+        audio_seconds: Length of transcribed audio
+        latency: Call duration in seconds
+        batch: Whether the call was made through the Batch API
+    """
+    prompt_tokens, completion_tokens = usage_tokens(usage)
+    cost = estimate_cost(
+        model, prompt_tokens, completion_tokens, audio_seconds, batch=batch
+    )
+    await save_usage(
+        username,
+        call_type,
+        model,
+        prompt_tokens,
+        completion_tokens,
+        images,
+        audio_seconds,
+        latency,
+        cost,
+    )
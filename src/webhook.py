@@ -0,0 +1,107 @@
+"""Webhook mode: Telegram posts updates to an ASGI app served by uvicorn.
+
+Needs the `starlette` and `uvicorn` packages, which polling mode does not.
+"""
+
+import logging
+import secrets
+from collections import deque
+from http import HTTPStatus
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+from telegram.ext import Application
+
+from config import (
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_MAX_CONNECTIONS,
+)
+
+# Number of recent update ids remembered to drop redeliveries
+RECENT_UPDATE_IDS = 10000
+
+
+def create_asgi_app(application: Application, secret_token: str) -> Starlette:
+    """
+    Build the ASGI app receiving Telegram's webhook requests
+    Args:
+        application: Bot application the updates are queued for
+        secret_token: Value Telegram sends in X-Telegram-Bot-Api-Secret-Token
+    Returns:
+        Starlette: App with the webhook and a health check route
+    """
+    # Telegram sends an update again when its request isn't answered in
+    # time, which happens while the update queue holds a request back
+    recent_ids = set()
+    recent_order = deque()
+
+    async def telegram(request: Request) -> Response:
+        """Queue an update posted by Telegram"""
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+            return Response(status_code=HTTPStatus.FORBIDDEN)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception as e:
+            logging.error(f"Error parsing webhook update: {str(e)}")
+            return Response(status_code=HTTPStatus.BAD_REQUEST)
+        if update.update_id in recent_ids:
+            logging.info(f"Dropped redelivered update {update.update_id}")
+            return Response()
+        recent_ids.add(update.update_id)
+        recent_order.append(update.update_id)
+        if len(recent_order) > RECENT_UPDATE_IDS:
+            recent_ids.discard(recent_order.popleft())
+
+        # Answer once queued, the update is processed by the application
+        await application.update_queue.put(update)
+        return Response()
+
+    async def health(_: Request) -> PlainTextResponse:
+        """Report that the bot is up, for load balancers and monitoring"""
+        return PlainTextResponse("ok")
+
+    return Starlette(
+        routes=[
+            Route(f"/{WEBHOOK_PATH}", telegram, methods=["POST"]),
+            Route("/health", health, methods=["GET"]),
+        ]
+    )
+
+
+async def run_webhook(application: Application):
+    """
+    Register the webhook with Telegram and serve it until the process stops
+    Args:
+        application: Bot application with its handlers added
+    """
+    # Without a configured secret a new one is set with each start
+    secret_token = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = uvicorn.Server(
+        uvicorn.Config(
+            create_asgi_app(application, secret_token),
+            host=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            use_colors=False,
+        )
+    )
+
+    async with application:
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        await application.start()
+        try:
+            await server.serve()
+        finally:
+            await application.stop()
@@ -0,0 +1,120 @@
+"""Shared test setup.
+
+The bot's modules read their settings and open the database when they are
+imported, so the environment is set up here, before any test imports them:
+a throwaway SQLite database and dummy credentials.
+"""
+
+import io
+import os
+import random
+import sys
+import tempfile
+
+import pytest
+from PIL import Image, ImageDraw, ImageFilter
+
+_data_dir = tempfile.mkdtemp(prefix="calorie-bot-tests-")
+os.environ.update(
+    TELEGRAM_TOKEN="123:test",
+    OPENAI_API_KEY="sk-test",
+    DATABASE_URL=f"sqlite:///{_data_dir}/test.db",
+    ALLOWED_USERS="alice,bob,carol",
+    STATE_BACKEND="memory",
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: measures the bot at production-like scale (slow)"
+    )
+
+
+@pytest.fixture
+def db():
+    """The database module, emptied after the test"""
+    import database
+
+    yield database
+    with database.engine.begin() as conn:
+        for table in reversed(database.Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    database._goals_cache.clear()
+    database._weight_goal_cache.clear()
+
+
+@pytest.fixture
+def offline_bot(monkeypatch):
+    """Let an Application start without contacting Telegram"""
+    from telegram import User
+    from telegram.ext import ExtBot
+
+    async def initialize(self):
+        self._bot_user = User(1, "bot", True, username="bot")
+
+    async def shutdown(self):
+        pass
+
+    monkeypatch.setattr(ExtBot, "initialize", initialize)
+    monkeypatch.setattr(ExtBot, "shutdown", shutdown)
+
+
+@pytest.fixture
+def scratch_db(tmp_path, monkeypatch):
+    """The database module on a fresh SQLite file of its own, for bulk data"""
+    import database
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    engine = create_engine(f"sqlite:///{tmp_path}/scratch.db")
+    database.Base.metadata.create_all(engine)
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(database, "SessionLocal", sessionmaker(bind=engine))
+    yield database
+    engine.dispose()
+    database._goals_cache.clear()
+    database._weight_goal_cache.clear()
+
+
+def _food_photo(size: tuple, seed: int) -> bytes:
+    """A JPEG shaped like a phone photo of a plate, with EXIF"""
+    rnd = random.Random(seed)
+    width, height = size
+    image = Image.new("RGB", size, (200 + rnd.randrange(40), 190, 170))
+    draw = ImageDraw.Draw(image)
+    plate = min(size) * 0.4
+    center = (width / 2, height / 2)
+    draw.ellipse(
+        [center[0] - plate, center[1] - plate, center[0] + plate, center[1] + plate],
+        fill=(240, 240, 235),
+    )
+    for _ in range(60):
+        x = center[0] + rnd.uniform(-plate, plate) * 0.7
+        y = center[1] + rnd.uniform(-plate, plate) * 0.7
+        radius = rnd.uniform(0.02, 0.08) * min(size)
+        draw.ellipse(
+            [x - radius, y - radius, x + radius, y + radius],
+            fill=(
+                rnd.randrange(90, 220),
+                rnd.randrange(60, 160),
+                rnd.randrange(20, 90),
+            ),
+        )
+    # Sensor grain, softened the way a camera pipeline does
+    grain = Image.effect_noise(size, 40).convert("RGB").filter(ImageFilter.BLUR)
+    image = Image.blend(image, grain, 0.15)
+
+    exif = Image.Exif()
+    exif[0x0110] = "Phone camera"  # Model
+    exif[0x0112] = 1  # Orientation
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=92, exif=exif)
+    return output.getvalue()
+
+
+@pytest.fixture
+def food_photo():
+    """Make a generated food photo of a size, different for each seed"""
+    return _food_photo
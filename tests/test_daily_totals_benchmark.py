@@ -0,0 +1,107 @@
+"""Benchmark: calorie totals from the daily rollup vs summing the meals.
+
+A year of meals for thousands of users. The old way loaded every meal of
+the day (with its HTML response) as an ORM row and summed in Python; run
+with -s to see the timings.
+"""
+
+import random
+import time
+from datetime import date, timedelta
+
+import pytest
+
+USERS = 2000
+DAYS = 365
+MEALS_PER_DAY = 3
+SAMPLED_USERS = 200
+
+RESPONSE = "<b>Гречка с курицей</b>\n" + "Описание блюда и его состава. " * 10
+
+
+def old_daily_calories(database, username: str, target_date: date) -> float:
+    """get_daily_calories as it was before the rollup"""
+    session = database.SessionLocal()
+    try:
+        records = (
+            session.query(database.DailyData)
+            .filter(database.DailyData.username == username)
+            .filter(database.DailyData.date == target_date)
+            .all()
+        )
+        return sum(record.calories or 0 for record in records)
+    finally:
+        session.close()
+
+
+def fill_year(database, today: date):
+    """Insert a year of meals of every user and build the rollup from them"""
+    rnd = random.Random(2)
+    with database.engine.begin() as conn:
+        # Straight to the driver: the ORM would spend minutes on two million rows
+        conn.exec_driver_sql(
+            "INSERT INTO daily_data "
+            "(date, time, username, gpt_response, calories, protein, fat, carbs) "
+            "VALUES (?, ?, ?, ?, ?, 20, 15, 60)",
+            [
+                (
+                    (today - timedelta(days=day)).isoformat(),
+                    f"{8 + 5 * meal:02d}:00:00.000000",
+                    f"user{user}",
+                    RESPONSE,
+                    rnd.randint(200, 900),
+                )
+                for day in range(DAYS)
+                for user in range(USERS)
+                for meal in range(MEALS_PER_DAY)
+            ],
+        )
+        conn.execute(database._insert_daily_totals())
+
+
+def timed(func, calls: list) -> tuple:
+    """Run func over the argument tuples; returns (results, seconds)"""
+    started = time.perf_counter()
+    results = [func(*args) for args in calls]
+    return results, time.perf_counter() - started
+
+
+@pytest.mark.benchmark
+def test_totals_from_the_rollup_beat_summing_a_year_of_meals(scratch_db):
+    database = scratch_db
+    today = date.today()
+    fill_year(database, today)
+    users = [
+        f"user{user}" for user in random.Random(3).sample(range(USERS), SAMPLED_USERS)
+    ]
+    week_start = today - timedelta(days=6)
+
+    # /calories and /analyze: today's total
+    calls = [(database, username, today) for username in users]
+    old, old_seconds = timed(old_daily_calories, calls)
+    new, new_seconds = timed(database.get_daily_calories, [args[1:] for args in calls])
+    assert new == old
+
+    # A week of per-day totals: seven old queries vs one range query
+    week_calls = [
+        (database, username, week_start + timedelta(days=i))
+        for username in users
+        for i in range(7)
+    ]
+    old_week, old_week_seconds = timed(old_daily_calories, week_calls)
+    new_week, new_week_seconds = timed(
+        database.get_totals_by_day, [(username, week_start, 7) for username in users]
+    )
+    assert [day["calories"] for days in new_week for day in days.values()] == old_week
+
+    print(
+        f"\n{USERS} users x {DAYS} days x {MEALS_PER_DAY} meals, "
+        f"{len(users)} users sampled"
+        f"\n  day total:  old {old_seconds * 1000 / len(users):.2f} ms, "
+        f"new {new_seconds * 1000 / len(users):.2f} ms per user"
+        f"\n  week:       old {old_week_seconds * 1000 / len(users):.2f} ms, "
+        f"new {new_week_seconds * 1000 / len(users):.2f} ms per user"
+    )
+    # A single day's meals are few, so the gain there is mostly in bytes read;
+    # a range pays one round-trip instead of one per day
+    assert new_week_seconds < old_week_seconds / 2
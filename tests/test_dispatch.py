@@ -0,0 +1,31 @@
+import asyncio
+
+from dispatch import RateLimiter, fan_out
+
+
+def test_concurrent_fan_outs_share_one_send_rate():
+    limiter = RateLimiter(20)
+    sent = []
+
+    async def prepare(username):
+        return f"hello {username}"
+
+    async def deliver(username, message):
+        sent.append(asyncio.get_running_loop().time())
+
+    async def scenario():
+        # Two timezone buckets firing at the same moment
+        return await asyncio.gather(
+            fan_out([f"a{i}" for i in range(10)], prepare, deliver, 5, limiter),
+            fan_out([f"b{i}" for i in range(10)], prepare, deliver, 5, limiter),
+        )
+
+    first, second = asyncio.run(scenario())
+
+    assert set(first.values()) == set(second.values()) == {"sent"}
+    assert len(sent) == 20
+    sent.sort()
+    # 20 sends at 20 per second together, not 20 per second each
+    assert sent[-1] - sent[0] >= 0.9
+    for earlier, later in zip(sent, sent[1:]):
+        assert later - earlier >= 0.04
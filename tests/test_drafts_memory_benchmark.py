@@ -0,0 +1,123 @@
+"""Benchmark: memory held by 5k pending meal drafts.
+
+Drafts used to keep each photo as a base64 string of the original; they now
+keep the Telegram file id and perceptual hash, with encoded photos in a
+bounded cache. Run with -s to see the numbers.
+"""
+
+import asyncio
+import base64
+import tracemalloc
+from collections import OrderedDict
+
+import pytest
+
+import main
+from config import PHOTO_CACHE_SIZE
+
+DRAFTS = 5000
+PHOTOS_PER_DRAFT = 3
+# Base64 drafts are measured on a sample and scaled, to spare the test
+# machine gigabytes
+OLD_SAMPLE = 500
+
+
+class FakeBot:
+    """Serves the same few photos for any file id"""
+
+    def __init__(self, photos: list):
+        self.photos = photos
+
+    async def get_file(self, file_id: str):
+        photo = self.photos[int(file_id[-1]) % len(self.photos)]
+
+        class TelegramFile:
+            async def download_to_memory(self, buffer):
+                buffer.write(photo)
+
+        return TelegramFile()
+
+
+def file_id(draft: int, photo: int) -> str:
+    """A file id shaped like Telegram's"""
+    return (
+        f"AgACAgIAAxkBAAI{draft:08d}ZmVhc3RfcGhvdG9fZmlsZV9pZF9wYWRkaW5nX3RleHQ{photo}"
+    )
+
+
+def measure(build) -> tuple:
+    """
+    Run build under tracemalloc
+    Returns:
+        tuple: (what build returned, bytes still allocated by it)
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.benchmark
+def test_5k_drafts_hold_references_not_photos(monkeypatch, food_photo):
+    monkeypatch.setattr(main, "_photo_cache", OrderedDict())
+    photos = [food_photo((1600, 1200), seed) for seed in range(PHOTOS_PER_DRAFT)]
+    bot = FakeBot(photos)
+
+    def old_drafts():
+        return [
+            {
+                "photos_base64": [
+                    base64.b64encode(photo).decode("utf-8") for photo in photos
+                ],
+                "additional_info": ["гречка с курицей, 200 г"],
+                "has_voice": False,
+            }
+            for _ in range(OLD_SAMPLE)
+        ]
+
+    def new_drafts():
+        async def download():
+            return await asyncio.gather(
+                *[
+                    main._download_photo(bot, file_id(draft, photo))
+                    for draft in range(PHOTO_CACHE_SIZE // PHOTOS_PER_DRAFT + 1)
+                    for photo in range(PHOTOS_PER_DRAFT)
+                ]
+            )
+
+        # The photos recently sent are kept encoded, up to the cache size
+        prepared = asyncio.run(download())
+        drafts = []
+        for draft in range(DRAFTS):
+            user_data = {
+                "photo_ids": [],
+                "photo_hashes": [],
+                "additional_info": ["гречка с курицей, 200 г"],
+                "has_voice": False,
+            }
+            for photo in range(PHOTOS_PER_DRAFT):
+                assert main._add_prepared_photo(
+                    user_data, file_id(draft, photo), prepared[photo][1]
+                )
+            drafts.append(user_data)
+        return drafts
+
+    old, old_sample_bytes = measure(old_drafts)
+    old_bytes = old_sample_bytes * DRAFTS // OLD_SAMPLE
+    del old
+    new, new_bytes = measure(new_drafts)
+
+    assert len(new) == DRAFTS
+    assert len(main._photo_cache) == PHOTO_CACHE_SIZE
+    print(
+        f"\n{DRAFTS} drafts of {PHOTOS_PER_DRAFT} photos 1600x1200 "
+        f"({len(photos[0]) // 1024} KiB each)"
+        f"\n  base64 drafts:      {old_bytes / 2**20:8.1f} MiB "
+        f"(scaled from {OLD_SAMPLE})"
+        f"\n  references + cache: {new_bytes / 2**20:8.1f} MiB "
+        f"({PHOTO_CACHE_SIZE} photos cached)"
+    )
+    assert new_bytes < old_bytes / 20
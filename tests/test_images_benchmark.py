@@ -0,0 +1,155 @@
+"""Benchmark: bytes, encode time and model latency of photos before and after
+preprocessing.
+
+The fixture photos are generated: camera-like food shots (a plate with
+grainy texture, saved with EXIF) at the sizes Telegram delivers. The fake
+OpenAI server reads each request at UPLINK_BYTES_PER_SECOND, so latency
+follows what is sent. Run with -s to see the table.
+"""
+
+import asyncio
+import base64
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+import openai_client
+import openai_utils
+from config import IMAGE_MAX_EDGE
+from images import image_detail
+
+# A 10 Mbit/s uplink
+UPLINK_BYTES_PER_SECOND = 1_250_000
+
+PHOTO_SIZES = [(1280, 960), (960, 1280), (1280, 720), (2560, 1920), (800, 600)]
+
+ANALYSIS = {
+    "items": [{"name": "Гречка", "grams": 150, "calories": 165}],
+    "total": {"calories": 165, "protein": 6, "fat": 2, "carbs": 30},
+    "comment": "",
+}
+
+
+class SlowUplinkOpenAI:
+    """Chat completions endpoint that receives requests at a fixed rate"""
+
+    def __init__(self):
+        self.bodies = []
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                fake.bodies.append(json.loads(self.rfile.read(length)))
+                time.sleep(length / UPLINK_BYTES_PER_SECOND)
+                data = json.dumps(
+                    {
+                        "id": "chatcmpl-test",
+                        "object": "chat.completion",
+                        "created": 0,
+                        "model": "test",
+                        "choices": [
+                            {
+                                "index": 0,
+                                "finish_reason": "stop",
+                                "message": {
+                                    "role": "assistant",
+                                    "content": json.dumps(ANALYSIS),
+                                },
+                            }
+                        ],
+                        "usage": {
+                            "prompt_tokens": 800,
+                            "completion_tokens": 60,
+                            "total_tokens": 860,
+                        },
+                    }
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v1"
+
+
+@pytest.fixture
+def slow_uplink_openai(monkeypatch):
+    fake = SlowUplinkOpenAI()
+    thread = threading.Thread(target=fake.server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(openai_client.client, "base_url", fake.url)
+    monkeypatch.setattr(openai_client, "_breakers", {})
+    monkeypatch.setattr(openai_client, "_semaphores", {})
+    yield fake
+    fake.server.shutdown()
+    fake.server.server_close()
+
+
+def run(photos: list, encode) -> dict:
+    """
+    Encode the photos and have them analyzed one by one
+    Returns:
+        dict: Totals of base64 bytes sent, encode seconds and analysis seconds
+    """
+    totals = {"bytes": 0, "encode": 0.0, "latency": 0.0}
+    for index, photo in enumerate(photos):
+        started = time.perf_counter()
+        encoded = encode(photo)
+        totals["encode"] += time.perf_counter() - started
+        totals["bytes"] += len(encoded)
+
+        started = time.perf_counter()
+        # A description per run keeps the analysis cache out of the way
+        asyncio.run(
+            openai_utils.analyze_image_with_gpt([encoded], f"{encode.__name__} {index}")
+        )
+        totals["latency"] += time.perf_counter() - started
+    return totals
+
+
+def raw_base64(photo: bytes) -> str:
+    """What encode_image did before preprocessing"""
+    return base64.b64encode(photo).decode("utf-8")
+
+
+@pytest.mark.benchmark
+def test_preprocessed_photos_are_smaller_and_faster_to_analyze(
+    slow_uplink_openai, db, food_photo
+):
+    photos = [food_photo(size, seed) for seed, size in enumerate(PHOTO_SIZES)]
+
+    before = run(photos, raw_base64)
+    after = run(photos, openai_utils.encode_image)
+
+    print(
+        f"\n{len(photos)} photos, uplink {UPLINK_BYTES_PER_SECOND * 8 // 10**6} Mbit/s"
+    )
+    for name, totals in (("before", before), ("after", after)):
+        print(
+            f"  {name:6}  {totals['bytes'] / 1024:7.0f} KiB base64  "
+            f"encode {totals['encode'] * 1000:6.0f} ms  "
+            f"analysis {totals['latency']:5.2f} s"
+        )
+
+    assert after["bytes"] < before["bytes"] / 2
+    assert after["latency"] < before["latency"]
+    # No EXIF left in what was sent, and the detail level was requested
+    for body in slow_uplink_openai.bodies[len(photos) :]:
+        image_part = body["messages"][0]["content"][1]["image_url"]
+        assert image_part["detail"] == image_detail()
+        sent = base64.b64decode(image_part["url"].split(",", 1)[1])
+        with Image.open(io.BytesIO(sent)) as image:
+            assert max(image.size) <= IMAGE_MAX_EDGE
+            assert not image.getexif()
@@ -0,0 +1,63 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+import main
+from constants import AWAITING_FEEDBACK
+from openai_client import CircuitOpenError
+
+
+def press(data: str, user_data: dict):
+    """Press an inline button of the meal draft; returns (state, replies)"""
+    replies = []
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    async def nothing(*args, **kwargs):
+        pass
+
+    query = SimpleNamespace(
+        data=data,
+        answer=nothing,
+        edit_message_reply_markup=nothing,
+        message=SimpleNamespace(reply_text=reply_text),
+    )
+    update = SimpleNamespace(
+        callback_query=query, effective_user=SimpleNamespace(id=1, username="alice")
+    )
+    context = SimpleNamespace(user_data=user_data)
+    return asyncio.run(main.button_callback(update, context)), replies
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        CircuitOpenError("OpenAI calls to gpt-4o are paused"),
+        openai.APIConnectionError(request=httpx.Request("POST", "http://openai")),
+        asyncio.TimeoutError(),
+    ],
+)
+def test_failed_analysis_is_reported_and_keeps_the_draft(monkeypatch, error):
+    async def analyze_meal(*args):
+        raise error
+
+    monkeypatch.setattr(main, "analyze_meal", analyze_meal)
+    user_data = {
+        "photo_ids": [],
+        "photo_hashes": [],
+        "additional_info": ["гречка с курицей"],
+        "has_voice": False,
+    }
+
+    state, replies = press("start_analysis", user_data)
+
+    assert state == AWAITING_FEEDBACK
+    assert replies[0] == "🔄 Начинаю анализ..."
+    assert "недоступен" in replies[1]
+    # The draft is kept and shown again with its buttons to retry
+    assert user_data["additional_info"] == ["гречка с курицей"]
+    assert len(replies) == 3
@@ -0,0 +1,168 @@
+"""Replays of interleaved albums: each one is analyzed once, in order, whole."""
+
+import asyncio
+import random
+
+import pytest
+import telegram
+from telegram import Update
+from telegram.ext import Application, ExtBot
+
+import main
+from media_groups import MediaGroupCollector
+
+
+def test_collector_closes_each_group_once_in_message_order():
+    rnd = random.Random(21)
+    closed = []
+
+    async def on_close(data, results, captions):
+        closed.append((data, results, captions))
+
+    async def process(part):
+        await asyncio.sleep(rnd.uniform(0, 0.05))
+        return part
+
+    # Three users' albums, parts delivered interleaved and out of order
+    albums = {
+        (1, "a"): [10, 11, 12],
+        (2, "b"): [20, 21, 22, 23],
+        (1, "c"): [30, 31],
+    }
+    parts = [(key, part) for key, album in albums.items() for part in album]
+    rnd.shuffle(parts)
+
+    async def scenario():
+        collector = MediaGroupCollector(0.2, 10, on_close)
+        for key, part in parts:
+            caption = f"caption {part}" if part % 10 == 0 else None
+            assert collector.add(key, part, process(part), caption, data=key)
+            await asyncio.sleep(rnd.uniform(0, 0.02))
+        await asyncio.sleep(0.5)
+        # A straggler of a closed album is dropped, not analyzed alone
+        assert not collector.add((1, "a"), 13, process(13))
+        await asyncio.sleep(0.3)
+
+    asyncio.run(scenario())
+
+    assert sorted(closed) == sorted(
+        (key, album, [f"caption {album[0]}"]) for key, album in albums.items()
+    )
+
+
+def test_collector_closes_a_full_group_at_once():
+    closed = []
+
+    async def on_close(data, results, captions):
+        closed.append(results)
+
+    async def process(part):
+        return part
+
+    async def scenario():
+        collector = MediaGroupCollector(10, 3, on_close)
+        for part in (3, 1, 2):
+            collector.add("album", part, process(part))
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    assert closed == [[1, 2, 3]]
+
+
+@pytest.fixture
+def bot_app(monkeypatch, offline_bot, db):
+    """The bot's application with the model and Telegram calls faked"""
+    analyses = []
+    sent = []
+    built = []
+
+    async def prepare_photo(bot, file_id):
+        await asyncio.sleep(random.uniform(0.01, 0.1))
+        return file_id, None
+
+    async def analyze_meal(context, username, photo_ids, photo_hashes, info):
+        analyses.append((username, list(photo_ids), info))
+        return main.MealAnalysis()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        sent.append(chat_id)
+
+    async def reply_text(self, *args, **kwargs):
+        pass
+
+    monkeypatch.setattr(main, "prepare_photo", prepare_photo)
+    monkeypatch.setattr(main, "analyze_meal", analyze_meal)
+    monkeypatch.setattr(main, "check_user_access", lambda *args: True)
+    monkeypatch.setattr(main.media_groups, "debounce", 0.3)
+    monkeypatch.setattr(ExtBot, "send_message", send_message)
+    monkeypatch.setattr(telegram.Message, "reply_text", reply_text)
+    monkeypatch.setattr(
+        Application, "run_polling", lambda self, *args, **kwargs: built.append(self)
+    )
+
+    main.main()
+    return built[-1], analyses, sent
+
+
+def message(update_id: int, user_id: int, text=None, album=None) -> dict:
+    """Update JSON of a private message with a text or an album photo"""
+    payload = {
+        "message_id": update_id,
+        "date": 0,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": "user",
+            "username": f"user{user_id}",
+        },
+    }
+    if album:
+        payload["media_group_id"] = album
+        payload["photo"] = [
+            {
+                "file_id": f"photo{update_id}",
+                "file_unique_id": f"photo{update_id}",
+                "width": 1,
+                "height": 1,
+            }
+        ]
+    if text:
+        payload["text"] = text
+    return {"update_id": update_id, "message": payload}
+
+
+def test_interleaved_albums_are_analyzed_once_with_the_users_texts(bot_app):
+    application, analyses, sent = bot_app
+    updates = [
+        message(1, 7, album="g7"),
+        message(2, 8, album="g8"),
+        message(3, 7, album="g7"),
+        message(4, 8, album="g8"),
+        message(5, 7, album="g7"),
+        # Sent right after the album, before it is complete
+        message(6, 7, text="это обед"),
+        message(7, 8, album="g8"),
+    ]
+
+    async def scenario():
+        async with application:
+            await application.start()
+            for update in updates:
+                await application.update_queue.put(
+                    Update.de_json(update, application.bot)
+                )
+            await asyncio.sleep(1)
+            await application.stop()
+
+    asyncio.run(scenario())
+
+    assert sorted(analyses) == [
+        ("user7", ["photo1", "photo3", "photo5"], "это обед"),
+        ("user8", ["photo2", "photo4", "photo7"], ""),
+    ]
+    assert sorted(sent) == [7, 8]
+    # The analyzed draft is emptied, the result waits for confirmation
+    for user_id in (7, 8):
+        assert application.user_data[user_id]["photo_ids"] == []
+        assert "current_gpt_response" in application.user_data[user_id]
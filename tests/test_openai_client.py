@@ -0,0 +1,217 @@
+"""Retries, deadlines, caps and the circuit breaker against a fake OpenAI server."""
+
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+import pytest
+
+import openai_client
+import routing
+
+COMPLETION = {
+    "id": "chatcmpl-test",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "test",
+    "choices": [
+        {
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": "ok"},
+        }
+    ],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+}
+
+
+class FakeOpenAI:
+    """
+    Chat completions endpoint answering each request with the next planned
+    behavior: "ok", "slow:<seconds>", "429:<retry-after>" or "500"
+    """
+
+    def __init__(self):
+        self.plan = []
+        # Behavior by requested model, used when the plan is empty
+        self.by_model = {}
+        self.requests = []
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with fake._lock:
+                    fake.requests.append((time.monotonic(), body["model"]))
+                    fake.active += 1
+                    fake.peak = max(fake.peak, fake.active)
+                    behavior = (
+                        fake.plan.pop(0)
+                        if fake.plan
+                        else fake.by_model.get(body["model"], "ok")
+                    )
+                try:
+                    self.respond(behavior)
+                finally:
+                    with fake._lock:
+                        fake.active -= 1
+
+            def respond(self, behavior):
+                kind, _, value = behavior.partition(":")
+                if kind == "slow":
+                    time.sleep(float(value))
+                if kind == "429":
+                    self.send_json(429, {"error": {"message": "rate limited"}}, value)
+                elif kind == "500":
+                    self.send_json(500, {"error": {"message": "server error"}})
+                else:
+                    self.send_json(200, COMPLETION)
+
+            def send_json(self, status, payload, retry_after=None):
+                data = json.dumps(payload).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    if retry_after:
+                        self.send_header("Retry-After", retry_after)
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up on a slow answer
+                    pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v1"
+
+    def gaps(self) -> list:
+        """Seconds between consecutive requests"""
+        times = [at for at, _ in self.requests]
+        return [later - earlier for earlier, later in zip(times, times[1:])]
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    fake = FakeOpenAI()
+    thread = threading.Thread(target=fake.server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(openai_client.client, "base_url", fake.url)
+    # Fresh breakers and semaphores; semaphores can't outlive an event loop
+    monkeypatch.setattr(openai_client, "_breakers", {})
+    monkeypatch.setattr(openai_client, "_semaphores", {})
+    monkeypatch.setattr(openai_client, "OPENAI_MAX_RETRIES", 2)
+    yield fake
+    fake.server.shutdown()
+    fake.server.server_close()
+
+
+def complete(model: str = "test-model", **kwargs):
+    """Make a chat completion through the shared client"""
+    return openai_client.call_openai(
+        model,
+        openai_client.client.chat.completions.create,
+        messages=[{"role": "user", "content": "hi"}],
+        **kwargs,
+    )
+
+
+def test_retries_honor_retry_after(fake_openai):
+    fake_openai.plan = ["429:0.3", "500"]
+
+    response = asyncio.run(complete())
+
+    assert response.choices[0].message.content == "ok"
+    assert len(fake_openai.requests) == 3
+    assert fake_openai.gaps()[0] >= 0.3
+
+
+def test_long_retry_after_fails_at_once(fake_openai):
+    fake_openai.plan = ["429:120"]
+
+    started = time.monotonic()
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(complete())
+
+    assert time.monotonic() - started < 1
+    assert len(fake_openai.requests) == 1
+
+
+def test_slow_answer_is_cut_at_the_deadline_and_retried(fake_openai):
+    fake_openai.plan = ["slow:5"]
+
+    started = time.monotonic()
+    response = asyncio.run(complete(deadline=0.3))
+
+    assert response.choices[0].message.content == "ok"
+    assert len(fake_openai.requests) == 2
+    # Deadline plus at most 1.5 s of backoff, not the 5 s answer
+    assert time.monotonic() - started < 3
+
+
+def test_breaker_opens_and_lets_a_trial_through(fake_openai, monkeypatch):
+    monkeypatch.setattr(openai_client, "OPENAI_BREAKER_THRESHOLD", 2)
+    monkeypatch.setattr(openai_client, "OPENAI_BREAKER_RESET", 0.5)
+    fake_openai.by_model["test-model"] = "500"
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(openai.InternalServerError):
+                await complete(retries=0)
+        assert openai_client.get_breaker("test-model").state == "open"
+
+        # Paused without reaching the server
+        with pytest.raises(openai_client.CircuitOpenError):
+            await complete(retries=0)
+        assert len(fake_openai.requests) == 2
+
+        await asyncio.sleep(0.5)
+        fake_openai.by_model["test-model"] = "ok"
+        await complete(retries=0)
+        assert openai_client.get_breaker("test-model").state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_calls_are_capped_per_model(fake_openai, monkeypatch):
+    monkeypatch.setattr(openai_client, "OPENAI_CONCURRENCY", 2)
+    fake_openai.by_model["test-model"] = "slow:0.2"
+
+    async def scenario():
+        await asyncio.gather(*[complete() for _ in range(6)])
+
+    asyncio.run(scenario())
+
+    assert len(fake_openai.requests) == 6
+    assert fake_openai.peak == 2
+
+
+def test_route_falls_back_from_a_slow_model(fake_openai, monkeypatch, db):
+    monkeypatch.setitem(routing.MODEL_ROUTES, "test", ["slow-model", "fast-model"])
+    monkeypatch.setattr(routing, "OPENAI_FALLBACK_TIMEOUT", 0.3)
+    fake_openai.by_model["slow-model"] = "slow:1"
+
+    started = time.monotonic()
+    response = asyncio.run(
+        routing.call_route(
+            "test",
+            openai_client.client.chat.completions.create,
+            messages=[{"role": "user", "content": "hi"}],
+        )
+    )
+
+    assert response.choices[0].message.content == "ok"
+    assert [model for _, model in fake_openai.requests] == [
+        "slow-model",
+        "fast-model",
+    ]
+    assert time.monotonic() - started < 1
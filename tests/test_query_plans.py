@@ -0,0 +1,80 @@
+"""The per-user queries must be served by the per-user indexes."""
+
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+import database
+
+
+def query_plans(func, *args) -> list:
+    """
+    Run a database function and get the SQLite plans of its SELECTs
+    Returns:
+        list: One plan per SELECT, as the joined details of its steps
+    """
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(database.engine, "before_cursor_execute", capture)
+    try:
+        func(*args)
+    finally:
+        event.remove(database.engine, "before_cursor_execute", capture)
+
+    plans = []
+    with database.engine.connect() as conn:
+        for statement, parameters in statements:
+            rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            plans.append(" | ".join(row[-1] for row in rows))
+    return plans
+
+
+@pytest.fixture
+def history(db):
+    """A few weeks of meals and weights of two users"""
+    today = date.today()
+    for days_ago in range(21):
+        for username in ("alice", "bob"):
+            db.save_weight_measurement(
+                username, 70 + days_ago / 10, datetime.now() - timedelta(days=days_ago)
+            )
+    for _ in range(3):
+        db.save_gpt_response("Итого: 500 ккал", "alice")
+        db.save_gpt_response("Итого: 400 ккал", "bob")
+    return today
+
+
+def test_daily_records_use_the_username_date_index(history):
+    plans = query_plans(database.get_daily_food_records, "alice", history)
+    meal_plans = [plan for plan in plans if "daily_data" in plan]
+    assert meal_plans
+    for plan in meal_plans:
+        assert "USING INDEX ix_daily_data_username_date_time" in plan
+        # The index already orders the day's meals by time
+        assert "TEMP B-TREE" not in plan
+
+
+def test_weekly_nutrition_uses_the_username_date_index(history):
+    plans = query_plans(
+        database.get_weekly_nutrition, "alice", history - timedelta(days=6)
+    )
+    meal_plans = [plan for plan in plans if "daily_data" in plan]
+    assert meal_plans
+    for plan in meal_plans:
+        assert "USING INDEX ix_daily_data_username_date_time" in plan
+
+
+@pytest.mark.parametrize("limit", [None, 5])
+def test_weight_history_uses_the_username_measured_at_index(history, limit):
+    plans = query_plans(database.get_weight_history, "alice", limit)
+    weight_plans = [plan for plan in plans if "weight_history" in plan]
+    assert weight_plans
+    for plan in weight_plans:
+        assert "USING INDEX ix_weight_history_username_measured_at" in plan
+        # Newest first is a backwards scan of the index, not a sort
+        assert "TEMP B-TREE" not in plan
@@ -0,0 +1,95 @@
+"""Scheduled runs: one at a time, and no user messaged twice by a retry."""
+
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import scheduler
+from async_database import claim_scheduled_job
+
+
+class FakeApplication:
+    def __init__(self):
+        self.tasks = []
+
+    def create_task(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.append(task)
+        return task
+
+
+@pytest.fixture
+def fire_time(db):
+    """A due fire time of the job "test", which has run before"""
+    now = datetime.now(pytz.utc).replace(microsecond=0)
+    # The first claim only registers the job
+    db.claim_scheduled_job("test", now - timedelta(days=1), timedelta(minutes=1))
+    return now
+
+
+def test_a_long_run_keeps_its_lease(fire_time, monkeypatch):
+    # A lease of 0.6 s, renewed every 0.2 s
+    monkeypatch.setattr(scheduler, "JOB_LEASE_MINUTES", 0.01)
+    application = FakeApplication()
+    runs = []
+
+    async def job(application, fire_time):
+        runs.append(fire_time)
+        await asyncio.sleep(1.5)
+
+    async def scenario():
+        assert await scheduler.run_scheduled_job(application, "test", fire_time, job)
+        await asyncio.sleep(1)
+        # Past the first lease: neither this process nor another claims it
+        assert not await scheduler.run_scheduled_job(
+            application, "test", fire_time, job
+        )
+        assert not await claim_scheduled_job("test", fire_time, timedelta(minutes=1))
+        await asyncio.gather(*application.tasks)
+        # Done: the fire time is never run again
+        assert not await scheduler.run_scheduled_job(
+            application, "test", fire_time, job
+        )
+
+    asyncio.run(scenario())
+    assert runs == [fire_time]
+
+
+def test_a_retried_run_skips_users_it_reached(fire_time, db):
+    application = FakeApplication()
+    users = ["alice", "bob", "carol", "dave"]
+    sent = []
+    crash = True
+
+    async def job(application, fire_time):
+        for username in await scheduler.undelivered(users):
+            if crash and len(sent) == 2:
+                raise RuntimeError("lost connection")
+            sent.append(username)
+            await scheduler.mark_delivered(username)
+
+    async def scenario():
+        nonlocal crash
+        assert await scheduler.run_scheduled_job(application, "test", fire_time, job)
+        await asyncio.gather(*application.tasks)
+        assert sent == ["alice", "bob"]
+
+        crash = False
+        assert await scheduler.run_scheduled_job(application, "test", fire_time, job)
+        await asyncio.gather(*application.tasks)
+
+    asyncio.run(scenario())
+
+    assert sent == users
+    # A completed run needs its marks no more
+    assert db.get_job_deliveries("test", fire_time) == set()
+
+
+def test_outside_a_scheduled_run_everyone_is_messaged():
+    async def scenario():
+        await scheduler.mark_delivered("alice")
+        return await scheduler.undelivered(["alice", "bob"])
+
+    assert asyncio.run(scenario()) == ["alice", "bob"]
@@ -0,0 +1,220 @@
+"""Daily summaries through a local stand-in for the OpenAI Batch API."""
+
+import asyncio
+import json
+import re
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import pytz
+
+import main
+import openai_client
+from constants import DEFAULT_TIMEZONE
+
+
+class FakeBatchAPI:
+    """
+    Files and batches endpoints keeping everything in memory; batches stay
+    in progress until complete() is called
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.batches = {}
+        self.fail_batches = False
+        # Custom ids whose requests fail inside a completed batch
+        self.failing_requests = set()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, payload, status=200):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                if self.path == "/v1/files":
+                    content = re.search(
+                        rb'filename="requests.jsonl"\r\n[^\r]*\r\n\r\n(.*?)\r\n--',
+                        body,
+                        re.S,
+                    ).group(1)
+                    file_id = fake.add_file(content.decode())
+                    return self.send_json(
+                        {
+                            "id": file_id,
+                            "object": "file",
+                            "bytes": len(content),
+                            "created_at": 0,
+                            "filename": "requests.jsonl",
+                            "purpose": "batch",
+                            "status": "processed",
+                        }
+                    )
+                if self.path == "/v1/batches":
+                    if fake.fail_batches:
+                        return self.send_json({"error": {"message": "down"}}, 500)
+                    request = json.loads(body)
+                    batch_id = f"batch-{len(fake.batches)}"
+                    fake.batches[batch_id] = {
+                        "id": batch_id,
+                        "status": "in_progress",
+                        "input_file_id": request["input_file_id"],
+                        "output_file_id": None,
+                    }
+                    return self.send_json(fake.batches[batch_id])
+
+            def do_GET(self):
+                match = re.fullmatch(r"/v1/batches/(.+)", self.path)
+                if match:
+                    return self.send_json(fake.batches[match.group(1)])
+                match = re.fullmatch(r"/v1/files/(.+)/content", self.path)
+                if match:
+                    data = fake.files[match.group(1)].encode()
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v1"
+
+    def add_file(self, content: str) -> str:
+        file_id = f"file-{len(self.files)}"
+        self.files[file_id] = content
+        return file_id
+
+    def requests(self, batch_id: str) -> list:
+        """Request lines uploaded for a batch"""
+        content = self.files[self.batches[batch_id]["input_file_id"]]
+        return [json.loads(line) for line in content.splitlines()]
+
+    def complete(self, batch_id: str):
+        """Answer every request of a batch and mark it completed"""
+        results = []
+        for request in self.requests(batch_id):
+            custom_id = request["custom_id"]
+            if custom_id in self.failing_requests:
+                response = {"status_code": 500, "body": {}}
+            else:
+                response = {
+                    "status_code": 200,
+                    "body": {
+                        "model": request["body"]["model"],
+                        "choices": [
+                            {"message": {"content": f"BATCH analysis of {custom_id}"}}
+                        ],
+                        "usage": {"prompt_tokens": 100, "completion_tokens": 20},
+                    },
+                }
+            results.append(
+                json.dumps(
+                    {"custom_id": custom_id, "response": response, "error": None}
+                )
+            )
+        batch = self.batches[batch_id]
+        batch["output_file_id"] = self.add_file("\n".join(results))
+        batch["status"] = "completed"
+
+
+class FakeApplication:
+    """Just what the summary jobs use of the Telegram application"""
+
+    def __init__(self):
+        self.sent = {}
+        self.tasks = []
+        application = self
+
+        class Bot:
+            async def send_message(self, chat_id, text, parse_mode=None):
+                application.sent[chat_id] = text
+
+        self.bot = Bot()
+
+    def create_task(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.append(task)
+        return task
+
+
+@pytest.fixture
+def batch_api(monkeypatch, db):
+    fake = FakeBatchAPI()
+    thread = threading.Thread(target=fake.server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(openai_client.client, "base_url", fake.url)
+    monkeypatch.setattr(main, "SUMMARY_MODE", "batch")
+
+    async def direct_analysis(food_records, goals, username=None):
+        return f"DIRECT analysis of {username}"
+
+    monkeypatch.setattr(main, "analyze_nutrition_vs_goals", direct_analysis)
+
+    # alice and bob have goals, carol has none and needs no analysis
+    for username in ("alice", "bob", "carol"):
+        db.save_gpt_response("<b>Каша</b>\nИтого: 300 ккал", username)
+    db.save_nutrition_goals("alice", "Дневная норма калорий: 2000 ккал")
+    db.save_nutrition_goals("bob", "Дневная норма калорий: 1800 ккал")
+
+    yield fake
+    fake.server.shutdown()
+    fake.server.server_close()
+
+
+def next_morning() -> datetime:
+    """Fire time of the summary of today's meals"""
+    return datetime.now(pytz.timezone(DEFAULT_TIMEZONE)) + timedelta(days=1)
+
+
+def test_analyses_go_through_a_batch(batch_api, db):
+    application = FakeApplication()
+
+    async def scenario():
+        await main.send_daily_summary(application, next_morning(), DEFAULT_TIMEZONE)
+        # Only the summary without an analysis is sent right away
+        assert list(application.sent) == ["carol"]
+        batch_users = [
+            request["custom_id"] for request in batch_api.requests("batch-0")
+        ]
+        assert sorted(batch_users) == ["alice", "bob"]
+
+        # Nothing is sent while the batch runs
+        await main.poll_summary_batches(application)
+        await asyncio.gather(*application.tasks)
+        assert list(application.sent) == ["carol"]
+        assert len(db.get_pending_summary_batches()) == 1
+
+        batch_api.failing_requests.add("bob")
+        batch_api.complete("batch-0")
+        await main.poll_summary_batches(application)
+        await asyncio.gather(*application.tasks)
+
+    asyncio.run(scenario())
+
+    assert "BATCH analysis of alice" in application.sent["alice"]
+    # A request that failed in the batch is analyzed directly
+    assert "DIRECT analysis of bob" in application.sent["bob"]
+    assert "Анализ питания" not in application.sent["carol"]
+    assert db.get_pending_summary_batches() == []
+
+
+def test_summaries_are_sent_directly_if_the_batch_cannot_start(batch_api, db):
+    batch_api.fail_batches = True
+    application = FakeApplication()
+
+    asyncio.run(main.send_daily_summary(application, next_morning(), DEFAULT_TIMEZONE))
+
+    assert sorted(application.sent) == ["alice", "bob", "carol"]
+    assert "DIRECT analysis of alice" in application.sent["alice"]
+    assert db.get_pending_summary_batches() == []
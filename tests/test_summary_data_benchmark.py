@@ -0,0 +1,106 @@
+"""Benchmark: loading the midnight summary for 10k users in bulk.
+
+The old job made three queries per user (records, total, goals) after
+listing the users. Run with -s to see the timings and query counts.
+"""
+
+import random
+import time
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import event
+
+USERS = 10_000
+DAYS = 7
+MEALS_PER_DAY = 3
+
+RESPONSE = "<b>Омлет с сыром</b>\nИтого: {} ккал"
+
+
+def fill_week(database, yesterday: date):
+    """Insert a week of meals of every user, goals of half of them and the rollup"""
+    rnd = random.Random(5)
+    with database.engine.begin() as conn:
+        # Straight to the driver: the ORM would take longer than the benchmark
+        conn.exec_driver_sql(
+            "INSERT INTO daily_data (date, time, username, gpt_response, calories) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    (yesterday - timedelta(days=day)).isoformat(),
+                    f"{8 + 5 * meal:02d}:00:00.000000",
+                    f"user{user}",
+                    RESPONSE.format(calories),
+                    calories,
+                )
+                for day in range(DAYS)
+                for user in range(USERS)
+                for meal in range(MEALS_PER_DAY)
+                for calories in [rnd.randint(200, 900)]
+            ],
+        )
+        conn.exec_driver_sql(
+            "INSERT INTO nutrition_goals "
+            "(username, goals, calories_target, protein_target) VALUES (?, ?, ?, ?)",
+            [
+                (f"user{user}", "2000 ккал, белок 120 г", 2000, 120)
+                for user in range(0, USERS, 2)
+            ],
+        )
+        conn.execute(database._insert_daily_totals())
+
+
+def old_summary_data(database, target_date: date) -> dict:
+    """What send_daily_summary loaded before the bulk loader, query by query"""
+    return {
+        username: {
+            "food_records": database.get_daily_food_records(username, target_date),
+            "total_calories": database.get_daily_calories(username, target_date),
+            "goals": database.get_nutrition_targets(username),
+        }
+        for username in database.get_all_active_users()
+    }
+
+
+def measure(database, func, *args) -> tuple:
+    """Run func with cold goal caches; returns (result, seconds, queries)"""
+    queries = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    database._goals_cache.clear()
+    event.listen(database.engine, "before_cursor_execute", count)
+    try:
+        started = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - started
+    finally:
+        event.remove(database.engine, "before_cursor_execute", count)
+    return result, seconds, len(queries)
+
+
+@pytest.mark.benchmark
+def test_summary_data_for_10k_users_loads_in_a_few_queries(scratch_db):
+    database = scratch_db
+    yesterday = date.today() - timedelta(days=1)
+    fill_week(database, yesterday)
+
+    old, old_seconds, old_queries = measure(
+        database, old_summary_data, database, yesterday
+    )
+    new, new_seconds, new_queries = measure(
+        database, database.get_daily_summary_data, yesterday
+    )
+
+    print(
+        f"\n{USERS} users, {MEALS_PER_DAY} meals a day for {DAYS} days"
+        f"\n  per user: {old_queries} queries, {old_seconds:.2f} s"
+        f"\n  bulk:     {new_queries} queries, {new_seconds:.2f} s"
+    )
+    assert len(new) == USERS
+    assert new == old
+    assert old_queries == 3 * USERS + 1
+    assert new_queries == 4
+    assert new_seconds < old_seconds / 5
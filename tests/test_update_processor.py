@@ -0,0 +1,202 @@
+"""Deterministic replays of mixed traffic through the ordered update processor."""
+
+import asyncio
+import random
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from update_processor import UpdateQueue, UserOrderedUpdateProcessor, ordering_key
+
+
+def mixed_traffic(seed: int, users: int = 30, events: int = 150) -> list:
+    """
+    Update JSON of albums, texts, button presses and channel posts of many
+    users, each with how long its handler takes
+    Returns:
+        list: Tuples (update JSON, seconds)
+    """
+    rnd = random.Random(seed)
+    traffic = []
+    update_id = 0
+    for _ in range(events):
+        user_id = 100 + rnd.randrange(users)
+        sender = {"id": user_id, "is_bot": False, "first_name": "user"}
+        chat = {"id": user_id, "type": "private"}
+        kind = rnd.choice(["album", "text", "button", "channel"])
+        album = f"album{update_id}"
+        for _ in range(rnd.randint(2, 5) if kind == "album" else 1):
+            update_id += 1
+            if kind == "button":
+                payload = {
+                    "callback_query": {
+                        "id": str(update_id),
+                        "from": sender,
+                        "chat_instance": "chat",
+                        "data": "correct",
+                    }
+                }
+            elif kind == "channel":
+                payload = {
+                    "channel_post": {
+                        "message_id": update_id,
+                        "date": 0,
+                        "text": "news",
+                        "chat": {"id": -5, "type": "channel"},
+                    }
+                }
+            else:
+                payload = {
+                    "message": {
+                        "message_id": update_id,
+                        "date": 0,
+                        "chat": chat,
+                        "from": sender,
+                        "text": "text",
+                    }
+                }
+                if kind == "album":
+                    payload["message"]["media_group_id"] = album
+            traffic.append(
+                ({"update_id": update_id, **payload}, rnd.uniform(0.001, 0.01))
+            )
+    return traffic
+
+
+def replay(traffic: list, concurrency: int = 8, max_in_flight: int = 32) -> dict:
+    """
+    Feed traffic to an application with the ordered processor
+    Returns:
+        dict: Observations: per-key handled update ids in order, peak
+            running handlers, peak updates in flight and whether one key
+            ever ran twice at once
+    """
+    durations = {}
+    running = set()
+    stats = {"order": {}, "peak_running": 0, "peak_in_flight": 0, "overlap": False}
+
+    async def handle(update, context):
+        key = ordering_key(update)
+        if key in running:
+            stats["overlap"] = True
+        running.add(key)
+        stats["peak_running"] = max(stats["peak_running"], len(running))
+        await asyncio.sleep(durations[update.update_id])
+        stats["order"].setdefault(key, []).append(update.update_id)
+        running.discard(key)
+
+    async def scenario():
+        queue = UpdateQueue(max_in_flight)
+        application = (
+            Application.builder()
+            .token("123:test")
+            .updater(None)
+            .update_queue(queue)
+            .concurrent_updates(UserOrderedUpdateProcessor(concurrency, queue))
+            .build()
+        )
+        application.add_handler(TypeHandler(Update, handle))
+        async with application:
+            await application.start()
+            for payload, duration in traffic:
+                update = Update.de_json(payload, application.bot)
+                durations[update.update_id] = duration
+                await queue.put(update)
+                stats["peak_in_flight"] = max(stats["peak_in_flight"], queue.in_flight)
+            while queue.in_flight:
+                await asyncio.sleep(0.01)
+            await application.stop()
+
+    asyncio.run(scenario())
+    return stats
+
+
+def test_mixed_traffic_keeps_per_user_order_within_the_limits(offline_bot):
+    traffic = mixed_traffic(seed=25)
+
+    stats = replay(traffic, concurrency=8, max_in_flight=32)
+
+    handled = [update_id for ids in stats["order"].values() for update_id in ids]
+    assert sorted(handled) == [payload["update_id"] for payload, _ in traffic]
+    for ids in stats["order"].values():
+        assert ids == sorted(ids)
+    assert not stats["overlap"]
+    # Different users did run in parallel, within the cap
+    assert 1 < stats["peak_running"] <= 8
+    # More traffic than the limit: intake was held back at it
+    assert stats["peak_in_flight"] == 32
+
+
+def test_replay_of_the_same_traffic_gives_the_same_sequences(offline_bot):
+    first = replay(mixed_traffic(seed=7))
+    second = replay(mixed_traffic(seed=7))
+
+    assert first["order"] == second["order"]
+
+
+def test_queue_admits_no_more_than_its_limit(offline_bot):
+    async def scenario():
+        application = Application.builder().token("123:test").updater(None).build()
+        queue = UpdateQueue(2)
+        updates = [
+            Update.de_json(payload, application.bot)
+            for payload, _ in mixed_traffic(seed=1, events=3)[:3]
+        ]
+        await queue.put(updates[0])
+        await queue.put(updates[1])
+        third = asyncio.create_task(queue.put(updates[2]))
+        await asyncio.sleep(0.05)
+        assert not third.done()
+        assert queue.in_flight == 2
+
+        queue.finish(updates[0])
+        await asyncio.wait_for(third, 1)
+        assert queue.in_flight == 2
+
+    asyncio.run(scenario())
+
+
+def test_a_users_burst_does_not_hold_slots_of_others(offline_bot):
+    finished = {}
+
+    async def handle(update, context):
+        await asyncio.sleep(0.1 if update.effective_user.id == 100 else 0)
+        finished[update.update_id] = asyncio.get_running_loop().time()
+
+    async def scenario():
+        queue = UpdateQueue(32)
+        application = (
+            Application.builder()
+            .token("123:test")
+            .updater(None)
+            .update_queue(queue)
+            .concurrent_updates(UserOrderedUpdateProcessor(2, queue))
+            .build()
+        )
+        application.add_handler(TypeHandler(Update, handle))
+        async with application:
+            await application.start()
+            started = asyncio.get_running_loop().time()
+            # Ten slow updates of one user, then one of another user
+            for update_id, user_id in enumerate([100] * 10 + [200], start=1):
+                payload = {
+                    "update_id": update_id,
+                    "message": {
+                        "message_id": update_id,
+                        "date": 0,
+                        "chat": {"id": user_id, "type": "private"},
+                        "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+                        "text": "text",
+                    },
+                }
+                await queue.put(Update.de_json(payload, application.bot))
+            while queue.in_flight:
+                await asyncio.sleep(0.01)
+            await application.stop()
+        return started
+
+    started = asyncio.run(scenario())
+
+    # The other user ran in the free slot instead of after the whole burst
+    assert finished[11] - started < 0.3
+    assert finished[10] - started >= 1
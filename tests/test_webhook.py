@@ -0,0 +1,123 @@
+"""Webhook requests held back by a full update queue, as Telegram retries them."""
+
+import asyncio
+import socket
+
+import httpx
+import pytest
+import uvicorn
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from config import WEBHOOK_PATH
+from update_processor import UpdateQueue, UserOrderedUpdateProcessor
+from webhook import create_asgi_app
+
+SECRET = "test-secret"
+
+
+def message(update_id: int, user_id: int) -> dict:
+    """Update JSON of a text message"""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+            "text": "text",
+        },
+    }
+
+
+async def deliver(url: str, queue: UpdateQueue, release: asyncio.Event):
+    """Post updates the way Telegram does when the bot answers too slowly"""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+    async with httpx.AsyncClient(headers=headers) as client:
+        response = await client.post(url, json=message(1, 100))
+        assert response.status_code == 200
+
+        # Held back by the full queue until Telegram gives up on it
+        with pytest.raises(httpx.TimeoutException):
+            await client.post(url, json=message(2, 200), timeout=0.3)
+
+        # The redelivery is answered at once and not queued again
+        response = await client.post(url, json=message(2, 200), timeout=1)
+        assert response.status_code == 200
+
+        release.set()
+        while queue.in_flight:
+            await asyncio.sleep(0.01)
+        # A late copy of a processed update is dropped as well
+        response = await client.post(url, json=message(2, 200), timeout=1)
+        assert response.status_code == 200
+        await asyncio.sleep(0.1)
+
+
+def test_update_redelivered_after_a_timeout_is_processed_once(offline_bot):
+    handled = []
+    release = asyncio.Event()
+
+    async def handle(update, context):
+        handled.append(update.update_id)
+        await release.wait()
+
+    async def scenario():
+        # Room for one update: the first one fills the queue until released
+        queue = UpdateQueue(1)
+        application = (
+            Application.builder()
+            .token("123:test")
+            .updater(None)
+            .update_queue(queue)
+            .concurrent_updates(UserOrderedUpdateProcessor(4, queue))
+            .build()
+        )
+        application.add_handler(TypeHandler(Update, handle))
+
+        server_socket = socket.socket()
+        server_socket.bind(("127.0.0.1", 0))
+        url = f"http://127.0.0.1:{server_socket.getsockname()[1]}/{WEBHOOK_PATH}"
+        server = uvicorn.Server(
+            uvicorn.Config(
+                create_asgi_app(application, SECRET),
+                log_level="warning",
+                lifespan="off",
+            )
+        )
+
+        async with application:
+            await application.start()
+            serving = asyncio.create_task(server.serve(sockets=[server_socket]))
+            while not server.started:
+                await asyncio.sleep(0.01)
+            try:
+                await deliver(url, queue, release)
+            finally:
+                # Let held requests finish, so the server can stop
+                release.set()
+                server.should_exit = True
+                await serving
+                await application.stop()
+
+    asyncio.run(scenario())
+
+    assert handled == [1, 2]
+
+
+def test_wrong_secret_is_refused(offline_bot):
+    async def scenario():
+        application = Application.builder().token("123:test").updater(None).build()
+        app = create_asgi_app(application, SECRET)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bot"
+        ) as client:
+            response = await client.post(
+                f"/{WEBHOOK_PATH}",
+                json=message(1, 100),
+                headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"},
+            )
+        return response.status_code
+
+    assert asyncio.run(scenario()) == 403
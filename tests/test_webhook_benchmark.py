@@ -0,0 +1,206 @@
+"""Load generator: synthetic Telegram updates through polling and the webhook.
+
+Updates of many users arrive at a steady rate. Polling takes what has
+arrived in batches, as the Updater does; the webhook gets each one posted
+over up to WEBHOOK_MAX_CONNECTIONS connections, as Telegram does. Latency
+is from an update's arrival until its handler is done. Run with -s to see
+the table.
+"""
+
+import asyncio
+import random
+import socket
+import time
+
+import httpx
+import pytest
+import uvicorn
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from config import UPDATE_CONCURRENCY, WEBHOOK_MAX_CONNECTIONS, WEBHOOK_PATH
+from update_processor import UpdateQueue, UserOrderedUpdateProcessor
+from webhook import create_asgi_app
+
+UPDATES = 400
+USERS = 100
+ARRIVALS_PER_SECOND = 200
+HANDLER_SECONDS = 0.02
+POLL_INTERVAL = 0.1
+POLL_BATCH = 100
+
+SECRET = "load-test-secret"
+
+
+def synthetic_updates(seed: int = 24) -> list:
+    """Text messages of USERS users in random order, as update JSON"""
+    rnd = random.Random(seed)
+    updates = []
+    for update_id in range(1, UPDATES + 1):
+        user_id = 1000 + rnd.randrange(USERS)
+        updates.append(
+            {
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": 0,
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+                    "text": "гречка 200 г",
+                },
+            }
+        )
+    return updates
+
+
+async def poll(application: Application, queue: UpdateQueue, updates: list, arrivals):
+    """Hand over what has arrived every POLL_INTERVAL, like getUpdates"""
+    pending = list(zip(arrivals, updates))
+    while pending:
+        await asyncio.sleep(POLL_INTERVAL)
+        now = time.perf_counter()
+        batch = [payload for arrival, payload in pending[:POLL_BATCH] if arrival <= now]
+        del pending[: len(batch)]
+        for payload in batch:
+            await queue.put(Update.de_json(payload, application.bot))
+
+
+async def send_updates(url: str, updates: list, arrivals: list) -> list:
+    """
+    Post each update at its arrival, like Telegram: a chat's next update
+    after the previous one is answered, up to WEBHOOK_MAX_CONNECTIONS at once
+    Returns:
+        list: Response status codes
+    """
+    chats = {}
+    for arrival, payload in zip(arrivals, updates):
+        chats.setdefault(payload["message"]["chat"]["id"], []).append(
+            (arrival, payload)
+        )
+
+    limits = httpx.Limits(max_connections=WEBHOOK_MAX_CONNECTIONS)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+
+        async def deliver(chat_updates):
+            statuses = []
+            for arrival, payload in chat_updates:
+                await asyncio.sleep(max(0, arrival - time.perf_counter()))
+                response = await client.post(
+                    url,
+                    json=payload,
+                    headers={"X-Telegram-Bot-Api-Secret-Token": SECRET},
+                )
+                statuses.append(response.status_code)
+            return statuses
+
+        results = await asyncio.gather(*[deliver(chat) for chat in chats.values()])
+    return [status for statuses in results for status in statuses]
+
+
+async def post(application: Application, updates: list, arrivals: list):
+    """Serve the webhook and have a load generator thread post the updates"""
+    server_socket = socket.socket()
+    server_socket.bind(("127.0.0.1", 0))
+    url = f"http://127.0.0.1:{server_socket.getsockname()[1]}/{WEBHOOK_PATH}"
+    server = uvicorn.Server(
+        uvicorn.Config(
+            create_asgi_app(application, SECRET), log_level="warning", lifespan="off"
+        )
+    )
+    serving = asyncio.create_task(server.serve(sockets=[server_socket]))
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    # The generator gets its own thread and loop, as Telegram is not
+    # sharing the bot's event loop
+    statuses = await asyncio.to_thread(
+        asyncio.run, send_updates(url, updates, arrivals)
+    )
+
+    server.should_exit = True
+    await serving
+    assert statuses == [200] * len(updates)
+
+
+def run_load(mode: str, concurrency: int) -> dict:
+    """
+    Send the synthetic updates through one intake mode
+    Returns:
+        dict: Updates per second, p95 latency in seconds and the update ids
+            handled per user in order
+    """
+    updates = synthetic_updates()
+    handled = {}
+    order = {}
+
+    async def handle(update, context):
+        await asyncio.sleep(HANDLER_SECONDS)
+        handled[update.update_id] = time.perf_counter()
+        order.setdefault(update.effective_user.id, []).append(update.update_id)
+
+    async def scenario():
+        queue = UpdateQueue(256)
+        application = (
+            Application.builder()
+            .token("123:test")
+            .updater(None)
+            .update_queue(queue)
+            .concurrent_updates(UserOrderedUpdateProcessor(concurrency, queue))
+            .build()
+        )
+        application.add_handler(TypeHandler(Update, handle))
+        async with application:
+            await application.start()
+            started = time.perf_counter()
+            arrivals = [
+                started + index / ARRIVALS_PER_SECOND for index in range(UPDATES)
+            ]
+            if mode == "polling":
+                await poll(application, queue, updates, arrivals)
+            else:
+                await post(application, updates, arrivals)
+            while queue.in_flight:
+                await asyncio.sleep(0.01)
+            await application.stop()
+        return started, arrivals
+
+    started, arrivals = asyncio.run(scenario())
+    latencies = sorted(
+        handled[payload["update_id"]] - arrival
+        for payload, arrival in zip(updates, arrivals)
+    )
+    return {
+        "throughput": UPDATES / (max(handled.values()) - started),
+        "p95": latencies[int(len(latencies) * 0.95)],
+        "order": order,
+    }
+
+
+@pytest.mark.benchmark
+def test_load_through_polling_and_webhook(offline_bot):
+    modes = [
+        ("polling", 1),
+        ("polling", UPDATE_CONCURRENCY),
+        ("webhook", UPDATE_CONCURRENCY),
+    ]
+    results = {mode: run_load(*mode) for mode in modes}
+
+    print(
+        f"\n{UPDATES} updates of {USERS} users arriving at "
+        f"{ARRIVALS_PER_SECOND}/s, {HANDLER_SECONDS * 1000:.0f} ms handler"
+    )
+    print(f"  {'mode':24} {'updates/s':>9} {'p95':>8}")
+    for (mode, concurrency), result in results.items():
+        print(
+            f"  {mode + ', concurrency ' + str(concurrency):24} "
+            f"{result['throughput']:9.0f} {result['p95']:7.2f}s"
+        )
+
+    for result in results.values():
+        assert sum(len(ids) for ids in result["order"].values()) == UPDATES
+        for ids in result["order"].values():
+            assert ids == sorted(ids)
+    sequential = results[("polling", 1)]
+    for mode in modes[1:]:
+        assert results[mode]["throughput"] > 3 * sequential["throughput"]
+        assert results[mode]["p95"] < sequential["p95"] / 3
@@ -0,0 +1,135 @@
+"""Benchmark: size of the weekly weight analysis prompt vs meals logged.
+
+The old prompt pasted every meal's HTML response of the week; the new one
+holds the compacted week. Sizes use the same char/3 token estimate as the
+budget. Run with -s to see the table.
+"""
+
+import random
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import select, update
+
+from config import WEEKLY_PROMPT_TOKEN_BUDGET
+from nutrition import MealAnalysis, compact_week, estimate_tokens
+from openai_utils import _weight_progress_prompt
+
+MEAL_COUNTS = [1, 10, 50, 200]
+PRODUCTS_PER_MEAL = 3
+
+MENU = [
+    "Гречка",
+    "Куриная грудка",
+    "Омлет",
+    "Творог 5%",
+    "Овсянка на молоке",
+    "Банан",
+    "Яблоко",
+    "Салат из огурцов и помидоров",
+    "Борщ",
+    "Котлета из говядины",
+    "Картофельное пюре",
+    "Рис отварной",
+    "Лосось запечённый",
+    "Хлеб цельнозерновой",
+    "Сыр",
+    "Йогурт греческий",
+    "Макароны",
+    "Кофе с молоком",
+    "Шоколад",
+    "Орехи грецкие",
+]
+
+
+def log_week(db, username: str, meals: int):
+    """
+    Save meals of a user spread over the past week
+    Returns:
+        date: Start date of that week
+    """
+    rnd = random.Random(meals)
+    today = db.get_user_today(username)
+    for _ in range(meals):
+        items = [
+            {
+                "name": name,
+                "grams": rnd.choice([100, 150, 200]),
+                "calories": rnd.randint(50, 400),
+                "protein": 10,
+                "fat": 5,
+                "carbs": 20,
+            }
+            for name in rnd.sample(MENU, PRODUCTS_PER_MEAL)
+        ]
+        analysis = MealAnalysis(
+            items=items,
+            total={
+                "calories": sum(item["calories"] for item in items),
+                "protein": 30,
+                "fat": 15,
+                "carbs": 60,
+            },
+            comment="Сбалансированный приём пищи.",
+        )
+        db.save_gpt_response(
+            analysis.render_html(), username, analysis=analysis.model_dump()
+        )
+    # Spread the meals over the seven days before today, as process_weight reads
+    with db.engine.begin() as conn:
+        meal_ids = conn.execute(
+            select(db.DailyData.id)
+            .where(db.DailyData.username == username)
+            .order_by(db.DailyData.id)
+        ).scalars()
+        for index, meal_id in enumerate(meal_ids.all()):
+            conn.execute(
+                update(db.DailyData)
+                .where(db.DailyData.id == meal_id)
+                .values(date=today - timedelta(days=1 + index % 7))
+            )
+    db.rebuild_daily_totals(username)
+    return today - timedelta(days=7)
+
+
+def prompt_tokens(week: str) -> int:
+    """Estimated tokens of the whole weekly analysis prompt"""
+    prompt = _weight_progress_prompt(
+        75.0, week, [(None, 75.0), (None, 75.4)], 70.0, "2000 ккал, белок 120 г"
+    )
+    return estimate_tokens(prompt)
+
+
+@pytest.mark.benchmark
+def test_weekly_prompt_stays_bounded_however_many_meals(db):
+    sizes = []
+    for meals in MEAL_COUNTS:
+        username = f"eater{meals}"
+        start_date = log_week(db, username, meals)
+        responses = [
+            response
+            for day in range(7)
+            for _, response in db.get_daily_food_records(
+                username, start_date + timedelta(days=day)
+            )
+        ]
+        assert len(responses) == meals
+
+        old = prompt_tokens("\n".join(responses))
+        new = prompt_tokens(
+            compact_week(
+                db.get_weekly_nutrition(username, start_date),
+                WEEKLY_PROMPT_TOKEN_BUDGET,
+            )
+        )
+        sizes.append((meals, old, new))
+
+    empty = prompt_tokens("")
+    print(f"\nEstimated prompt tokens ({empty} without the week)")
+    for meals, old, new in sizes:
+        print(f"  {meals:4} meals: {old:6} -> {new:5}")
+
+    for meals, old, new in sizes:
+        assert new - empty <= WEEKLY_PROMPT_TOKEN_BUDGET
+    # The old prompt grew with every meal
+    assert sizes[-1][1] > 10 * sizes[1][1] > 0